@@ -2,7 +2,9 @@
 import os
 from osgeo import gdal
 from rasterio.coords import BoundingBox
-from global_grid2tiles import BaseTileGenerator,OverviewTileGenerator,save_matrix_as_png
+from global_grid2tiles import BaseTileGenerator,OverviewTileGenerator,build_overview_tiles,save_matrix_as_png
+from palette_lut import PaletteLUT
+from raster_source import WindowedRasterSource
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
@@ -41,60 +43,73 @@ config = {
     ]
 }
 
-# 将十六进制颜色转换为RGB元组
-def hex_to_rgb(hex_color):
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+# 调色板查找表, nodata(0)映射为透明
+palette_lut = PaletteLUT(config, nodata_value=0)
+# True时按调色板索引直接存为索引色png(更小, 编码更快); 自定义map_to_RGB时改为False
+indexed_png = True
 
 
 def map_to_RGB(data):
-    # 创建颜色映射
-    palette = [hex_to_rgb(color) for color in config['palette']]
+    # 整张瓦片一次性查表着色, 返回RGBA矩阵
+    return palette_lut(data)
 
-    # 获取图像的宽度和高度
-    width = len(data[0])
-    height = len(data)
 
-    # 创建一个新的图像
-    image = Image.new('RGB', (width, height))
-
-    # 将数据映射到颜色并填充图像
-    for y in range(height):
-        for x in range(width):
-            value = data[y][x]
-            # 将值映射到调色板索引
-            index = int((value - config['min']) / (config['max'] - config['min']) * (len(palette) - 1))
-            color = palette[index]
-            image.putpixel((x, y), color)
-            # print(f'{value}-----{color}')
-    return image
+def save_tiles(tile_iter, save_path):
+    # 着色保存每张瓦片, 并原样向下游传递 (用于逐级构建上一级瓦片)
+    for imagedict in tile_iter:
+        outpath = f"{save_path}/{imagedict['current_index']}.png"
+        if indexed_png:
+            palette_lut.save_png(imagedict['data'], outpath)
+        else:
+            savedData = map_to_RGB(imagedict['data'])
+            save_matrix_as_png(np.array(savedData),outpath)
+        yield imagedict
 
 
-def pyramidBuilding(input_tif,save_path,maxScale,bands=[1]):
+def pyramidBuilding(input_tif,save_path,maxScale,bands=[1],single_read=True,lazy=False):
+    """
+    single_read: True时只从原始数据切最深一级(maxScale-1)瓦片, 其余各级由下一级瓦片2x2降采样得到;
+                 False时每一级都从全分辨率数据重新切片
+    lazy: True时不整幅读入内存, 每张瓦片只按窗口读取所需的数据块(raster_source.WindowedRasterSource),
+          适用于全球500m/100m等大幅GeoTIFF
+    """
     ds = gdal.Open(input_tif)
     geotransform = ds.GetGeoTransform()
     projection = ds.GetProjection()
     bbox = geotransform_to_bbox(geotransform, ds.RasterXSize, ds.RasterYSize)
     # 读取多波段数据
     num_bands = ds.RasterCount
-    if num_bands>=3 and len(bands)==3:
+    if not (num_bands>=3 and len(bands)==3) and len(bands)!=1:
+        raise Exception('bands set error')
+    if lazy:
+        data3 = WindowedRasterSource(input_tif, bands=bands)
+    elif len(bands)==3:
         dataR = ds.GetRasterBand(bands[0]).ReadAsArray()
         dataG = ds.GetRasterBand(bands[1]).ReadAsArray()
         dataB = ds.GetRasterBand(bands[2]).ReadAsArray()
         data3  = np.stack([dataR, dataG, dataB], axis=0)
-    elif len(bands)==1:
+    else:
         data = ds.GetRasterBand(bands[0]).ReadAsArray()
         data3  = np.expand_dims(data, axis=0)
-    else:
-        raise Exception('bands set error')
     ds = None
 
-    for i in tqdm(range(maxScale)):
-        basetileList = BaseTileGenerator(data3, geotransform, bbox, max_zoom=i, min_zoom=1, nodata_value=0, tile_size=256, xyz_flag=True, max_zoom_level=32)
-        myList = basetileList.generate_tiles()
-        for imagedict in myList:
-            outpath = f"{save_path}/{imagedict['current_index']}.png"
-            savedData = map_to_RGB(imagedict['data'])
-            save_matrix_as_png(np.array(savedData),outpath)
+    if single_read:
+        max_zoom = maxScale - 1
+        basetileList = BaseTileGenerator(data3, geotransform, bbox, max_zoom=max_zoom, min_zoom=max(max_zoom - 1, 0), nodata_value=0, tile_size=256, xyz_flag=True, max_zoom_level=32)
+        # 每一级瓦片在保存的同时流式生成上一级, 直到0级
+        tile_stream = save_tiles(basetileList.iter_tiles(), save_path)
+        for _ in range(basetileList.max_zoom):
+            tile_stream = save_tiles(build_overview_tiles(tile_stream, tile_size=256), save_path)
+        for _ in tqdm(tile_stream, desc='zoom-0'):
+            pass
+    else:
+        for i in tqdm(range(maxScale)):
+            basetileList = BaseTileGenerator(data3, geotransform, bbox, max_zoom=i, min_zoom=1, nodata_value=0, tile_size=256, xyz_flag=True, max_zoom_level=32)
+            for _ in save_tiles(basetileList.iter_tiles(), save_path):
+                pass
+
+    if lazy:
+        data3.close()
 
 def main():
     input_tif = './output_composite.tif'
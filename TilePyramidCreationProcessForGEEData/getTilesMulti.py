@@ -3,6 +3,8 @@ import os
 from osgeo import gdal
 from rasterio.coords import BoundingBox
 from global_grid2tiles import BaseTileGenerator,OverviewTileGenerator,save_matrix_as_png
+from palette_lut import PaletteLUT
+from mosaic_accumulator import MosaicAccumulator
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
@@ -41,34 +43,23 @@ config = {
         '69fff8', 'f9ffa4', '1c0dff'
     ]
 }
-# 将十六进制颜色转换为RGB元组
-def hex_to_rgb(hex_color):
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+# 调色板查找表, nodata(0)映射为透明
+palette_lut = PaletteLUT(config, nodata_value=0)
+# True时按调色板索引直接存为索引色png(更小, 编码更快); 自定义map_to_RGB时改为False
+indexed_png = True
 
 
 def map_to_RGB(data):
-    # 创建颜色映射
-    palette = [hex_to_rgb(color) for color in config['palette']]
+    # 整张瓦片一次性查表着色, 返回RGBA矩阵
+    return palette_lut(data)
 
-    # 获取图像的宽度和高度
-    width = len(data[0])
-    height = len(data)
 
-    # 创建一个新的图像
-    image = Image.new('RGB', (width, height))
-
-    # 将数据映射到颜色并填充图像
-    for y in range(height):
-        for x in range(width):
-            value = data[y][x]
-            # 将值映射到调色板索引
-            index = int((value - config['min']) / (config['max'] - config['min']) * (len(palette) - 1))
-            color = palette[index]
-            image.putpixel((x, y), color)
-            # print(f'{value}-----{color}')
-    return image
-
-def pyramidBuilding(input_dir,tmp_path,save_path,maxScale,bands=[1]):
+def pyramidBuilding(input_dir,tmp_path,save_path,maxScale,bands=[1],max_cached_tiles=1024):
+    """
+    max_cached_tiles: 内存中缓存的瓦片数量上限, 超出时最久未使用的瓦片暂存到tmp_path;
+                      所有tif处理完毕后每张瓦片只着色、保存一次png
+    """
+    mosaic = MosaicAccumulator(tmp_path, max_tiles=max_cached_tiles)
 
     # 使用 glob 匹配形如 modis_* 的文件
     modis_files = glob.glob(f'{input_dir}/*.tif')
@@ -84,21 +75,20 @@ def pyramidBuilding(input_dir,tmp_path,save_path,maxScale,bands=[1]):
         data3  = np.expand_dims(data, axis=0)
         for i in range(maxScale):
             basetileList = BaseTileGenerator(data3, geotransform, bbox, max_zoom=i, min_zoom=1, nodata_value=0, tile_size=256, xyz_flag=True, max_zoom_level=32)
-            myList = basetileList.generate_tiles()
-            for imagedict in myList:
-                outpath = f"{tmp_path}/{imagedict['current_index']}.npy"
-                outpathPGN = f"{save_path}/{imagedict['current_index']}.png"
-                if os.path.exists(outpath):
-                    existData = np.load(outpath)
-                    existData[existData==0] += imagedict['data'][existData==0]
-                else:
-                    existData = imagedict['data']
-                os.makedirs(os.path.dirname(outpath), exist_ok=True)
-                np.save(outpath,existData)
-                #这里改你的映射函数
-                savedData = map_to_RGB(existData)
-                #映射之后savedData需为3通道RGB矩阵
-                save_matrix_as_png(np.array(savedData),outpathPGN)
+            for imagedict in basetileList.iter_tiles():
+                # 多张tif的重叠瓦片在内存中合并, 先写入的非0像素保留
+                mosaic.add(imagedict['current_index'], imagedict['data'])
+
+    for current_index, existData in tqdm(mosaic.finalize(), total=len(mosaic), desc='save png'):
+        outpathPGN = f"{save_path}/{current_index}.png"
+        if indexed_png:
+            palette_lut.save_png(existData, outpathPGN)
+            continue
+        #这里改你的映射函数
+        savedData = map_to_RGB(existData)
+        #映射之后savedData需为3通道RGB或4通道RGBA矩阵
+        save_matrix_as_png(np.array(savedData),outpathPGN)
+    print(f"spilled {mosaic.spill_count} tiles, reloaded {mosaic.reload_count} tiles")
 def main():
     input_dir = './'
     tmp_path = './tiles_tmp'
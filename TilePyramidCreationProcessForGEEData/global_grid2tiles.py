@@ -13,7 +13,9 @@ class BaseTileGenerator:
         """
         Initialize the BaseTileGenerator.
 
-        :param data: Input data array with shape (raster_count, x_size, y_size).
+        :param data: Input data array with shape (raster_count, x_size, y_size), or a lazy source
+                     (e.g. raster_source.WindowedRasterSource) with the same shape and a
+                     read(x, y, width, height, buf_shape) method.
         :param geotransform: GDAL geotransform tuple.
         :param bbox: Bounding box of the data.
         :param max_zoom: Maximum zoom level. If None, it will be calculated based on the pixel size.
@@ -186,7 +188,14 @@ class BaseTileGenerator:
 
         :return: List of tiles.
         """
-        tile_list = []
+        return list(self.iter_tiles(return_part_data=return_part_data))
+
+    def iter_tiles(self,return_part_data=False):
+        """
+        Generate tiles for the given data one at a time, row by row in XYZ order.
+
+        :return: Generator of tiles.
+        """
         zoom_level = self.max_zoom
         query_size = self.tile_size
         delta_z = zoom_level - self.min_zoom
@@ -202,7 +211,11 @@ class BaseTileGenerator:
                     raster_x, raster_y, raster_width, raster_height = raster_bounds
                     window_x, window_y, window_width, window_height = window_bounds
                     
-                    sub_data = self.data[:, raster_y:raster_y + raster_height, raster_x:raster_x + raster_width]
+                    if isinstance(self.data, np.ndarray):
+                        sub_data = self.data[:, raster_y:raster_y + raster_height, raster_x:raster_x + raster_width]
+                    else:
+                        sub_data = self.data.read(raster_x, raster_y, raster_width, raster_height,
+                                                  buf_shape=(window_height, window_width))
 
                     target_data = np.zeros((sub_data.shape[0], self.tile_size, self.tile_size))
                     target_mask = np.zeros((self.tile_size, self.tile_size), dtype=bool)
@@ -216,7 +229,7 @@ class BaseTileGenerator:
                     #rgba_array = np.dstack((image_array, alpha_channel))
 
                     if return_part_data:
-                        tile_list.append({
+                        tile = {
                             'data': part_data,
                             'current_index': f'{zoom_level}/{tile_x}/{final_tile_y}',
                             'current_level': zoom_level,
@@ -226,19 +239,19 @@ class BaseTileGenerator:
                             'window_x':window_x,
                             'window_height':window_height,
                             'window_width':window_width
-                        })
+                        }
                     else:
-                        tile_list.append({
+                        tile = {
                             'data': image_array,
                             'current_index': f'{zoom_level}/{tile_x}/{final_tile_y}',
                             'current_level': zoom_level,
                             'min_index': f'{self.min_zoom}/{tile_x // (2**delta_z)}/{final_tile_y // (2**delta_z)}',
                             'min_level': self.min_zoom
-                        })
+                        }
                 except:
                     continue
-        
-        return tile_list
+                yield tile
+
 
 class OverviewTileGenerator:
     def __init__(self, tile_list, nodata_value=0, tile_size=256):
@@ -335,6 +348,46 @@ class OverviewTileGenerator:
         }
         return next_tile
     
+def build_overview_tiles(tile_iter, tile_size=256):
+    """
+    Build the parent level from a stream of child tiles by 2x2 downsampling.
+
+    Children must arrive row by row in XYZ order (tile y ascending), as
+    BaseTileGenerator.generate_tiles produces them, so a parent is complete and
+    emitted as soon as the stream moves past its second row of children. Parents
+    are emitted in the same row order, which lets calls be chained level by level
+    while only two rows of tiles per level are held in memory.
+
+    :param tile_iter: Iterable of child tiles with 'data' of shape (tile_size, tile_size, bands).
+    :param tile_size: Size of each tile.
+    :return: Generator of parent tiles in the same format.
+    """
+    pending = {}
+    current_row = None
+
+    def build(children):
+        # OverviewTileGenerator works on (bands, height, width)
+        children = [dict(tile, data=np.transpose(tile['data'], (2, 0, 1))) for tile in children]
+        next_tile = OverviewTileGenerator(children, tile_size=tile_size).generate_next_tiles()
+        next_tile['data'] = np.transpose(next_tile['data'], (1, 2, 0))
+        return next_tile
+
+    for tile in tile_iter:
+        zoom_level, tile_x, tile_y = parse_index(tile['current_index'])
+        parent_y = tile_y // 2
+        if parent_y != current_row:
+            # the stream moved past this row of parents, all their children are in
+            for children in pending.values():
+                yield build(children)
+            pending = {}
+            current_row = parent_y
+
+        parent_index = f'{zoom_level - 1}/{tile_x // 2}/{parent_y}'
+        pending.setdefault(parent_index, []).append(dict(tile, min_index=parent_index, min_level=zoom_level - 1))
+
+    for children in pending.values():
+        yield build(children)
+
 def alter_min_index(result,min_level):
     """
         result: {
@@ -405,13 +458,34 @@ def scale_to_uint8(band_data, min_val, max_val):
     return np.interp(band_data, (min_val, max_val), (0, 255)).astype(np.uint8)
 
       
-def save_matrix_as_png(rgba_array, output_path):
+def save_matrix_as_png(rgba_array, output_path, compress_level=6):
     """
     Save the given RGBA array as a PNG image.
 
     :param rgba_array: RGBA array.
     :param output_path: Output file path.
+    :param compress_level: zlib compression level 0-9, lower is faster and larger.
     """
     image = Image.fromarray(rgba_array.astype(np.uint8))
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    image.save(output_path)
\ No newline at end of file
+    image.save(output_path, compress_level=compress_level)
+
+
+def save_indexed_png(index_array, palette, output_path, transparency=None, compress_level=6):
+    """
+    Save a palette index array as an indexed (mode 'P') PNG with an optional tRNS entry.
+    Much smaller and faster to encode than the equivalent RGBA PNG for palette-coloured tiles.
+
+    :param index_array: uint8 array of palette indices with shape (height, width).
+    :param palette: uint8 array of RGB colours with shape (N, 3), N <= 256.
+    :param output_path: Output file path.
+    :param transparency: Palette index rendered fully transparent, or None.
+    :param compress_level: zlib compression level 0-9, lower is faster and larger.
+    """
+    image = Image.fromarray(np.ascontiguousarray(index_array, dtype=np.uint8), mode='L')
+    image.putpalette(np.ascontiguousarray(palette, dtype=np.uint8).tobytes())
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if transparency is None:
+        image.save(output_path, compress_level=compress_level)
+    else:
+        image.save(output_path, compress_level=compress_level, transparency=transparency)
\ No newline at end of file
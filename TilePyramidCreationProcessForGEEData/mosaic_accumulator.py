@@ -0,0 +1,87 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class MosaicAccumulator:
+    '''
+    In-memory mosaic of tiles contributed by several scenes.
+
+    Contributions are merged the same way getTilesMulti always did: pixels that
+    are still 0 (nodata) are filled by later scenes, pixels already set keep the
+    value of the first scene. Dirty tiles stay in a bounded LRU dictionary and are
+    only written to tmp_path as .npy when evicted; an evicted tile is loaded back
+    if another scene touches it. Each tile is rendered exactly once by finalize().
+    '''
+    def __init__(self, tmp_path, max_tiles=1024):
+        """
+        Initialize the MosaicAccumulator.
+
+        :param tmp_path: Directory for tiles spilled on eviction, as {current_index}.npy.
+        :param max_tiles: Maximum number of tiles kept in memory.
+        """
+        self.tmp_path = tmp_path
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.spilled = set()
+        self.spill_count = 0
+        self.reload_count = 0
+
+    def _spill_file(self, current_index):
+        return f"{self.tmp_path}/{current_index}.npy"
+
+    def _load_spilled(self, current_index):
+        self.reload_count += 1
+        self.spilled.discard(current_index)
+        spill_file = self._spill_file(current_index)
+        data = np.load(spill_file)
+        # The tile is back in memory; a later eviction writes a fresh file
+        os.remove(spill_file)
+        return data
+
+    def _evict(self):
+        current_index, data = self.tiles.popitem(last=False)
+        outpath = self._spill_file(current_index)
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        np.save(outpath, data)
+        self.spilled.add(current_index)
+        self.spill_count += 1
+
+    def add(self, current_index, data):
+        """
+        Merge one scene's contribution into a tile.
+
+        :param current_index: Tile index 'z/x/y'.
+        :param data: Tile data array.
+        """
+        if current_index in self.tiles:
+            exist_data = self.tiles[current_index]
+            self.tiles.move_to_end(current_index)
+        elif current_index in self.spilled:
+            exist_data = self._load_spilled(current_index)
+            self.tiles[current_index] = exist_data
+        else:
+            self.tiles[current_index] = data.copy()
+            exist_data = None
+
+        if exist_data is not None:
+            mask = exist_data == 0
+            exist_data[mask] = data[mask]
+
+        while len(self.tiles) > self.max_tiles:
+            self._evict()
+
+    def __len__(self):
+        return len(self.tiles) + len(self.spilled)
+
+    def finalize(self):
+        """
+        Yield every merged tile once, spilled tiles included, and empty the accumulator.
+
+        :return: Generator of (current_index, data).
+        """
+        while self.tiles:
+            yield self.tiles.popitem(last=False)
+        for current_index in sorted(self.spilled):
+            yield current_index, self._load_spilled(current_index)
@@ -0,0 +1,155 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+
+class WindowedRasterSource:
+    '''
+    Lazy raster source for BaseTileGenerator.
+
+    Exposes the same (raster_count, y_size, x_size) shape as an in-memory data
+    array, but only reads the source window each tile asks for. Full-resolution
+    windows are assembled from a bounded LRU cache of square blocks; windows that
+    are shrunk to tile size (low zoom levels) are read decimated straight from the
+    file, so they never materialise the full-resolution window (the driver samples
+    pixel centres, which can pick a neighbouring source pixel compared with the
+    scipy nearest-neighbour zoom used for in-memory arrays).
+    '''
+    def __init__(self, path, bands=(1,), block_size=512, max_blocks=None):
+        """
+        Initialize the WindowedRasterSource.
+
+        :param path: Path of the raster file.
+        :param bands: 1-based band indexes to read.
+        :param block_size: Edge length of the cached blocks in pixels.
+        :param max_blocks: Maximum number of cached blocks. If None, two rows of blocks
+                           across the raster width are kept, which is what a row-by-row
+                           tile scan reuses.
+        """
+        self.dataset = rasterio.open(path)
+        self.bands = list(bands)
+        self.shape = (len(self.bands), self.dataset.height, self.dataset.width)
+        self.dtype = np.dtype(self.dataset.dtypes[self.bands[0] - 1])
+        self.geotransform = self.dataset.transform.to_gdal()
+
+        self.block_size = block_size
+        if max_blocks is None:
+            max_blocks = 2 * math.ceil(self.dataset.width / block_size)
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+
+    def _read_block(self, block_row, block_col):
+        """
+        Return a cached block, reading it from the file on a miss.
+
+        :param block_row: Block row index.
+        :param block_col: Block column index.
+        :return: Block array with shape (raster_count, rows, cols).
+        """
+        key = (block_row, block_col)
+        block = self._blocks.get(key)
+        if block is not None:
+            self._blocks.move_to_end(key)
+            return block
+
+        x = block_col * self.block_size
+        y = block_row * self.block_size
+        window = Window(x, y, min(self.block_size, self.shape[2] - x), min(self.block_size, self.shape[1] - y))
+        block = self.dataset.read(self.bands, window=window)
+        self._blocks[key] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def read(self, x, y, width, height, buf_shape=None):
+        """
+        Read a source window.
+
+        :param x: Window column offset.
+        :param y: Window row offset.
+        :param width: Window width.
+        :param height: Window height.
+        :param buf_shape: Optional (height, width) the window will be resampled to. When it is
+                          smaller than the window, the read is decimated by the driver.
+        :return: Array with shape (raster_count, rows, cols).
+        """
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Empty window: {(x, y, width, height)}")
+
+        if buf_shape is not None and (buf_shape[0] < height or buf_shape[1] < width):
+            return self.dataset.read(self.bands, window=Window(x, y, width, height),
+                                     out_shape=(len(self.bands), buf_shape[0], buf_shape[1]),
+                                     resampling=Resampling.nearest)
+
+        out = np.empty((len(self.bands), height, width), dtype=self.dtype)
+        size = self.block_size
+        for block_row in range(y // size, (y + height - 1) // size + 1):
+            for block_col in range(x // size, (x + width - 1) // size + 1):
+                block = self._read_block(block_row, block_col)
+                # intersection of the block and the window, in raster coordinates
+                row0, row1 = max(y, block_row * size), min(y + height, block_row * size + block.shape[1])
+                col0, col1 = max(x, block_col * size), min(x + width, block_col * size + block.shape[2])
+                out[:, row0 - y:row1 - y, col0 - x:col1 - x] = \
+                    block[:, row0 - block_row * size:row1 - block_row * size, col0 - block_col * size:col1 - block_col * size]
+        return out
+
+    def close(self):
+        self._blocks.clear()
+        self.dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    # Memory benchmark: peak Python/NumPy allocations while cutting one zoom level
+    # from an in-memory array versus from the windowed source.
+    import os
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+    from rasterio.transform import Affine
+    from global_grid2tiles import BaseTileGenerator
+    from tile_config import GlobalMercator
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8192
+    zoom_level = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    resolution = GlobalMercator().Resolution(zoom_level + 2)
+    transform = Affine(resolution, 0, -size * resolution / 2, 0, -resolution, size * resolution / 2)
+
+    tif_file = os.path.join(tempfile.mkdtemp(), 'synthetic.tif')
+    with rasterio.open(tif_file, 'w', driver='GTiff', width=size, height=size, count=1, dtype='int16',
+                       crs='epsg:3857', transform=transform, tiled=True, blockxsize=512, blockysize=512) as dst:
+        rng = np.random.default_rng(0)
+        for row in range(0, size, 512):
+            rows = min(512, size - row)
+            dst.write(rng.integers(1, 18, (1, rows, size), dtype=np.int16), window=Window(0, row, size, rows))
+
+    def run(lazy):
+        tracemalloc.start()
+        start = time.perf_counter()
+        with rasterio.Env(GDAL_CACHEMAX=16):
+            if lazy:
+                source = WindowedRasterSource(tif_file)
+                data, geotransform = source, source.geotransform
+            else:
+                with rasterio.open(tif_file) as src:
+                    data, geotransform = src.read(), src.transform.to_gdal()
+            generator = BaseTileGenerator(data, geotransform, None, max_zoom=zoom_level, min_zoom=zoom_level - 1)
+            count = sum(1 for _ in generator.iter_tiles())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return count, peak, time.perf_counter() - start
+
+    for lazy in (False, True):
+        count, peak, elapsed = run(lazy)
+        print(f"{'windowed' if lazy else 'in-memory':9s}: {count} tiles, peak {peak / 2**20:8.1f} MiB, {elapsed:6.1f} s "
+              f"(raster {size}x{size} int16 = {size * size * 2 / 2**20:.0f} MiB)")
@@ -0,0 +1,314 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rasterio.coords import BoundingBox
+from rasterio.warp import transform_bounds
+from aster_core.global_grid import GlobalRasterGrid
+from aster_core.utils import bbox2bbox
+from utils import get_bbox_from_geotiff, extract_x_y_from_filename, save_json
+from Regenerate_png import bbox_tile_range
+from Level_Store import LevelStore, list_level_stores
+from Tile_Archive import open_tile_archive
+from Run_Manifest import RunManifest
+
+
+def pack_keys(index_x, index_y):
+    '''
+    (x, y) --> x << 32 | y 的uint64数组, 集合运算(np.setdiff1d等)直接在整数数组上进行
+    '''
+    return (np.asarray(index_x, dtype=np.uint64) << np.uint64(32)) | np.asarray(index_y, dtype=np.uint64)
+
+
+def unpack_keys(keys):
+    keys = np.asarray(keys, dtype=np.uint64)
+    return (keys >> np.uint64(32)).astype(np.int64), (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+
+def sorted_unique(arrays):
+    '''
+    合并多个packed keys数组, 排序去重; 对uint64比np.unique快得多
+    '''
+    keys = np.sort(np.concatenate(arrays)) if len(arrays) else np.empty(0, dtype=np.uint64)
+    if len(keys) < 2:
+        return keys
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+
+def tiff_footprints(tiff_dir, file_list, src_crs='epsg:4326'):
+    '''
+    各源文件的经纬度范围
+
+    Returns:
+        {文件名: (min_lon, min_lat, max_lon, max_lat)}, 读取失败的文件记录日志后跳过
+    '''
+    footprints = {}
+    for fn in file_list:
+        try:
+            bbox = get_bbox_from_geotiff(os.path.join(tiff_dir, fn))
+            footprints[fn] = transform_bounds(src_crs, 'epsg:4326', *bbox) if src_crs != 'epsg:4326' else tuple(bbox)
+        except Exception as E:
+            logging.error(f"{fn} footprint failed: {E}")
+    return footprints
+
+
+def _range_keys(tile_range):
+    x_min, y_min, x_max, y_max = tile_range
+    index_x, index_y = np.meshgrid(np.arange(x_min, x_max + 1), np.arange(y_min, y_max + 1), indexing='ij')
+    return pack_keys(index_x.ravel(), index_y.ravel())
+
+
+def ingested_tiles(run_manifest_file):
+    '''
+    运行清单(Run_Manifest)中已切片的文件及其登记的瓦片碎片; 碎片只为有数据的瓦片生成,
+    即最大等级实际应有的瓦片, 不含范围内全为nodata的瓦片(如海洋)
+
+    Returns:
+        (max_zoom, 碎片瓦片的packed keys, 已切片的文件set), 没有运行清单或清单中没有碎片时返回None
+    '''
+    if not os.path.exists(run_manifest_file):
+        return None
+    with RunManifest(run_manifest_file, resume=True) as run_manifest:
+        fragments = [fragment for event in run_manifest.events if event['stage'] == 'ingest'
+                     for fragment in event['fragments']]
+        done_files = run_manifest.done_files()
+    if not fragments:
+        return None
+    max_zoom = fragments[0][0]
+    keys = sorted_unique([pack_keys([f[1] for f in fragments], [f[2] for f in fragments])])
+    return max_zoom, keys, done_files
+
+
+def expected_tiles(footprints, zoom_level, ingested=None):
+    '''
+    zoom_level应有的瓦片。源文件范围覆盖的瓦片(由GlobalMercator换算, 各文件的并集)只作为上界:
+    传入ingested(ingested_tiles的结果)时, 为已切片文件的碎片瓦片(及其上级瓦片), 加上未切片文件的整个范围
+
+    Returns:
+        排序去重后的packed keys
+    '''
+    keys = sorted_unique([_range_keys(bbox_tile_range(bbox, zoom_level)) for bbox in footprints.values()])
+    if ingested is None:
+        return keys
+    max_zoom, data_keys, done_files = ingested
+    index_x, index_y = unpack_keys(data_keys)
+    shift = max_zoom - zoom_level
+    data_keys = [pack_keys(index_x >> shift, index_y >> shift)]
+    # 未切片(失败或未运行)的文件不知道哪些瓦片有数据, 只能按整个范围检查
+    data_keys.extend(_range_keys(bbox_tile_range(bbox, zoom_level)) for fn, bbox in footprints.items()
+                     if fn not in done_files)
+    return np.intersect1d(sorted_unique(data_keys), keys, assume_unique=True)
+
+
+def _scan_column(args):
+    # 一个x目录下的瓦片文件及其中的0字节文件
+    x_dir, index_x, extensions = args
+    index_y, zero_byte = [], []
+    try:
+        entries = list(os.scandir(x_dir))
+    except FileNotFoundError:
+        return index_x, index_y, zero_byte
+    for entry in entries:
+        name, ext = os.path.splitext(entry.name)
+        if ext in extensions and name.isdigit():
+            index_y.append(int(name))
+            if entry.stat().st_size == 0:
+                zero_byte.append(int(name))
+    return index_x, index_y, zero_byte
+
+
+def scan_tile_dir(tile_dir, zoom_levels, extensions, executor):
+    '''
+    多线程扫描 tile_dir/{z}/{x}/{y}.ext 目录
+
+    Returns:
+        {zoom_level: (packed keys, 0字节文件的packed keys)}
+    '''
+    tasks = []
+    for zoom_level in zoom_levels:
+        level_dir = os.path.join(tile_dir, str(zoom_level))
+        if os.path.isdir(level_dir):
+            tasks.extend((zoom_level, (entry.path, int(entry.name), extensions)) for entry in os.scandir(level_dir)
+                         if entry.is_dir() and entry.name.isdigit())
+    columns = {zoom_level: ([], []) for zoom_level in zoom_levels}
+    for (zoom_level, _), (index_x, index_y, zero_byte) in zip(tasks, executor.map(_scan_column, [t[1] for t in tasks])):
+        columns[zoom_level][0].append(pack_keys(np.full(len(index_y), index_x), index_y))
+        columns[zoom_level][1].append(pack_keys(np.full(len(zero_byte), index_x), zero_byte))
+    return {zoom_level: (sorted_unique(keys), sorted_unique(zeros)) for zoom_level, (keys, zeros) in columns.items()}
+
+
+def _compare(expected, existing, zero_byte=None):
+    missing = np.setdiff1d(expected, existing, assume_unique=True)
+    extra = np.setdiff1d(existing, expected, assume_unique=True)
+    result = {'tiles': int(len(existing)), 'missing': int(len(missing)), 'extra': int(len(extra))}
+    if zero_byte is not None:
+        result['zero_byte'] = int(len(zero_byte))
+    return result, missing
+
+
+def _is_empty(args):
+    # 全透明瓦片(alpha全为0), TileWriter不为其生成png
+    npy_file, store, index_x, index_y = args
+    try:
+        tile_data = store.read(index_x, index_y) if store is not None else np.load(npy_file, mmap_mode='r')
+        return tile_data is not None and not tile_data[:, :, -1].any()
+    except Exception as E:
+        logging.error(f"{npy_file} read failed: {E}")
+        return False
+
+
+def empty_tiles(keys, data_dir, zoom_level, executor, store=None):
+    '''
+    keys中的全透明瓦片, 只读取给定的瓦片(一般只是有数据但没有png的少数瓦片)
+
+    Returns:
+        全透明瓦片的packed keys
+    '''
+    index_x, index_y = unpack_keys(keys)
+    tasks = [(os.path.join(data_dir, 'NPY', str(zoom_level), str(x), f'{y}.npy'), store, x, y)
+             for x, y in zip(index_x.tolist(), index_y.tolist())]
+    return keys[np.fromiter(executor.map(_is_empty, tasks), dtype=bool, count=len(tasks))]
+
+
+def audit_coverage(data_dir, footprints, zoom_levels, store_dir=None, archive_file=None, num_workers=8,
+                   resolution=None, tile_size=None):
+    '''
+    对比各等级应有的瓦片与已生成的瓦片, 统计缺失、多余和0字节的瓦片数。
+    瓦片集合为x << 32 | y的uint64数组, 用np.setdiff1d比较, 数百万瓦片也只需几秒;
+    目录扫描按x目录多线程进行。
+    应有的瓦片由<data_dir>/run_manifest.jsonl中登记的碎片得到(expected_tiles), 范围内本来全为nodata的瓦片(如海洋)
+    不计入missing, 源文件范围只作为上界; 没有运行清单时退回到源文件范围, 此时这些瓦片也会计入missing;
+    TileWriter不为全透明瓦片生成png, 这些瓦片(empty)不计入PNG的missing和unrendered,
+    只需读取有NPY但没有png的瓦片判断; unrendered为有数据但没有png的瓦片, 不受范围内nodata的影响
+
+    Args:
+        data_dir: process_tiff的输出主目录, 扫描其中的NPY和PNG目录
+        footprints: 源文件范围, tiff_footprints生成
+        zoom_levels: 需要检查的等级list
+        store_dir: 可选, Level_Store的存储目录, 代替NPY目录
+        archive_file: 可选, 瓦片包(.mbtiles或.pak), 代替PNG目录
+        num_workers: 扫描目录的线程数
+        resolution: 可选, 栅格分辨率, 与tile_size一起传入时同时检查TILES目录的栅格(GlobalRasterGrid)
+        tile_size: 可选, 栅格尺寸
+
+    Returns:
+        report: {zoom_level: {'expected', 'npy': {...}, 'png': {...}, 'empty', 'unrendered'}}, 栅格的结果在report['grid'],
+                应有瓦片的来源('run_manifest'或'bbox')在report['expected_from'], 未切片的文件在report['not_ingested']
+        missing: {(zoom_level, 'npy'/'png'): 缺失瓦片的packed keys}
+    '''
+    report, missing = {}, {}
+    ingested = ingested_tiles(os.path.join(data_dir, 'run_manifest.jsonl'))
+    report['expected_from'] = 'bbox' if ingested is None else 'run_manifest'
+    if ingested is not None:
+        report['not_ingested'] = sorted(fn for fn in footprints if fn not in ingested[2])
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        stores = {}
+        if store_dir is not None:
+            stored = set(list_level_stores(store_dir))
+            npy_tiles = {}
+            for zoom_level in zoom_levels:
+                stores[zoom_level] = LevelStore(store_dir, zoom_level, mode='r') if zoom_level in stored else None
+                keys = stores[zoom_level].keys() if stores[zoom_level] is not None else []
+                npy_tiles[zoom_level] = (sorted_unique([pack_keys([k[0] for k in keys], [k[1] for k in keys])]), None)
+        else:
+            npy_tiles = scan_tile_dir(os.path.join(data_dir, 'NPY'), zoom_levels, ('.npy',), executor)
+        if archive_file is not None:
+            with open_tile_archive(archive_file) as reader:
+                tiles = np.array(list(reader.tiles()), dtype=np.int64).reshape(-1, 3)
+            png_tiles = {zoom_level: (sorted_unique([pack_keys(tiles[tiles[:, 0] == zoom_level, 1],
+                                                               tiles[tiles[:, 0] == zoom_level, 2])]), None)
+                         for zoom_level in zoom_levels}
+        else:
+            png_tiles = scan_tile_dir(os.path.join(data_dir, 'PNG'), zoom_levels, ('.png', '.webp'), executor)
+
+        for zoom_level in zoom_levels:
+            if ingested is not None and zoom_level > ingested[0]:
+                logging.warning(f"Zoom-{zoom_level} is above the ingested zoom-{ingested[0]}, skipped")
+                continue
+            expected = expected_tiles(footprints, zoom_level, ingested)
+            level_report = {'expected': int(len(expected))}
+            level_report['npy'], missing[(zoom_level, 'npy')] = _compare(expected, *npy_tiles[zoom_level])
+            without_png = np.setdiff1d(npy_tiles[zoom_level][0], png_tiles[zoom_level][0], assume_unique=True)
+            empty = empty_tiles(without_png, data_dir, zoom_level, executor, store=stores.get(zoom_level))
+            # 全透明瓦片本来就没有png
+            level_report['png'], missing[(zoom_level, 'png')] = _compare(np.setdiff1d(expected, empty, assume_unique=True),
+                                                                         *png_tiles[zoom_level])
+            level_report['empty'] = int(len(empty))
+            level_report['unrendered'] = int(len(without_png) - len(empty))
+            report[zoom_level] = level_report
+            logging.info(f"Zoom-{zoom_level} coverage: {level_report}")
+
+    if resolution is not None and tile_size is not None:
+        report['grid'] = audit_grid_tiles(os.path.join(data_dir, 'TILES'), footprints, resolution, tile_size)
+    return report, missing
+
+
+def audit_grid_tiles(tiles_dir, footprints, resolution, tile_size):
+    '''
+    检查tiff2tiles生成的栅格(TILES目录), README已知风险中全球TIFF栅格数量不足的问题可由此发现
+
+    Returns:
+        {'expected', 'tiles', 'missing', 'extra', 'zero_byte'}
+    '''
+    global_grid = GlobalRasterGrid(resolution=resolution, tile_size=tile_size)
+    expected = []
+    for bbox in footprints.values():
+        # 与tiff2tiles相同的换算方式
+        tile_index_list = global_grid.get_tile_list(bbox2bbox(BoundingBox(*bbox), 'epsg:4326', 'epsg:3857'))
+        expected.append(pack_keys([index[0] for index in tile_index_list], [index[1] for index in tile_index_list]))
+    expected = sorted_unique(expected)
+
+    existing, zero_byte = [], []
+    prefix = f"res-{resolution}_tilesize-{tile_size}_"
+    if os.path.isdir(tiles_dir):
+        for entry in os.scandir(tiles_dir):
+            index = extract_x_y_from_filename(entry.name) if entry.name.startswith(prefix) else None
+            if index is not None:
+                existing.append(index)
+                if entry.stat().st_size == 0:
+                    zero_byte.append(index)
+    existing = sorted_unique([pack_keys([i[0] for i in existing], [i[1] for i in existing])])
+    result, _ = _compare(expected, existing, zero_byte)
+    result['expected'] = int(len(expected))
+    return result
+
+
+def files_covering(missing_keys, zoom_level, footprints):
+    '''
+    范围内有缺失瓦片的源文件, 只需对这些文件重新运行; missing_keys应来自由运行清单得到的应有瓦片,
+    否则范围内的nodata瓦片也会把文件计入
+
+    Returns:
+        文件名list
+    '''
+    index_x, index_y = unpack_keys(missing_keys)
+    files = []
+    for fn, bbox in footprints.items():
+        x_min, y_min, x_max, y_max = bbox_tile_range(bbox, zoom_level)
+        if np.any((index_x >= x_min) & (index_x <= x_max) & (index_y >= y_min) & (index_y <= y_max)):
+            files.append(fn)
+    return files
+
+
+if __name__ == '__main__':
+    # TIFF 文件存放文件夹和数据列表 (与主程序一致)
+    tiff_dir = '/home/data2/ASTWBD_TIFF'
+    data_list_file = "Data/ASTWBD.txt"
+    with open(data_list_file, 'r', encoding='utf-8') as f:
+        fn_list = [fn.strip().replace('.zip', '_dem.tif') for fn in f.readlines()]
+    # 主程序的输出目录
+    data_dir = '/home/data2/ASTGTM_tiny'
+    max_zoom = 12
+    resolution, tile_size = 30, 1024
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    footprints = tiff_footprints(tiff_dir, fn_list, src_crs='epsg:4326')
+    report, missing = audit_coverage(data_dir, footprints, list(range(max_zoom, 0, -1)), resolution=resolution,
+                                     tile_size=tile_size)
+    rerun_files = files_covering(missing[(max_zoom, 'npy')], max_zoom, footprints)
+    report['rerun_files'] = rerun_files
+    save_json({str(key): value for key, value in report.items()}, os.path.join(data_dir, 'coverage_audit.json'))
+    for zoom_level in range(max_zoom, 0, -1):
+        print(f"zoom-{zoom_level}: {report[zoom_level]}")
+    print(f"grid: {report['grid']}")
+    print(f"{len(rerun_files)} files cover missing zoom-{max_zoom} tiles")
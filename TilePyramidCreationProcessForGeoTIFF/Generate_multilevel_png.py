@@ -1,38 +1,220 @@
-from aster_core.global_grid2tiles import OverviewTileGenerator
-import os
-from utils import save_json
-import numpy as np
-
-def generate_multilevel_png(data_dir, base_tile_index_list):
-    '''
-    生成下一级瓦片
-    Args:
-        data_dir: 数据目录
-        base_tile_index_list: 上一级瓦片信息字典
-
-    Returns:
-        merged_base_tile_list: 下一级瓦片信息字典
-
-    '''
-    npy_dir = os.path.join(data_dir, 'NPY')
-    merged_base_tile_index_list = []
-    next_tile_dict = {}
-    for base_tile_dict in base_tile_index_list:
-        for key, value in base_tile_dict.items():
-            next_tile_index = f'{value["min_index"]}'
-            if next_tile_index in merged_base_tile_index_list:
-                next_tile_dict[next_tile_index].append(value)
-            else:
-                merged_base_tile_index_list.append(next_tile_index)
-                next_tile_dict[next_tile_index] = []
-                next_tile_dict[next_tile_index].append(value)
-    merged_base_tile_list = []
-    for key, value in next_tile_dict.items():
-        merged_base_tile_dict = {}
-        _OverviewTileGenerator = OverviewTileGenerator(value)
-        merged_base_tile_dict[key] = _OverviewTileGenerator.generate_next_tiles(data_dir_flag=True, save_dir=npy_dir)
-        merged_base_tile_list.append(merged_base_tile_dict)
-    current_level = list(merged_base_tile_list[0].values())[0]['current_level']
-    json_file_name = f"merged_base_tile_index_list_zoom-{current_level}.json"
-    save_json(merged_base_tile_list, os.path.join(data_dir, json_file_name))
-    return merged_base_tile_list
\ No newline at end of file
+from aster_core.global_grid2tiles import OverviewTileGenerator
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from tqdm import tqdm
+from Tile_Registry import TileRegistry, TileRecord, registry_file, parent_key
+from Level_Store import LevelStore, load_tile
+from Tile_Renderer import TileWriter
+from Tile_Archive import TileCollector
+from scipy.ndimage import zoom
+import numpy as np
+
+# 子进程中的瓦片写入器(Tile_Renderer.TileWriter), 由_init_worker设置
+_writer = None
+
+
+def _init_worker(renderer, png_dir):
+    global _writer
+    _writer = TileWriter(renderer, png_dir)
+
+
+def _build_parent_tile(args):
+    '''
+    由子瓦片生成一个上一级瓦片并存储为npy, 若进程设置了写入器则同时生成png;
+    只返回index、文件路径和png的写入方式('rendered'/'empty'/'uniform'), 瓦片数据不回传主进程;
+    collect=True时png不写文件, 编码后的瓦片回传主进程写入瓦片包
+    '''
+    key, child_dicts, npy_dir, png_dir, collect = args
+    _OverviewTileGenerator = OverviewTileGenerator(child_dicts)
+    next_tile = _OverviewTileGenerator.generate_next_tiles(data_dir_flag=True, save_dir=npy_dir)
+    png_file = kind = None
+    sink = TileCollector() if collect else None
+    if _writer is not None:
+        tile_data = next_tile.get('data')
+        if tile_data is None:
+            tile_data = np.load(next_tile['data_dir'])
+        z, x, y = key
+        kind = _writer.classify(tile_data) or 'rendered'
+        if sink is not None:
+            _writer.put(sink, z, x, y, tile_data)
+        else:
+            png_file = _writer.write(tile_data, os.path.join(png_dir, str(z), str(x), f'{y}.{_writer.renderer.extension}'))
+    return key, next_tile['data_dir'], png_file, kind, sink.tiles if sink is not None else None
+
+
+def overview_tile_data(key, children):
+    '''
+    由子瓦片拼接2x2的镶嵌矩阵, 再最近邻重采样为一个瓦片, 与OverviewTileGenerator的重采样方式(zoom, order=0)一致
+
+    Args:
+        key: 上一级瓦片的(z, x, y)
+        children: 子瓦片信息(TileRecord)的list
+
+    Returns:
+        瓦片数据, shape为(height, width, channel + 1)
+    '''
+    _, x, y = key
+    mosaic = None
+    for child in children:
+        child_data = load_tile(child)
+        height, width = child_data.shape[:2]
+        if mosaic is None:
+            mosaic = np.zeros((2 * height, 2 * width, child_data.shape[2]), dtype=child_data.dtype)
+        row, col = (child.y - 2 * y) * height, (child.x - 2 * x) * width
+        mosaic[row:row + height, col:col + width] = child_data
+    return zoom(mosaic, (0.5, 0.5, 1), order=0)
+
+
+def generate_multilevel_png(data_dir, registry, num_workers=1, store_dir=None):
+    '''
+    生成下一级瓦片
+    Args:
+        data_dir: 数据目录
+        registry: 上一级瓦片注册表
+        num_workers: 进程数, 大于1时同一级的各瓦片并行生成
+        store_dir: 可选, Level_Store的存储目录, 传入时下一级瓦片写入zoom-{z}.dat, 不再生成npy文件;
+                   存储只能单进程写入, 此时忽略num_workers
+
+    Returns:
+        next_registry: 下一级瓦片注册表, 同时存储为tile_registry_zoom-{z}.npz
+
+    '''
+    npy_dir = os.path.join(data_dir, 'NPY')
+    if store_dir is not None:
+        next_registry = TileRegistry()
+        groups = registry.group_by_parent()
+        with LevelStore(store_dir, next(iter(groups))[0], mode='w') as store:
+            for key, children in groups.items():
+                store.write(key[1], key[2], overview_tile_data(key, children))
+                next_registry.add(TileRecord(*key, data_dir=store.path))
+        next_registry.save(registry_file(data_dir, store.zoom_level))
+        return next_registry
+
+    tasks = [(key, [child.to_dict() for child in children], npy_dir, None, False)
+             for key, children in registry.group_by_parent().items()]
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_build_parent_tile, tasks, chunksize=max(1, len(tasks) // (num_workers * 4))))
+    else:
+        results = map(_build_parent_tile, tasks)
+
+    next_registry = TileRegistry()
+    for key, next_data_dir, _, _, _ in results:
+        next_registry.add(TileRecord(*key, data_dir=next_data_dir))
+    current_level = next(iter(next_registry)).current_level
+    next_registry.save(registry_file(data_dir, current_level))
+    return next_registry
+
+
+def build_overview_levels(data_dir, registry, renderer, num_workers=8, min_zoom=1, publisher=None, run_manifest=None,
+                          tile_sink=None):
+    '''
+    多进程生成registry以上的所有等级瓦片(直到min_zoom)并渲染png, 与逐级调用
+    generate_multilevel_png + npy2png 的结果一致。
+    各级需要生成的瓦片由index推出, 一个瓦片的子瓦片全部完成后立即提交, 不必等整级结束,
+    因此z级瓦片的png编码与z-1级的生成重叠进行; 子进程只回传index和文件路径
+
+    Args:
+        data_dir: 数据目录
+        registry: 最大等级的瓦片注册表(merge_tiles生成)
+        renderer: Tile_Renderer.TileRenderer, 在各子进程初始化时传入
+        num_workers: 进程数
+        min_zoom: 生成到的最小等级
+        publisher: 可选, 每生成一个png在主进程调用publisher(png_file), 如bulk_upload.TilePublisher
+        run_manifest: 可选, Run_Manifest.RunManifest, 一级瓦片全部成功生成且子瓦片完整(下级的失败向上传递)后记录该等级
+        tile_sink: 可选, 瓦片包(Tile_Archive.open_tile_sink), 传入时子进程回传编码后的瓦片, 由主进程写入瓦片包,
+                   不再生成单独的png文件
+
+    Returns:
+        registries: {zoom_level: TileRegistry}, 每级同时存储为tile_registry_zoom-{z}.npz;
+        全透明瓦片不生成png, 单一颜色瓦片共用一个png (Tile_Renderer.TileWriter), 各级计数写入日志
+    '''
+    npy_dir = os.path.join(data_dir, 'NPY')
+    png_dir = os.path.join(data_dir, 'PNG')
+
+    # 由index推出各级的瓦片及其子瓦片, 顺序与逐级生成一致
+    built = {record.key: record for record in registry}
+    children_of = {}
+    level_keys = {}
+    keys = list(built)
+    while keys and keys[0][0] - 1 >= min_zoom:
+        groups = {}
+        for key in keys:
+            groups.setdefault(parent_key(key), []).append(key)
+        children_of.update(groups)
+        keys = list(groups)
+        level_keys[keys[0][0]] = keys
+    pending = {key: len(children) for key, children in children_of.items()}
+    remaining = {z: len(keys) for z, keys in level_keys.items()}
+    registries = {}
+    futures = {}
+    counts = {z: {'rendered': 0, 'empty': 0, 'uniform': 0} for z in level_keys}
+    failed = {z: 0 for z in level_keys}
+    # 生成失败或由不完整的子瓦片生成的瓦片, 其祖先瓦片也不完整
+    incomplete = set()
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(renderer, png_dir)) as executor, \
+            tqdm(total=len(children_of), desc="Overview tiles") as progress:
+
+        def submit(key):
+            if any(child in incomplete for child in children_of[key]):
+                incomplete.add(key)
+            child_dicts = [built[child].to_dict() for child in children_of[key] if child in built]
+            if child_dicts:
+                futures[executor.submit(_build_parent_tile, (key, child_dicts, npy_dir, png_dir,
+                                                             tile_sink is not None))] = key
+            else:
+                # 子瓦片全部失败, 跳过该瓦片
+                finish(key, None)
+
+        def finish(key, record):
+            progress.update(1)
+            z = key[0]
+            if record is not None:
+                built[key] = record
+            else:
+                incomplete.add(key)
+            if key in incomplete:
+                failed[z] += 1
+            remaining[z] -= 1
+            if remaining[z] == 0:
+                registries[z] = TileRegistry([built[k] for k in level_keys[z] if k in built])
+                if len(registries[z]):
+                    registries[z].save(registry_file(data_dir, z))
+                logging.info(f"Zoom-{z} tiles: {counts[z]}")
+                if run_manifest is not None and failed[z] == 0:
+                    if tile_sink is not None:
+                        tile_sink.flush()
+                    run_manifest.record('level', zoom=z)
+            parent = parent_key(key)
+            if parent in pending:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    submit(parent)
+
+        # 最大等级的瓦片已经存在, 其上一级瓦片可以全部提交
+        if level_keys:
+            for key in level_keys[max(level_keys)]:
+                submit(key)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    _, next_data_dir, png_file, kind, sink_tiles = future.result()
+                    record = TileRecord(*key, data_dir=next_data_dir)
+                    record.png_dir = png_file
+                    counts[key[0]][kind] += 1
+                    for tile in sink_tiles or []:
+                        tile_sink.put(*tile)
+                    if publisher is not None and png_file is not None:
+                        publisher(png_file)
+                except Exception as E:
+                    logging.error(f"Tile {'/'.join(str(i) for i in key)} generation failed: {E}")
+                    record = None
+                finish(key, record)
+
+    return registries
@@ -0,0 +1,219 @@
+from Tiff2Tiles import tiff2tiles
+from Tiles2Npy import tiles2npy
+from Statistical_Analysis import StreamingStatistics, statistics_state_file, tile_statistics, _analyse_tiles
+from Generate_multilevel_png import overview_tile_data
+from Tile_Renderer import TileRenderer, TileWriter
+from Tile_Registry import TileRegistry, TileRecord, registry_file, parent_key
+from Level_Store import LevelStore, is_store_file, load_tile
+from utils import load_json, save_json
+import os
+import copy
+import shutil
+import logging
+from pathlib import Path
+from tqdm import tqdm
+import numpy as np
+
+
+def merge_fragments(fragments):
+    '''
+    合并同一瓦片的多个碎片(TMP文件), 先登记的碎片中有效像素(alpha不为0)优先, 与merge_tiles的规则一致
+    '''
+    tile_data = None
+    for fragment in fragments:
+        fragment_data = np.load(fragment)
+        tile_data = fragment_data if tile_data is None else np.where(tile_data[:, :, -1:] != 0, tile_data, fragment_data)
+    return tile_data
+
+
+def _write_tile(data_dir, record, tile_data, store):
+    '''
+    把更新后的瓦片写回原位置: LevelStore的槽位原地覆盖, 或覆盖npy文件; 新瓦片写入NPY/{z}/{x}/{y}.npy
+    '''
+    if store is not None:
+        store.write(record.x, record.y, tile_data)
+        record.data_dir = store.path
+        return
+    if record.data_dir is None or is_store_file(record.data_dir):
+        record.data_dir = os.path.join(data_dir, 'NPY', str(record.z), str(record.x), f'{record.y}.npy')
+    Path(record.data_dir).parent.mkdir(parents=True, exist_ok=True)
+    np.save(record.data_dir, tile_data)
+
+
+def _restore_extrema(statistics, statis_dict_list):
+    '''
+    subtract去掉旧瓦片后, 全局最大值/最小值只能取直方图的箱边界(浮点数据误差可达一个箱宽);
+    各瓦片统计信息中的max/min是精确值, 由它们重建全局最值。无有效值的通道在瓦片统计中填0(0值不参与统计), 跳过
+    '''
+    tiles = [next(iter(statis_dict.values())) for statis_dict in statis_dict_list.values()]
+    for n in range(statistics.channels):
+        if statistics.count[n] == 0:
+            continue
+        min_values = [tile['min'][n] for tile in tiles if n < len(tile.get('min', [])) and tile['min'][n] != 0]
+        max_values = [tile['max'][n] for tile in tiles if n < len(tile.get('max', [])) and tile['max'][n] != 0]
+        if min_values and max_values:
+            statistics.min[n], statistics.max[n] = min(min_values), max(max_values)
+
+
+def _render_tiles(writer, png_dir, tiles, publisher=None):
+    for (z, x, y), tile_data in tiles.items():
+        png_file = writer.write(tile_data, os.path.join(png_dir, str(z), str(x), f'{y}.{writer.renderer.extension}'))
+        if publisher is not None and png_file is not None:
+            publisher(png_file)
+
+
+def update_pyramid(data_dir, tiff_dir, file_list, src_crs=None, resolution=None, tile_size=None, stretch_method=None,
+                   mode='add', min_zoom=1, freeze_stretch=True, nodata_value=None, cmap=None, customized_cmap=None,
+                   selected_channels=[], encoder=None, publisher=None):
+    '''
+    增量更新已生成的瓦片金字塔(process_tiff的输出): 只切新增/替换的景, 合并到受影响的最大等级瓦片,
+    再沿四叉树把它们的祖先瓦片标记为脏瓦片, 逐级只重新生成和渲染这些瓦片, 耗时与新景的覆盖范围成正比, 与数据集大小无关。
+    统计值由statistics_state.npz(save_statistics保存的StreamingStatistics状态)去掉旧瓦片、加入新瓦片得到,
+    不再遍历全部瓦片; 中间瓦片的存储方式(NPY文件或Level_Store)与原金字塔一致
+
+    Args:
+        data_dir: process_tiff的输出主目录
+        tiff_dir: 新景GeoTIFF所在目录
+        file_list: 新增/替换的GeoTIFF文件名称list, 按顺序合并
+        src_crs: GeoTIFF文件的投影坐标系
+        resolution: 栅格分辨率, 与原金字塔一致
+        tile_size: 栅格尺寸, 与原金字塔一致
+        stretch_method: 拉伸方法, 定义在utils.normalize函数里
+        mode: 'add' 原有有效像素优先, 新景只填补空白(与把文件追加到file_list末尾重跑的结果一致);
+              'replace' 新景的有效像素覆盖原有像素(旧景中新景未覆盖的像素保留)
+        min_zoom: 更新到的最小等级
+        freeze_stretch: True时脏瓦片仍按更新前的统计值渲染, 与未更新的瓦片颜色一致; 更新后的统计值写入statistics.json,
+                        之后可用Regenerate_png整体重新渲染
+        nodata_value: Nodata值, 仅在没有statistics_state.npz时重新统计全部瓦片使用
+        cmap: matplotlib中色卡关键词
+        customized_cmap: 自定义的基于matplotlib的色卡，定义在color_config.py里
+        selected_channels: List, 多通道图像按顺序选择RGB通道的index
+        encoder: 可选, 瓦片编码(Tile_Encoder.TileEncoder)
+        publisher: 可选, 每写完一个png调用publisher(png_file), 如bulk_upload.TilePublisher
+
+    Returns:
+        dirty: {zoom_level: 更新的瓦片数}
+    '''
+    if mode not in ('add', 'replace'):
+        raise ValueError(f"Unsupported update mode: {mode}")
+    png_dir = os.path.join(data_dir, 'PNG')
+    store_dir = os.path.join(data_dir, 'STORE')
+    statistics_file = os.path.join(data_dir, "statistics.json")
+    statistic_dict = load_json(statistics_file)
+    max_zoom = statistic_dict['max_zoom']
+    registry = TileRegistry.load(registry_file(data_dir, max_zoom))
+    level_store = any(is_store_file(record.data_dir) for record in registry)
+
+    # 1. 新景单独切片到UPDATE目录, 碎片只含新景的数据
+    update_dir = os.path.join(data_dir, 'UPDATE')
+    shutil.rmtree(update_dir, ignore_errors=True)
+    update_tiles_dir = os.path.join(update_dir, 'TILES')
+    os.makedirs(update_tiles_dir, exist_ok=True)
+    fragments = TileRegistry()
+    for fn in tqdm(file_list, desc="Cutting new scenes"):
+        tiff_file = os.path.join(tiff_dir, fn)
+        try:
+            tile_name_list = tiff2tiles(tiff_file, update_tiles_dir, src_crs=src_crs, resolution=resolution,
+                                        tile_size=tile_size)
+            if tile_name_list:
+                tiles2npy(update_dir, tile_name_list, fragments, current_level=max_zoom, resolution=resolution,
+                          tile_size=tile_size)
+        except Exception as E:
+            logging.error(f"{tiff_file} processed failed: {E}")
+    if not len(fragments):
+        logging.info("No tiles touched by the update")
+        return {}
+
+    # 2. 合并到受影响的最大等级瓦片, 同时从全局统计中去掉旧瓦片、加入新瓦片
+    state_file = statistics_state_file(data_dir)
+    statistics = StreamingStatistics.load(state_file) if os.path.exists(state_file) else None
+    statis_dict_list = {list(statis_dict)[0]: statis_dict for statis_dict in statistic_dict.get("statistics", [])}
+    store = LevelStore(store_dir, max_zoom, mode='a') if level_store else None
+    dirty_tiles = {}
+    for fragment_record in fragments:
+        new_data = merge_fragments(fragment_record.fragments)
+        record = registry.get(fragment_record.key)
+        if record is None:
+            record = registry.add(TileRecord(*fragment_record.key))
+            tile_data = new_data
+        else:
+            # 存储中的瓦片是只读映射, 原地覆盖前先拷贝
+            old_data = np.array(load_tile(record))
+            if mode == 'add':
+                tile_data = np.where(old_data[:, :, -1:] != 0, old_data, new_data)
+            else:
+                tile_data = np.where(new_data[:, :, -1:] != 0, new_data, old_data)
+            if statistics is not None:
+                old_stats = StreamingStatistics(statistics.nodata_value, statistics.bins)
+                old_stats.update(old_data[:, :, :-1])
+                statistics.subtract(old_stats)
+        _write_tile(data_dir, record, tile_data, store)
+        if statistics is not None:
+            statis_dict_list[record.current_index] = tile_statistics(statistics, tile_data, record)
+        dirty_tiles[record.key] = tile_data
+    if store is not None:
+        store.close()
+    registry.save(registry_file(data_dir, max_zoom))
+
+    if statistics is not None:
+        _restore_extrema(statistics, statis_dict_list)
+    else:
+        # 旧版本生成的金字塔没有保存统计状态, 重新统计一次全部瓦片, 之后的更新即为增量
+        logging.warning(f"{state_file} not found, recomputing statistics over all zoom-{max_zoom} tiles")
+        statistics, statis_list = _analyse_tiles((registry.records(), nodata_value))
+        statis_dict_list = {list(statis_dict)[0]: statis_dict for statis_dict in statis_list}
+    previous_dict = copy.deepcopy(statistic_dict)
+    statistic_dict["nums"] = len(registry)
+    statistic_dict.update(statistics.summary())
+    statistic_dict["statistics"] = list(statis_dict_list.values())
+    save_json(statistic_dict, statistics_file)
+    statistics.save(state_file)
+    for name in ('min', 'max', '02%', '98%'):
+        if previous_dict.get(name) != statistic_dict[name]:
+            logging.info(f"Statistic {name} changed: {previous_dict.get(name)} -> {statistic_dict[name]}")
+
+    renderer = TileRenderer(previous_dict if freeze_stretch else statistic_dict, stretch_method, cmap=cmap,
+                            customized_cmap=customized_cmap, selected_channels=selected_channels, encoder=encoder)
+    writer = TileWriter(renderer, png_dir)
+    _render_tiles(writer, png_dir, dirty_tiles, publisher=publisher)
+    dirty = {max_zoom: len(dirty_tiles)}
+
+    # 3. 脏瓦片沿四叉树向上传播, 每级只由子瓦片重新生成受影响的父瓦片
+    for zoom_level in range(max_zoom - 1, min_zoom - 1, -1):
+        level_file = registry_file(data_dir, zoom_level)
+        if not os.path.exists(level_file):
+            logging.warning(f"{level_file} not found, stop updating at zoom-{zoom_level + 1}")
+            break
+        parent_registry = TileRegistry.load(level_file)
+        dirty_keys = sorted({parent_key(key) for key in dirty_tiles})
+        store = LevelStore(store_dir, zoom_level, mode='a') if level_store else None
+        dirty_tiles = {}
+        for key in dirty_keys:
+            tile_data = overview_tile_data(key, registry.children(key))
+            record = parent_registry.get(key) or parent_registry.add(TileRecord(*key))
+            _write_tile(data_dir, record, tile_data, store)
+            dirty_tiles[key] = tile_data
+        if store is not None:
+            store.close()
+        parent_registry.save(level_file)
+        _render_tiles(writer, png_dir, dirty_tiles, publisher=publisher)
+        dirty[zoom_level] = len(dirty_tiles)
+        registry = parent_registry
+
+    shutil.rmtree(update_dir, ignore_errors=True)
+    logging.info(f"Incremental update of {len(file_list)} files: {dirty}, png {writer.counts}")
+    return dirty
+
+
+if __name__ == '__main__':
+    from color_config import BlueReds
+
+    # process_tiff已生成的主目录, 新景所在目录和文件
+    data_dir = '/home/data2/ASTGTM_tiny'
+    tiff_dir = '/home/data2/ASTWBD_TIFF'
+    fn_list = ['ASTGTMV003_N30E120_dem.tif']
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    dirty = update_pyramid(data_dir, tiff_dir, fn_list, src_crs='epsg:4326', resolution=30, tile_size=1024,
+                           stretch_method='dem', mode='replace', customized_cmap=BlueReds().cmap)
+    print(dirty)
@@ -0,0 +1,224 @@
+import os
+import glob
+import numpy as np
+
+
+def store_files(store_dir, zoom_level):
+    '''
+    一个等级的存储文件: 数据文件zoom-{z}.dat 和 索引文件zoom-{z}.index.npz
+    '''
+    return (os.path.join(store_dir, f'zoom-{zoom_level}.dat'),
+            os.path.join(store_dir, f'zoom-{zoom_level}.index.npz'))
+
+
+class LevelStore:
+    '''
+    按等级存储的瓦片块文件, 代替 TMP/{z}/{x}/*.npy 和 NPY/{z}/{x}/{y}.npy 每个瓦片一个文件的存储方式。
+    同一等级的瓦片大小和类型相同, 依次存放在zoom-{z}.dat的固定大小的槽位中, 索引(x, y, slot)单独存为npz;
+    读取时通过np.memmap直接映射到对应槽位, 不需要拷贝, 也不再为每个瓦片打开一次文件。
+    写入只能在一个进程中进行(单写多读)
+    '''
+
+    def __init__(self, store_dir, zoom_level, mode='a'):
+        '''
+        Args:
+            store_dir: 存储目录
+            zoom_level: 瓦片等级
+            mode: 'a' 读写(已存在时追加), 'w' 覆盖, 'r' 只读
+        '''
+        self.store_dir = store_dir
+        self.zoom_level = zoom_level
+        self.path, self.index_path = store_files(store_dir, zoom_level)
+        self.mode = mode
+        self.tile_shape = None
+        self.dtype = None
+        self._slots = {}
+        self._mmap = None
+        self._file = None
+
+        if mode != 'w' and os.path.exists(self.index_path):
+            with np.load(self.index_path) as index:
+                self._slots = dict(zip(zip(index['x'].tolist(), index['y'].tolist()), index['slot'].tolist()))
+                self.tile_shape = tuple(index['tile_shape'].tolist())
+                self.dtype = np.dtype(str(index['dtype']))
+        elif mode == 'r':
+            raise FileNotFoundError(f"{self.index_path} not found")
+
+        if mode != 'r':
+            os.makedirs(store_dir, exist_ok=True)
+            self._file = open(self.path, 'r+b' if mode == 'a' and os.path.exists(self.path) else 'w+b')
+            if not self._slots:
+                self._file.truncate(0)
+
+    @property
+    def slot_size(self):
+        return int(np.prod(self.tile_shape)) * self.dtype.itemsize
+
+    def _mapped(self, slot):
+        # 写入经过缓冲区, 读取前先写入文件, 映射才能看到刚写入的数据
+        if self._file is not None:
+            self._file.flush()
+        # 数据文件增长后重新映射
+        if self._mmap is None or slot >= self._mmap.shape[0]:
+            count = os.path.getsize(self.path) // self.slot_size
+            self._mmap = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(count,) + self.tile_shape)
+        return self._mmap
+
+    def read(self, x, y):
+        '''
+        Returns:
+            瓦片数据, 只读的np.memmap视图; 不存在时返回None
+        '''
+        slot = self._slots.get((x, y))
+        if slot is None:
+            return None
+        return self._mapped(slot)[slot]
+
+    def write(self, x, y, data):
+        '''
+        写入瓦片, 已存在时原地覆盖
+        '''
+        data = np.ascontiguousarray(data)
+        if self.tile_shape is None:
+            self.tile_shape, self.dtype = data.shape, data.dtype
+        elif data.shape != self.tile_shape:
+            raise ValueError(f"Tile shape {data.shape} does not match store shape {self.tile_shape}")
+        slot = self._slots.get((x, y))
+        if slot is None:
+            slot = self._slots[(x, y)] = len(self._slots)
+        self._file.seek(slot * self.slot_size)
+        self._file.write(data.astype(self.dtype, copy=False).tobytes())
+        return slot
+
+    def merge(self, x, y, data):
+        '''
+        合并同一瓦片的多个碎片: 按alpha整像素合并, 已有瓦片中alpha不为0的像素(全部通道)保留, 其余像素由data填充,
+        与Incremental_Update.merge_fragments一致。
+        注意与其他合并规则不同: merge_staged_tiles按波段逐元素保留已有的非0值(某波段为0时可由后续景填充);
+        默认的NPY文件路径由aster_core的MergeTileRecords合并。同一瓦片的碎片来自互不重叠的栅格,
+        有效像素基本不重叠, 几种规则的结果只在重投影边缘重叠的像素上可能不同
+        '''
+        existing = self.read(x, y)
+        if existing is not None:
+            data = np.where(existing[:, :, -1:] != 0, existing, data)
+        return self.write(x, y, data)
+
+    def flush(self):
+        '''
+        写入数据并保存索引, 之后其他进程可以只读打开
+        '''
+        if self._file is None or self.tile_shape is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        keys = np.array(list(self._slots.keys()), dtype=np.int64).reshape(-1, 2)
+        # 索引先写临时文件再替换, 中断时索引只会指向已写入的数据
+        with open(f'{self.index_path}.tmp', 'wb') as f:
+            np.savez(f, x=keys[:, 0], y=keys[:, 1],
+                     slot=np.array(list(self._slots.values()), dtype=np.int64),
+                     tile_shape=np.array(self.tile_shape, dtype=np.int64), dtype=np.array(self.dtype.str))
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+        self._mmap = None
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._mmap = None
+
+    def keys(self):
+        return list(self._slots.keys())
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# 只读打开的存储, 按数据文件缓存, 索引文件更新后重新打开
+_readers = {}
+
+
+def is_store_file(data_dir):
+    return bool(data_dir) and data_dir.endswith('.dat')
+
+
+def open_level_store(path):
+    '''
+    只读打开数据文件对应的LevelStore (进程内缓存)
+    '''
+    store_dir = os.path.dirname(path)
+    zoom_level = int(os.path.basename(path)[len('zoom-'):-len('.dat')])
+    index_path = store_files(store_dir, zoom_level)[1]
+    mtime = os.path.getmtime(index_path)
+    cached = _readers.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _readers[path] = (mtime, LevelStore(store_dir, zoom_level, mode='r'))
+    return cached[1]
+
+
+def load_tile(record):
+    '''
+    读取瓦片数据, record.data_dir为LevelStore数据文件时从存储中映射, 否则为单个npy文件
+
+    Args:
+        record: 瓦片信息(Tile_Registry.TileRecord)
+
+    Returns:
+        瓦片数据, shape为(height, width, channel + 1)
+    '''
+    if is_store_file(record.data_dir):
+        return open_level_store(record.data_dir).read(record.x, record.y)
+    return np.load(record.data_dir)
+
+
+def list_level_stores(store_dir):
+    '''
+    存储目录中已有的等级, 从大到小排列
+    '''
+    zoom_levels = []
+    for path in glob.glob(os.path.join(store_dir, 'zoom-*.index.npz')):
+        try:
+            zoom_levels.append(int(os.path.basename(path)[len('zoom-'):-len('.index.npz')]))
+        except ValueError:
+            continue
+    return sorted(zoom_levels, reverse=True)
+
+
+if __name__ == '__main__':
+    # 对比: 每个瓦片一个npy文件 与 按等级的块文件, 写入和读取的耗时
+    import time
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    tiles = {(x, y): rng.random((256, 256, 2)).astype(np.float32) for x in range(32) for y in range(32)}
+    tmp_dir = tempfile.mkdtemp()
+
+    start = time.perf_counter()
+    for (x, y), data in tiles.items():
+        npy_file = os.path.join(tmp_dir, 'NPY', '10', str(x), f'{y}.npy')
+        os.makedirs(os.path.dirname(npy_file), exist_ok=True)
+        np.save(npy_file, data)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    total = sum(float(np.load(os.path.join(tmp_dir, 'NPY', '10', str(x), f'{y}.npy'))[0, 0, 0]) for x, y in tiles)
+    print(f"npy files  : write {write_time:6.2f} s, read {time.perf_counter() - start:6.2f} s")
+
+    start = time.perf_counter()
+    with LevelStore(os.path.join(tmp_dir, 'STORE'), 10, mode='w') as store:
+        for (x, y), data in tiles.items():
+            store.write(x, y, data)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    store = LevelStore(os.path.join(tmp_dir, 'STORE'), 10, mode='r')
+    assert sum(float(store.read(x, y)[0, 0, 0]) for x, y in tiles) == total
+    print(f"level store: write {write_time:6.2f} s, read {time.perf_counter() - start:6.2f} s")
+    assert all(np.array_equal(store.read(x, y), data) for (x, y), data in tiles.items())
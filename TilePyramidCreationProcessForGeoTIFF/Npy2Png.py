@@ -1,39 +1,50 @@
-from utils import normalize, array_to_png, load_json
+from utils import load_json
+from Tile_Renderer import TileRenderer, TileWriter
+from Level_Store import load_tile
 import numpy as np
 import os
 from pathlib import Path
 
-def npy2png(data_dir, tile_dict_list, statistic_dict, stretch_method, cmap=None, customized_cmap=None, selected_channels=[]):
+def npy2png(data_dir, registry, statistic_dict, stretch_method, cmap=None, customized_cmap=None, selected_channels=[], publisher=None,
+            tile_sink=None, encoder=None):
     '''
     对npy文件进行归一化处理，再将归一化的RGBA四通道矩阵存储为.png格式文件
 
     Args:
         data_dir: 输出文件主目录
-        tile_dict_list: 瓦片信息对应字典
+        registry: 瓦片注册表(Tile_Registry.TileRegistry)
         statistic_dict: 统计信息，跑Statistical_Analysis可以得到该文件，字典格式
         stretch_method: 拉伸方法，定义在utils.normalize函数里
         cmap: matplotlib中色卡关键词
         customized_cmap: 自定义的基于matplotlib的色卡，定义在color_config.py里
         selected_channels: List, 多通道图像按顺序选择RGB通道的index
+        publisher: 可选, 每写完一个png调用publisher(png_file), 如bulk_upload.TilePublisher
+        tile_sink: 可选, 瓦片包(Tile_Archive.open_tile_sink), 传入时png写入瓦片包, 不再生成单独的png文件
+        encoder: 可选, 瓦片编码(Tile_Encoder.TileEncoder), 默认为索引色png
 
-    Returns: None
+    Returns:
+        counts: {'rendered', 'empty', 'uniform'}, 全透明瓦片不写入, 单一颜色瓦片共用一个png (Tile_Renderer.TileWriter)
 
     '''
     png_dir = os.path.join(data_dir, 'PNG')
-    for tile_dict in tile_dict_list:
-        for key, value in tile_dict.items():
-            tile_data = np.load(value['data_dir'])
-
-            current_level, index_x, index_y = value['current_index'].split('/')
-            # 归一化
-            norm_tile_data = normalize(tile_data, statistic_dict, stretch_method=stretch_method)
-
-            png_file = os.path.join(png_dir, current_level, index_x, f'{index_y}.png')
-            Path(png_file).parent.mkdir(parents=True, exist_ok=True)
-            # 将归一化的四通道RGBA矩阵存储为png文件
-            array_to_png(norm_tile_data, png_file, cmap=cmap, customized_cmap=customized_cmap, selected_channels=selected_channels)
-            # 维护瓦片信息对应的字典
-            tile_dict[key]['png_dir'] = png_file
+    # 拉伸和色卡只编译一次, 所有瓦片共用
+    renderer = TileRenderer(statistic_dict, stretch_method, cmap=cmap, customized_cmap=customized_cmap,
+                            selected_channels=selected_channels, encoder=encoder)
+    writer = TileWriter(renderer, png_dir)
+    for record in registry:
+        tile_data = load_tile(record)
+        if tile_sink is not None:
+            writer.put(tile_sink, record.z, record.x, record.y, tile_data)
+            continue
+
+        png_file = os.path.join(png_dir, str(record.z), str(record.x), f'{record.y}.{renderer.extension}')
+        # 归一化并上色, 将四通道RGBA矩阵存储为png文件; 全透明瓦片返回None
+        png_file = writer.write(tile_data, png_file)
+        # 维护瓦片信息
+        record.png_dir = png_file
+        if publisher is not None and png_file is not None:
+            publisher(png_file)
+    return writer.counts
 
 
 
@@ -0,0 +1,125 @@
+import os
+import shutil
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+import numpy as np
+import rasterio
+from osgeo import gdal
+from Tiff2Tiles import tiff2tiles, write_grid_tile
+from Tiles2Npy import tiles2npy
+from Tile_Registry import TileRegistry
+
+
+def _cut_scene(args):
+    scene_index, tiff_file, staging_dir, src_crs, resolution, tile_size, shared_reprojection = args
+    os.makedirs(staging_dir, exist_ok=True)
+    try:
+        return scene_index, tiff2tiles(tiff_file, staging_dir, src_crs=src_crs, resolution=resolution,
+                                       tile_size=tile_size, shared_reprojection=shared_reprojection)
+    except Exception as E:
+        logging.error(f"{tiff_file} processed failed: {E}")
+        return scene_index, None
+
+
+def _grid_tile_to_npy(args):
+    data_dir, tile_name, current_level, resolution, tile_size = args
+    try:
+        registry = tiles2npy(data_dir, [tile_name], TileRegistry(), current_level=current_level,
+                             resolution=resolution, tile_size=tile_size)
+    except Exception as E:
+        logging.error(f"{tile_name} processed failed: {E}")
+        registry = None
+    return tile_name, registry
+
+
+def merge_staged_tiles(staging_dirs, scene_tile_names, tiles_dir):
+    '''
+    按file_list顺序把各景暂存的栅格合并进TILES目录, 合并规则与串行的tiff2tiles一致(已有的非0像素保留),
+    因此结果与串行运行逐字节相同
+
+    Args:
+        staging_dirs: 各景的暂存目录, 与file_list顺序一致
+        scene_tile_names: 各景生成的栅格文件名称
+        tiles_dir: 栅格目录
+
+    '''
+    for staging_dir, tile_name_list in zip(staging_dirs, scene_tile_names):
+        for fn in tile_name_list:
+            staged_file = os.path.join(staging_dir, fn)
+            tiles_file = os.path.join(tiles_dir, fn)
+            if not os.path.exists(tiles_file):
+                os.replace(staged_file, tiles_file)
+                continue
+            with rasterio.open(staged_file) as src:
+                data = src.read()
+                tile_geotransform = src.transform
+            data_exist = gdal.Open(tiles_file).ReadAsArray()
+            if data_exist.ndim == 2:
+                data_exist = data_exist.reshape((1, data_exist.shape[0], data_exist.shape[1]))
+            data = np.where(data_exist != 0, data_exist, data)
+            write_grid_tile(tiles_file, data, tile_geotransform)
+            os.remove(staged_file)
+
+
+def parallel_ingest(data_dir, tiff_dir, file_list, registry, num_workers=8,
+                    src_crs=None, current_level=None, resolution=None, tile_size=None, desc=None,
+                    shared_reprojection=False):
+    '''
+    多进程版本的 tiff2tiles + tiles2npy
+    1. 各景并行重投影切栅格, 写入各自的暂存目录, 互不竞争同一个栅格文件;
+    2. 主进程按file_list顺序合并栅格 (merge_staged_tiles);
+    3. 每个栅格只生成一次基础瓦片(并行), 再按file_list顺序并入registry,
+       非0判断基于合并后的栅格
+
+    Args:
+        data_dir: 数据主目录
+        tiff_dir: tiff文件目录
+        file_list: tiff文件名称列表
+        registry: 瓦片注册表(Tile_Registry.TileRegistry)
+        num_workers: 进程数
+        src_crs: tiff文件坐标系
+        current_level: 当前切片等级
+        resolution: 栅格分辨率
+        tile_size: 栅格尺寸
+        desc: 进度条描述
+        shared_reprojection: 传给tiff2tiles, True时各景只打开一次并共用重投影(Tiff2Tiles.SceneReprojector)
+
+    Returns:
+        registry: 瓦片注册表
+        ingested_files: 处理成功的文件(切片和其全部栅格的基础瓦片都成功), 顺序与file_list一致
+
+    '''
+    tiles_dir = os.path.join(data_dir, 'TILES')
+    staging_root = os.path.join(tiles_dir, '.staging')
+    staging_dirs = [os.path.join(staging_root, str(i)) for i in range(len(file_list))]
+    scene_tile_names = [[] for _ in file_list]
+    failed_scenes = set()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        tasks = [(i, os.path.join(tiff_dir, fn), staging_dirs[i], src_crs, resolution, tile_size, shared_reprojection)
+                 for i, fn in enumerate(file_list)]
+        for scene_index, tile_name_list in tqdm(executor.map(_cut_scene, tasks), total=len(tasks), desc=desc):
+            if tile_name_list is None:
+                failed_scenes.add(scene_index)
+            else:
+                scene_tile_names[scene_index] = tile_name_list
+
+        merge_staged_tiles(staging_dirs, scene_tile_names, tiles_dir)
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+        unique_tile_names = list(dict.fromkeys(fn for names in scene_tile_names for fn in names))
+        tasks = [(data_dir, fn, current_level, resolution, tile_size) for fn in unique_tile_names]
+        fragments = dict(tqdm(executor.map(_grid_tile_to_npy, tasks, chunksize=16), total=len(tasks),
+                              desc="tiles2npy"))
+
+    # 每个栅格的碎片只登记一次(多景覆盖同一栅格时也是), 顺序为栅格在file_list中首次出现的顺序
+    for fn in unique_tile_names:
+        if fragments[fn] is not None:
+            registry.extend(fragments[fn])
+
+    # 覆盖了转换失败的栅格的景也算失败
+    failed_tiles = {fn for fn in unique_tile_names if fragments[fn] is None}
+    ingested_files = [fn for i, fn in enumerate(file_list)
+                      if i not in failed_scenes and not failed_tiles.intersection(scene_tile_names[i])]
+    return registry, ingested_files
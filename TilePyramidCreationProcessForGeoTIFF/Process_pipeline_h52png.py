@@ -1,13 +1,18 @@
 from H5_to_Tiff import h5_to_tiff
 from Tiff2Tiles import tiff2tiles
-from Statistical_Analysis import statistical_analysis
+from Statistical_Analysis import statistical_analysis, save_statistics, StreamingStatistics
 from Tiles2Npy import tiles2npy, merge_tiles
 from Npy2Png import npy2png
 from Generate_multilevel_png import generate_multilevel_png
+from Tile_Registry import TileRegistry, registry_file
+from Level_Store import LevelStore
+from Run_Manifest import RunManifest, IngestBatch
 import os
 from tqdm import tqdm
 from config_save import download_bucket, upload_bucket
-from utils import download_object_from_oss, upload_object_to_oss, get_dataset_name
+from utils import download_object_from_oss, get_dataset_name, load_json
+from bulk_upload import BulkUploader, TilePublisher, PublishManifest
+from Tile_Archive import open_tile_sink
 from Validate import plot_tiles_recursive
 import numpy as np
 from pathlib import Path
@@ -23,12 +28,20 @@ def process_h5(data_dir, h5_dir, oss_download_url, file_list, sds_name=None, max
                tile_size=None,
                nodata_value=None,
                src_crs=None,
-               channel_count=None, upload_npy_url=None, oss_upload_url=None, overwrite_oss=False):
+               channel_count=None, upload_npy_url=None, oss_upload_url=None, overwrite_oss=False,
+               fuse_statistics=True, level_store=False, resume=False, archive_file=None):
+    '''
+    主函数, 从OSS下载H5数据, 转为GeoTIFF后进行本地多级瓦片切片处理;
+    运行进度记录在<data_dir>/run_manifest.jsonl(Run_Manifest.RunManifest), 中断后resume=True重新运行,
+    跳过已下载切片的文件、已合并的瓦片和已完成的等级;
+    archive_file(.mbtiles或.pak)时各级瓦片写入该瓦片包, 不再生成单独的png文件, 上传OSS时只上传瓦片包(见process_tiff)
+    '''
     tiff_dir = os.path.join(data_dir, 'TIFF')
     tiles_dir = os.path.join(data_dir, 'TILES')
     npy_dir = os.path.join(data_dir, 'NPY')
     tmp_dir = os.path.join(data_dir, 'TMP')
     png_dir = os.path.join(data_dir, 'PNG')
+    store_dir = os.path.join(data_dir, 'STORE')
 
     os.makedirs(tiff_dir, exist_ok=True)
     os.makedirs(tiles_dir, exist_ok=True)
@@ -36,10 +49,31 @@ def process_h5(data_dir, h5_dir, oss_download_url, file_list, sds_name=None, max
     os.makedirs(tmp_dir, exist_ok=True)
     os.makedirs(png_dir, exist_ok=True)
 
-    base_tile_dict = {}
-    base_tile_index_list = []
-
-    for fn in tqdm(file_list, desc=f"Processing {sds_name}"):
+    # 运行清单: 记录已完成的输入文件和等级, resume=True时跳过已完成的部分(包括下载和h5_to_tiff)
+    run_manifest = RunManifest(os.path.join(data_dir, 'run_manifest.jsonl'), resume=resume)
+    # 已完成的等级不会重新渲染, 渲染参数也必须与记录一致
+    run_manifest.check_config(sds_name=sds_name, max_zoom=max_zoom, resolution=resolution, tile_size=tile_size,
+                              src_crs=src_crs, level_store=level_store, stretch_method=stretch_method,
+                              nodata_value=nodata_value)
+    if archive_file and resume and not archive_file.endswith('.mbtiles'):
+        # .pak的索引在关闭时才写入, 中断后无法继续写入
+        raise ValueError(f"Resume is only supported for .mbtiles archives: {archive_file}")
+    merged = run_manifest.done('merge', zoom=max_zoom)
+
+    registry = run_manifest.replay_registry(TileRegistry())
+    done_files = run_manifest.done_files()
+    # 已合并时不再切片(失败的文件也不再重试)
+    pending_files = [] if merged else [fn for fn in file_list if fn not in done_files]
+    if done_files and pending_files:
+        print(f"已完成{len(done_files)}个文件, 继续处理剩余{len(pending_files)}个文件")
+    # 中间瓦片按等级写入<data_dir>/STORE, 不再生成TMP/NPY小文件
+    store = None
+    if level_store and not merged:
+        store = LevelStore(store_dir, max_zoom, mode='a' if resume else 'w')
+
+    # 存储按批flush, 清单只记录已落盘的文件
+    ingest_batch = IngestBatch(run_manifest, store=store)
+    for fn in tqdm(pending_files, desc=f"Processing {sds_name}"):
         h5_file = os.path.join(h5_dir, fn)
         tiff_file = os.path.join(tiff_dir, fn.replace('.h5', '.tiff'))
         try:
@@ -50,73 +84,113 @@ def process_h5(data_dir, h5_dir, oss_download_url, file_list, sds_name=None, max
             print(f"{h5_file} download failed: {E}")
             continue
         try:
-
+            file_registry = TileRegistry()
             tile_name_list = tiff2tiles(tiff_file, tiles_dir, resolution=resolution, tile_size=tile_size, src_crs=src_crs,
                                         channel_count=channel_count)
             if tile_name_list:
-                tile_dict_info = tiles2npy(data_dir,
-                                           tile_name_list,
-                                           base_tile_dict,
-                                           base_tile_index_list,
-                                           current_level=max_zoom,
-                                           resolution=resolution,
-                                           tile_size=tile_size)
-                if tile_dict_info is not None:
-                    base_tile_dict, base_tile_index_list = tile_dict_info
+                tiles2npy(data_dir,
+                          tile_name_list,
+                          file_registry,
+                          current_level=max_zoom,
+                          resolution=resolution,
+                          tile_size=tile_size,
+                          store=store)
+            registry.extend(file_registry)
+            ingest_batch.add(fn, file_registry)
         except Exception as E:
             logging.error(f"{h5_file} processed failed: {E}")
             continue
+    ingest_batch.commit()
+
+    # png写完即在后台上传, 与后续等级的生成重叠进行; 按发布清单只上传内容变化的瓦片
+    publisher = None
+    if oss_upload_url and not archive_file:
+        manifest = PublishManifest(os.path.join(data_dir, 'publish_manifest.json'))
+        publisher = TilePublisher(upload_bucket, oss_upload_url, overwrite=overwrite_oss, manifest=manifest)
+    # 瓦片写入单个瓦片包, 续跑时保留已完成等级的瓦片
+    tile_sink = open_tile_sink(archive_file, name=sds_name or '', append=resume) if archive_file else None
 
     try:
-        print("正在合并重复瓦片...")
-        merged_base_tile_list = merge_tiles(data_dir, base_tile_dict)
-        print("正在计算统计值...")
-        statistic_dict = statistical_analysis(data_dir, npy_dir, max_zoom=max_zoom, sds_name=sds_name, nodata_value=nodata_value)
-        os.makedirs(os.path.join(data_dir, stretch_method), exist_ok=True)
-        print(f"正在生成{max_zoom}级瓦片...")
-        npy2png(data_dir, merged_base_tile_list, statistic_dict, stretch_method=stretch_method)
-    except Exception as E:
-        logging.error(f"Zoom-{max_zoom} merged failed: {E}")
-
-    for zoom_level in range(max_zoom - 1, 0, -1):
         try:
-            print(f"正在生成{zoom_level}级瓦片...")
-            merged_next_tile_list = generate_multilevel_png(data_dir, merged_base_tile_list)
-            npy2png(data_dir, merged_next_tile_list, statistic_dict, stretch_method=stretch_method)
-            merged_base_tile_list = merged_next_tile_list
+            if merged:
+                print("合并瓦片已完成, 读取注册表和统计值...")
+                merged_registry = TileRegistry.load(registry_file(data_dir, max_zoom))
+                statistic_dict = load_json(os.path.join(data_dir, "statistics.json"))
+            else:
+                print("正在合并重复瓦片...")
+                if fuse_statistics:
+                    # 合并瓦片的同时计算统计信息
+                    statistics, statis_dict_list = StreamingStatistics(nodata_value=nodata_value), []
+                    merged_registry = merge_tiles(data_dir, registry, statistics=statistics,
+                                                  statis_dict_list=statis_dict_list, store=store)
+                    statistic_dict = save_statistics(data_dir, npy_dir, statistics, statis_dict_list, max_zoom=max_zoom,
+                                                     sds_name=sds_name)
+                else:
+                    merged_registry = merge_tiles(data_dir, registry, store=store)
+                    print("正在计算统计值...")
+                    statistic_dict = statistical_analysis(data_dir, npy_dir, max_zoom=max_zoom, sds_name=sds_name, nodata_value=nodata_value)
+                run_manifest.record('merge', zoom=max_zoom)
+            os.makedirs(os.path.join(data_dir, stretch_method), exist_ok=True)
+            if run_manifest.resume_level(max_zoom) is None:
+                print(f"正在生成{max_zoom}级瓦片...")
+                counts = npy2png(data_dir, merged_registry, statistic_dict, stretch_method=stretch_method, publisher=publisher,
+                                 tile_sink=tile_sink)
+                logging.info(f"Zoom-{max_zoom} tiles: {counts}")
+                if tile_sink is not None:
+                    tile_sink.flush()
+                run_manifest.record('level', zoom=max_zoom)
         except Exception as E:
-            logging.error(f"Zoom-{zoom_level} generation failed: {E}")
-
-    # Validate
-    plot_tiles_recursive(data_dir=png_dir,
-                         output_dir=os.path.join(data_dir, stretch_method))
-
-    if oss_upload_url:
-        png_list = get_all_files(png_dir, suffix='png')
-        for png_path in png_list:
-            normalized_path = os.path.normpath(png_path)
-            parts = normalized_path.split(os.sep)
-            current_level = parts[-3]  # 倒数第3层是 current_level
-            index_x = parts[-2]  # 倒数第2层是 index_x
-            index_y = parts[-1].replace('.png', '')  # 文件名部分是 index_y
-
-            oss_upload_file = os.path.join(oss_upload_url, current_level, index_x, index_y) + '.png'
-            upload_object_to_oss(upload_bucket, oss_upload_file, normalized_path, overwrite=overwrite_oss)
-
-        print(f"Upload to OSS {oss_upload_url} OK, overwrite is {overwrite_oss}")
+            logging.error(f"Zoom-{max_zoom} merged failed: {E}")
+
+        # 从连续完成的最小等级继续生成
+        start_zoom = run_manifest.resume_level(max_zoom)
+        if start_zoom is not None and start_zoom < max_zoom:
+            print(f"{max_zoom}~{start_zoom}级瓦片已完成")
+            merged_registry = TileRegistry.load(registry_file(data_dir, start_zoom))
+        for zoom_level in range(start_zoom - 1 if start_zoom is not None else 0, 0, -1):
+            try:
+                print(f"正在生成{zoom_level}级瓦片...")
+                next_registry = generate_multilevel_png(data_dir, merged_registry,
+                                                        store_dir=store_dir if level_store else None)
+                counts = npy2png(data_dir, next_registry, statistic_dict, stretch_method=stretch_method, publisher=publisher,
+                                 tile_sink=tile_sink)
+                logging.info(f"Zoom-{zoom_level} tiles: {counts}")
+                if tile_sink is not None:
+                    tile_sink.flush()
+                run_manifest.record('level', zoom=zoom_level)
+                merged_registry = next_registry
+            except Exception as E:
+                logging.error(f"Zoom-{zoom_level} generation failed: {E}")
+
+        if tile_sink is not None:
+            logging.info(f"Tile archive {archive_file}: {tile_sink.close()}")
+            if oss_upload_url:
+                key = BulkUploader(upload_bucket, oss_upload_url).upload_file(archive_file)
+                print(f"Upload tile archive to OSS {key}")
+        else:
+            # Validate
+            plot_tiles_recursive(data_dir=png_dir,
+                                 output_dir=os.path.join(data_dir, stretch_method))
+    finally:
+        # 出错时也要结束后台上传线程, 已上传的瓦片记入发布清单
+        if publisher is not None:
+            metrics = publisher.close()
+            logging.info(f"Upload PNG to OSS {oss_upload_url}: {metrics}")
+
+            print(f"Upload to OSS {oss_upload_url} OK, overwrite is {overwrite_oss}")
 
     # 未归一化的中间结果上传 OSS
-    if upload_npy_url:
-        npy_list = get_all_files(npy_dir, suffix='npy')
-        for npy_path in npy_list:
-            normalized_path = os.path.normpath(npy_path)
-            parts = normalized_path.split(os.sep)
-            current_level = parts[-3]  # 倒数第3层是 current_level
-            index_x = parts[-2]  # 倒数第2层是 index_x
-            index_y = parts[-1].replace('.npy', '')  # 文件名部分是 index_y
-
-            oss_upload_file = os.path.join(upload_npy_url, current_level, index_x, index_y) + '.npy'
-            upload_object_to_oss(upload_bucket, oss_upload_file, normalized_path, overwrite=overwrite_oss)
+    if upload_npy_url and not run_manifest.done('upload_npy', url=upload_npy_url):
+        if level_store:
+            npy_list = get_all_files(store_dir, suffix='dat') + get_all_files(store_dir, suffix='npz')
+        else:
+            npy_list = get_all_files(npy_dir, suffix='npy')
+        metrics = BulkUploader(upload_bucket, upload_npy_url, overwrite=overwrite_oss).upload(npy_list, desc="Upload NPY")
+        logging.info(f"Upload NPY to OSS {upload_npy_url}: {metrics}")
+        if metrics['failed'] == 0:
+            run_manifest.record('upload_npy', url=upload_npy_url)
+
+    run_manifest.close()
 
 
 if __name__ == '__main__':
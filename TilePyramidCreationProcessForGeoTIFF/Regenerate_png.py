@@ -1,14 +1,128 @@
-
-from utils import normalize, array_to_png, load_json
+from utils import load_json
+from Tile_Renderer import TileRenderer, TileWriter
 import numpy as np
 import os
-from pathlib import Path
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from Validate import plot_tiles_recursive
 from tqdm import tqdm
+from bulk_upload import TilePublisher, PublishManifest
+from Tile_Archive import open_tile_sink, TileCollector
+from Tile_Registry import TileRecord
+from Level_Store import LevelStore, list_level_stores, load_tile
+from aster_core.global_grid2tiles import GlobalMercator
+
+# 子进程中各调色方案的瓦片写入器, 由_init_worker设置
+_writers = None
+
 
-def regenerate_png(npy_dir, png_dir, statistic_dict, stretch_method, cmap, customized_cmap, selected_channels):
+def bbox_tile_range(bbox, zoom_level):
     '''
-        按照stretch_method方法，重新遍历npy文件目录，生成新的调色图片
+    经纬度范围对应的XYZ瓦片范围
+
+    Args:
+        bbox: (min_lon, min_lat, max_lon, max_lat)
+        zoom_level: 瓦片等级
+
+    Returns:
+        (x_min, y_min, x_max, y_max), 包含两端
+    '''
+    mercator = GlobalMercator()
+    min_lon, min_lat, max_lon, max_lat = bbox
+    # 墨卡托投影的纬度范围
+    min_lat, max_lat = max(min_lat, -85.0511287798), min(max_lat, 85.0511287798)
+    # GlobalMercator为TMS(原点在左下角), 再换算为XYZ的行号
+    tx_min, ty_min = mercator.MetersToTile(*mercator.LatLonToMeters(min_lat, min_lon), zoom_level)
+    tx_max, ty_max = mercator.MetersToTile(*mercator.LatLonToMeters(max_lat, max_lon), zoom_level)
+    last = 2 ** zoom_level - 1
+    tx_min, tx_max = min(max(tx_min, 0), last), min(max(tx_max, 0), last)
+    ty_min, ty_max = min(max(ty_min, 0), last), min(max(ty_max, 0), last)
+    return tx_min, mercator.GoogleTile(tx_min, ty_max, zoom_level)[1], tx_max, mercator.GoogleTile(tx_max, ty_min, zoom_level)[1]
+
+
+def scale_tile_range(tile_range, zoom_level):
+    '''
+    把某一等级的瓦片范围(z, x_min, y_min, x_max, y_max)换算到zoom_level
+
+    Returns:
+        (x_min, y_min, x_max, y_max), 包含两端
+    '''
+    z, x_min, y_min, x_max, y_max = tile_range
+    if zoom_level >= z:
+        shift = zoom_level - z
+        return x_min << shift, y_min << shift, ((x_max + 1) << shift) - 1, ((y_max + 1) << shift) - 1
+    shift = z - zoom_level
+    return x_min >> shift, y_min >> shift, x_max >> shift, y_max >> shift
+
+
+def _list_npy_tiles(npy_dir, zoom_level, tile_range=None):
+    '''
+    列出一个等级的npy瓦片, 只扫描范围内的x目录
+
+    Returns:
+        {index_x: [(index_y, npy_file), ...]}
+    '''
+    level_dir = os.path.join(npy_dir, str(zoom_level))
+    if tile_range is None:
+        try:
+            x_dirs = [entry.name for entry in os.scandir(level_dir) if entry.is_dir() and entry.name.isdigit()]
+        except FileNotFoundError:
+            return {}
+    else:
+        x_dirs = [str(index_x) for index_x in range(tile_range[0], tile_range[2] + 1)]
+
+    columns = {}
+    for x_name in x_dirs:
+        try:
+            entries = list(os.scandir(os.path.join(level_dir, x_name)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext != '.npy' or not name.isdigit():
+                continue
+            index_y = int(name)
+            if tile_range is None or tile_range[1] <= index_y <= tile_range[3]:
+                columns.setdefault(int(x_name), []).append((index_y, entry.path))
+    return columns
+
+
+def _init_worker(renderers, png_dirs):
+    global _writers
+    _writers = [TileWriter(renderer, png_dir) for renderer, png_dir in zip(renderers, png_dirs)]
+
+
+def _render_column(args):
+    '''
+    渲染同一x列的瓦片, 每个瓦片只读取一次, 依次按各调色方案写出
+
+    Returns:
+        (各方案的counts, 主方案写出的png文件list, 主方案写入瓦片包的瓦片list或None)
+    '''
+    zoom_level, index_x, tiles, collect = args
+    sink = TileCollector() if collect else None
+    before = [dict(writer.counts) for writer in _writers]
+    png_files = []
+    for index_y, source in tiles:
+        data = load_tile(TileRecord(zoom_level, index_x, index_y, data_dir=source))
+        for i, writer in enumerate(_writers):
+            if i == 0 and sink is not None:
+                writer.put(sink, zoom_level, index_x, index_y, data)
+                continue
+            png_file = writer.write(data, os.path.join(writer.png_dir, str(zoom_level), str(index_x),
+                                                       f'{index_y}.{writer.renderer.extension}'))
+            if i == 0 and png_file is not None:
+                png_files.append(png_file)
+    counts = [{key: writer.counts[key] - start[key] for key in start} for writer, start in zip(_writers, before)]
+    return counts, png_files, sink.tiles if sink is not None else None
+
+
+def regenerate_png(npy_dir, png_dir, statistic_dict, stretch_method, cmap, customized_cmap, selected_channels,
+                   publisher=None, tile_sink=None, store_dir=None, encoder=None, zoom_range=None, bbox=None,
+                   tile_range=None, variants=None, num_workers=1):
+    '''
+        按照stretch_method方法，重新遍历npy文件目录，生成新的调色图片;
+        可按等级和范围只重新生成一部分瓦片, 范围由GlobalMercator换算为各级的瓦片index, 只扫描范围内的目录
 
     Args:
         npy_dir: NPY文件目录
@@ -18,49 +132,101 @@ def regenerate_png(npy_dir, png_dir, statistic_dict, stretch_method, cmap, custo
         cmap: matplotlib色卡关键词
         customized_cmap: 自定义色卡, 在color_config中定义
         selected_channels: List, 多通道图像按顺序选择RGB通道的index
+        publisher: 可选, 每写完一个png调用publisher(png_file), 如bulk_upload.TilePublisher
+        tile_sink: 可选, 瓦片包(Tile_Archive.open_tile_sink), 传入时png写入瓦片包, 不再生成单独的png文件
+        store_dir: 可选, Level_Store的存储目录, 传入时从各等级的存储读取瓦片, 不再遍历npy_dir
+        encoder: 可选, 瓦片编码(Tile_Encoder.TileEncoder), 默认为索引色png
+        zoom_range: 可选, (min_zoom, max_zoom), 只生成这些等级(包含两端)
+        bbox: 可选, 经纬度范围(min_lon, min_lat, max_lon, max_lat)
+        tile_range: 可选, 某一等级的瓦片范围(z, x_min, y_min, x_max, y_max), 包含两端, 换算到其他等级; 与bbox取交集
+        variants: 可选, 额外的调色方案[(png_dir, stretch_method, cmap, customized_cmap), ...],
+                  每个瓦片只读取一次, 依次渲染各方案; publisher和tile_sink只用于主方案
+        num_workers: 进程数, 大于1时按x列分配给进程池渲染
 
     Returns:
+        counts: 主方案的{'rendered', 'empty', 'uniform'}, 全透明瓦片不写入, 单一颜色瓦片共用一个png (Tile_Renderer.TileWriter)
 
     '''
-    npy_tiles = {}
-    # 读取数据
-    for root, _, files in os.walk(npy_dir):
-        # 获取当前目录的 group 和 index_x
-        rel_path = os.path.relpath(root, npy_dir)
-        parts = rel_path.split(os.sep)
-
-        if len(parts) < 2:
-            continue  # 跳过没有足够层级的目录
-
+    if store_dir is not None:
+        zoom_levels = list_level_stores(store_dir)
+    else:
         try:
-            group = int(parts[0])  # 第二层级 group
-            index_x = int(parts[1])  # index_x
-        except ValueError:
-            continue  # 跳过非数字目录
-
-        for file in files:
-            if file.endswith('.npy'):
-                try:
-                    # 提取文件名中的 index_y
-                    index_y = int(file.replace('.npy', ''))
-                    npy_tiles.setdefault(group, []).append(
-                        (index_x, index_y, os.path.join(root, file))
-                    )
-                except ValueError:
-                    continue
+            zoom_levels = sorted((int(entry.name) for entry in os.scandir(npy_dir) if entry.name.isdigit()),
+                                 reverse=True)
+        except FileNotFoundError:
+            zoom_levels = []
+    if zoom_range is not None:
+        zoom_levels = [z for z in zoom_levels if zoom_range[0] <= z <= zoom_range[1]]
+
+    # 各等级需要渲染的瓦片, 按x列分组
+    npy_tiles = {}
+    if isinstance(publisher, TilePublisher) and publisher.delete_scope is None:
+        # 只在本次渲染的等级和范围内删除没有发布的瓦片, 没有渲染任何等级时不删除
+        publisher.delete_scope = {}
+    for zoom_level in zoom_levels:
+        ranges = []
+        if bbox is not None:
+            ranges.append(bbox_tile_range(bbox, zoom_level))
+        if tile_range is not None:
+            ranges.append(scale_tile_range(tile_range, zoom_level))
+        level_range = None
+        if ranges:
+            level_range = (max(r[0] for r in ranges), max(r[1] for r in ranges),
+                           min(r[2] for r in ranges), min(r[3] for r in ranges))
+            if level_range[0] > level_range[2] or level_range[1] > level_range[3]:
+                continue
+        if store_dir is not None:
+            store = LevelStore(store_dir, zoom_level, mode='r')
+            columns = {}
+            for index_x, index_y in store.keys():
+                if level_range is None or (level_range[0] <= index_x <= level_range[2]
+                                           and level_range[1] <= index_y <= level_range[3]):
+                    columns.setdefault(index_x, []).append((index_y, store.path))
+        else:
+            columns = _list_npy_tiles(npy_dir, zoom_level, level_range)
+        if columns:
+            npy_tiles[zoom_level] = columns
+        if isinstance(publisher, TilePublisher):
+            publisher.limit_deletion(zoom_level, level_range)
 
     if not npy_tiles:
         print("未找到npy数据！")
         return
 
-    for zoom_level in npy_tiles.keys():
-        for npy_info in tqdm(zip(npy_tiles[zoom_level]), desc=f"Regenerate zoom-{zoom_level} PNG"):
-            index_x, index_y, npy_file = npy_info[0]
-            data = np.load(npy_file)
-            norm_tile_data = normalize(data, statistic_dict, stretch_method=stretch_method)
-            png_file = f"{png_dir}/{zoom_level}/{index_x}/{index_y}.png"
-            Path(png_file).parent.mkdir(parents=True, exist_ok=True)
-            array_to_png(norm_tile_data, png_file, cmap=cmap, customized_cmap=customized_cmap, selected_channels=selected_channels)
+    schemes = [(png_dir, stretch_method, cmap, customized_cmap)] + list(variants or [])
+    renderers = [TileRenderer(statistic_dict, scheme_stretch, cmap=scheme_cmap, customized_cmap=scheme_customized_cmap,
+                              selected_channels=selected_channels, encoder=encoder)
+                 for _, scheme_stretch, scheme_cmap, scheme_customized_cmap in schemes]
+    png_dirs = [scheme[0] for scheme in schemes]
+    counts = [{'rendered': 0, 'empty': 0, 'uniform': 0} for _ in schemes]
+
+    def collect(result):
+        column_counts, png_files, sink_tiles = result
+        for total, column in zip(counts, column_counts):
+            for key in total:
+                total[key] += column[key]
+        if publisher is not None:
+            for png_file in png_files:
+                publisher(png_file)
+        for tile in sink_tiles or []:
+            tile_sink.put(*tile)
+
+    if num_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(renderers, png_dirs))
+    else:
+        _init_worker(renderers, png_dirs)
+    try:
+        for zoom_level, columns in npy_tiles.items():
+            tasks = [(zoom_level, index_x, tiles, tile_sink is not None) for index_x, tiles in columns.items()]
+            results = executor.map(_render_column, tasks) if num_workers > 1 else map(_render_column, tasks)
+            for result in tqdm(results, total=len(tasks), desc=f"Regenerate zoom-{zoom_level} PNG"):
+                collect(result)
+    finally:
+        if num_workers > 1:
+            executor.shutdown()
+    for scheme, scheme_counts in zip(schemes[1:], counts[1:]):
+        logging.info(f"Variant {scheme[0]} ({scheme[1]}, {scheme[2] or 'customized'}): {scheme_counts}")
+    return counts[0]
 
 
 
@@ -73,10 +239,36 @@ if __name__ == '__main__':
     cmap = "Greens"
     customized_cmap = None
     stretch_method = "linear-stretch"
+    # 按等级存储的瓦片目录(主程序level_store=True时为<data_dir>/STORE), 为空时遍历npy_dir
+    store_dir = ''
+    # 只重新生成部分等级和范围, 为None时生成全部; 如 zoom_range=(5, 8), bbox=(73, 18, 135, 54)
+    zoom_range = None
+    bbox = None
+    # 同时生成的其他调色方案, 如 [(os.path.join(data_dir, 'PNG_02-98'), '02-98', 'Greens', None)]
+    variants = []
+    num_workers = 8
     print(f"Stretching method: {stretch_method}")
-    statistic_json = load_json(os.path.join(data_dir, "statistics.json"))
-    regenerate_png(npy_dir, png_dir, statistic_json, stretch_method=stretch_method, selected_channels=selected_channels, cmap=cmap, customized_cmap=customized_cmap)
+    # 瓦片上传目录, 为空时不上传; 按发布清单只上传内容变化的瓦片
+    oss_upload_url = ''
+    publisher = None
+    if oss_upload_url:
+        from config_save import upload_bucket
+        manifest = PublishManifest(os.path.join(data_dir, 'publish_manifest.json'))
+        publisher = TilePublisher(upload_bucket, oss_upload_url, manifest=manifest, delete_missing=False)
 
-    # Validate
-    plot_tiles_recursive(data_dir=png_dir, output_dir=os.path.join(data_dir, stretch_method))
+    # 单文件瓦片包(.mbtiles或.pak), 为空时逐个写png文件
+    archive_file = ''
+    tile_sink = open_tile_sink(archive_file) if archive_file else None
 
+    statistic_json = load_json(os.path.join(data_dir, "statistics.json"))
+    counts = regenerate_png(npy_dir, png_dir, statistic_json, stretch_method=stretch_method, selected_channels=selected_channels, cmap=cmap, customized_cmap=customized_cmap,
+                   publisher=publisher, tile_sink=tile_sink, store_dir=store_dir or None, zoom_range=zoom_range,
+                   bbox=bbox, variants=variants, num_workers=num_workers)
+    print(f"Tiles rendered/empty/uniform: {counts}")
+    if publisher is not None:
+        print(f"Upload to OSS {oss_upload_url}: {publisher.close()}")
+    if tile_sink is not None:
+        print(f"Tile archive {archive_file}: {tile_sink.close()}")
+    else:
+        # Validate
+        plot_tiles_recursive(data_dir=png_dir, output_dir=os.path.join(data_dir, stretch_method))
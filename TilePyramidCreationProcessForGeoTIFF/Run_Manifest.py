@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+from Tile_Registry import TileRegistry
+
+
+class RunManifest:
+    '''
+    运行清单: 以只追加的jsonl日志记录已完成的输入文件和阶段, 每条记录写入后立即fsync,
+    进程中断时最多丢失正在写的最后一行(读取时忽略)。重新运行时按日志恢复瓦片注册表、跳过已完成的阶段。
+    记录格式:
+    --{'stage': 'config', ...}: 运行参数, 恢复时参数不一致则报错
+    --{'stage': 'ingest', 'files': [...], 'fragments': [[z, x, y, path], ...]}: 一批输入文件切片完成及其瓦片碎片
+    --{'stage': 'merge', 'zoom': z}: 合并瓦片和统计完成
+    --{'stage': 'level', 'zoom': z}: 该等级瓦片(npy/png)全部生成
+    --{'stage': 其他阶段名}: 如上传
+    '''
+
+    def __init__(self, path, resume=False):
+        '''
+        Args:
+            path: 清单文件(.jsonl)
+            resume: True时读取已有记录继续运行, False时清空重新开始
+        '''
+        self.path = path
+        self.events = []
+        truncated = False
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # 中断时未写完的行
+                        logging.warning(f"Skip truncated record in {path}")
+                        truncated = True
+                        break
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        if truncated:
+            # 去掉未写完的行, 先写临时文件再替换
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                for event in self.events:
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            os.replace(f'{path}.tmp', path)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def record(self, stage, **fields):
+        '''
+        追加一条记录并落盘
+        '''
+        event = {'stage': stage, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        event.update(fields)
+        self._file.write(json.dumps(event, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.events.append(event)
+        return event
+
+    def check_config(self, **config):
+        '''
+        第一次运行时记录参数; 恢复运行时参数必须与记录一致, 否则中间结果不能复用
+        '''
+        for event in self.events:
+            if event['stage'] == 'config':
+                recorded = {key: event.get(key) for key in config}
+                if recorded != config:
+                    raise ValueError(f"{self.path} was recorded with {recorded}, got {config}; "
+                                     f"rerun with resume=False")
+                return
+        self.record('config', **config)
+
+    def done(self, stage, **match):
+        '''
+        是否已有该阶段(且字段一致)的记录
+        '''
+        return any(event['stage'] == stage and all(event.get(key) == value for key, value in match.items())
+                   for event in self.events)
+
+    def done_files(self):
+        return {fn for event in self.events if event['stage'] == 'ingest' for fn in event['files']}
+
+    def done_levels(self):
+        return {event['zoom'] for event in self.events if event['stage'] == 'level'}
+
+    def record_ingest(self, files, registry):
+        '''
+        记录一批输入文件已切片, 以及它们登记到注册表的碎片(按登记顺序)
+
+        Args:
+            files: 输入文件名称list
+            registry: 这批文件的瓦片注册表(Tile_Registry.TileRegistry)
+        '''
+        fragments = [[*record.key, fragment] for record in registry for fragment in record.fragments]
+        return self.record('ingest', files=list(files), fragments=fragments)
+
+    def replay_registry(self, registry):
+        '''
+        按记录顺序把已完成文件的碎片重新登记到registry, 与不中断运行时的登记顺序一致
+        '''
+        for event in self.events:
+            if event['stage'] == 'ingest':
+                for z, x, y, fragment in event['fragments']:
+                    registry.add_fragment((z, x, y), fragment)
+        return registry
+
+    def resume_level(self, max_zoom):
+        '''
+        从max_zoom开始连续完成的最小等级, 下一次从其上一级继续生成; 没有完成的等级时返回None
+        '''
+        levels = self.done_levels()
+        zoom_level = max_zoom
+        while zoom_level in levels:
+            zoom_level -= 1
+        return zoom_level + 1 if zoom_level < max_zoom else None
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IngestBatch:
+    '''
+    成批记录已切片的输入文件: 每batch_size个文件flush一次LevelStore再记录这批文件, 而不是每个文件都flush
+    (flush重写整个索引, 逐文件flush的开销为 文件数x瓦片数)。清单中的文件对应的数据总是已经落盘,
+    中断后续跑时最多重新处理一批文件
+    '''
+
+    def __init__(self, run_manifest, store=None, batch_size=64):
+        '''
+        Args:
+            run_manifest: RunManifest
+            store: Level_Store.LevelStore, 为None时瓦片直接写入npy文件, 不需要flush
+            batch_size: 每批文件数
+        '''
+        self.run_manifest = run_manifest
+        self.store = store
+        self.batch_size = batch_size
+        self.files = []
+        self.registry = TileRegistry()
+
+    def add(self, fn, file_registry):
+        '''
+        登记一个切片完成的文件及其瓦片注册表, 攒满一批时提交
+        '''
+        self.files.append(fn)
+        self.registry.extend(file_registry)
+        if len(self.files) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        '''
+        flush存储并记录当前批次的文件, 输入文件处理完后调用一次提交剩余的文件
+        '''
+        if not self.files:
+            return
+        if self.store is not None:
+            self.store.flush()
+        self.run_manifest.record_ingest(self.files, self.registry)
+        self.files = []
+        self.registry = TileRegistry()
@@ -1,9 +1,345 @@
-from utils import load_json, save_json, get_dataset_name
+from utils import save_json, get_dataset_name
+from Tile_Registry import TileRegistry, registry_file
+from Level_Store import load_tile
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 
-def statistical_analysis(data_dir, npy_dir, max_zoom=None, sds_name=None, contact_info="", nodata_value=None):
+def _covering_grid(extents, bins, min_exponent=None):
+    '''
+    找到能容纳所有非空箱的最细分箱网格。网格的箱宽为2^exponent, 第i个箱对应 [(start + i) * 2^exponent, (start + i + 1) * 2^exponent),
+    不同网格的箱边界是对齐的, 粗化网格(exponent加1)时相邻两个箱合并为一个, 因此不同范围的直方图可以精确合并
+
+    Args:
+        extents: [(exponent, 第一个非空箱的绝对序号, 最后一个非空箱的绝对序号), ...]
+        bins: 分箱数
+        min_exponent: exponent的下限
+
+    Returns:
+        exponent, start
+    '''
+    exponent = max(extent[0] for extent in extents)
+    if min_exponent is not None:
+        exponent = max(exponent, min_exponent)
+    while True:
+        low = min(first >> (exponent - e) for e, first, _ in extents)
+        high = max(last >> (exponent - e) for e, _, last in extents)
+        if high - low < bins:
+            return exponent, low
+        exponent += 1
+
+
+def _rebin(hist, exponent, start, new_exponent, new_start):
+    # 把直方图转换到更粗(或相同)的网格上
+    nonzero = np.flatnonzero(hist)
+    index = ((start + nonzero.astype(np.int64)) >> (new_exponent - exponent)) - new_start
+    rebinned = np.zeros(len(hist), dtype=np.int64)
+    np.add.at(rebinned, index, hist[nonzero])
+    return rebinned
+
+
+class StreamingStatistics:
+    '''
+    单遍流式统计引擎, 按通道累计:
+    --Welford 均值/方差 (count, mean, M2), 可精确合并, 得到全局均值和标准差
+    --精确的全局最大值/最小值
+    --分箱直方图, 得到全局分位数。箱宽为2的整数次幂, 范围由数据决定: 每个通道的网格覆盖已出现的取值范围,
+      新数据超出范围时把网格粗化一倍(相邻两个箱合并)直到覆盖, 因此箱宽不超过取值范围/(bins/2)。
+      整型数据的箱宽至少为1, 取值范围不超过bins时(如int16)分位数是精确的; 浮点数据(如NDVI)的分位数误差不超过一个箱宽
+
+    各部分状态可以通过merge合并, 因此可以按瓦片增量计算, 也可以多进程分块计算后合并;
+    subtract从全局状态中去掉一部分像素(如增量更新时被替换的瓦片), 状态可以save/load保存。
+    与原统计方法一致, nodata值和0值不参与统计。
+    '''
+
+    def __init__(self, nodata_value=None, bins=65536):
+        '''
+        Args:
+            nodata_value: Nodata值
+            bins: 每个通道直方图的分箱数
+        '''
+        self.nodata_value = nodata_value
+        self.bins = int(bins)
+        self.channels = 0
+        self.count = self.mean = self.m2 = self.min = self.max = self.hist = None
+        self.exponent = self.start = None
+
+    def _init_channels(self, channels):
+        self.channels = channels
+        self.count = np.zeros(channels, dtype=np.int64)
+        self.mean = np.zeros(channels, dtype=np.float64)
+        self.m2 = np.zeros(channels, dtype=np.float64)
+        self.min = np.full(channels, np.inf)
+        self.max = np.full(channels, -np.inf)
+        self.hist = np.zeros((channels, self.bins), dtype=np.int64)
+        # 各通道直方图网格: 箱宽2^exponent, 第一个箱的左边界为start * 2^exponent
+        self.exponent = np.zeros(channels, dtype=np.int64)
+        self.start = np.zeros(channels, dtype=np.int64)
+
+    def _merge_hist(self, n, exponent, start, hist, sign=1):
+        # 把另一个网格上的直方图加到(sign=-1时减去)第n个通道, 必要时粗化当前网格
+        nonzero = np.flatnonzero(hist)
+        if len(nonzero) == 0:
+            return
+        extents = [(int(exponent), int(start + nonzero[0]), int(start + nonzero[-1]))]
+        own = np.flatnonzero(self.hist[n])
+        if len(own):
+            extents.append((int(self.exponent[n]), int(self.start[n] + own[0]), int(self.start[n] + own[-1])))
+        new_exponent, new_start = _covering_grid(extents, self.bins)
+        if len(own):
+            self.hist[n] = _rebin(self.hist[n], self.exponent[n], self.start[n], new_exponent, new_start)
+        self.exponent[n], self.start[n] = new_exponent, new_start
+        self.hist[n] += sign * _rebin(hist, exponent, start, new_exponent, new_start)
+
+    def _merge_channel(self, n, count, mean, m2, min_value, max_value, exponent, start, hist):
+        # Chan et al. 并行合并公式
+        total = self.count[n] + count
+        if count == 0:
+            return
+        delta = mean - self.mean[n]
+        self.mean[n] += delta * count / total
+        self.m2[n] += m2 + delta * delta * self.count[n] * count / total
+        self.count[n] = total
+        self.min[n] = min(self.min[n], min_value)
+        self.max[n] = max(self.max[n], max_value)
+        self._merge_hist(n, exponent, start, hist)
+
+    def update(self, tile_data):
+        '''
+        累计一个瓦片的统计值
+
+        Args:
+            tile_data: 瓦片数据, shape为(height, width, channel), 不含alpha通道
+        '''
+        if self.count is None:
+            self._init_channels(tile_data.shape[-1])
+        # 整型数据的箱宽至少为1, 使每个整数落在单独的箱中
+        min_exponent = 0 if np.issubdtype(tile_data.dtype, np.integer) else None
+
+        for n in range(tile_data.shape[-1]):
+            values = tile_data[:, :, n]
+            valid = (values != 0) & ~np.isnan(values)
+            if self.nodata_value is not None:
+                valid &= values != self.nodata_value
+            values = values[valid].astype(np.float64, copy=False)
+            if values.size == 0:
+                continue
+
+            mean = values.mean()
+            m2 = np.square(values - mean).sum()
+            min_value, max_value = values.min(), values.max()
+            # 先在覆盖该瓦片取值范围的最细网格上分箱, 合并时再对齐到全局网格
+            # (exponent不小于最大绝对值的指数-40, 保证箱序号不会溢出int64)
+            exponent = int(np.frexp(max(abs(min_value), abs(max_value)))[1]) - 40
+            if max_value > min_value:
+                exponent = max(exponent, int(np.frexp((max_value - min_value) / self.bins)[1]))
+            if min_exponent is not None:
+                exponent = max(exponent, min_exponent)
+            width = np.ldexp(1.0, exponent)
+            first, last = int(np.floor(min_value / width)), int(np.floor(max_value / width))
+            exponent, start = _covering_grid([(exponent, first, last)], self.bins)
+            index = np.floor(values / np.ldexp(1.0, exponent)).astype(np.int64) - start
+            hist = np.bincount(index, minlength=self.bins)
+            self._merge_channel(n, values.size, mean, m2, min_value, max_value, exponent, start, hist)
+
+    def merge(self, other):
+        '''
+        合并另一个StreamingStatistics的状态 (分箱数必须一致, 网格不同时自动对齐)
+        '''
+        if other.count is None:
+            return self
+        if other.bins != self.bins:
+            raise ValueError("Cannot merge StreamingStatistics with different histogram bins")
+        if self.count is None:
+            self._init_channels(other.channels)
+        for n in range(other.channels):
+            self._merge_channel(n, other.count[n], other.mean[n], other.m2[n], other.min[n], other.max[n],
+                                other.exponent[n], other.start[n], other.hist[n])
+        return self
+
+    def subtract(self, other):
+        '''
+        从当前状态中去掉other的像素(other必须是当前状态的一部分), merge的逆运算。
+        计数、均值、方差和直方图是精确的; 最大值/最小值无法精确还原, 被去掉的部分包含最值时改用直方图中非空箱的边界
+        (整型数据且箱宽为1时仍是精确的; 保留了各部分精确最值的调用方应自行重建, 如Incremental_Update)
+        '''
+        if other.count is None:
+            return self
+        if other.bins != self.bins:
+            raise ValueError("Cannot subtract StreamingStatistics with different histogram bins")
+        for n in range(other.channels):
+            count = other.count[n]
+            if count == 0:
+                continue
+            total = self.count[n] - count
+            if total <= 0:
+                self.count[n], self.mean[n], self.m2[n] = 0, 0.0, 0.0
+                self.min[n], self.max[n] = np.inf, -np.inf
+                self.hist[n] = 0
+                continue
+            mean = (self.mean[n] * self.count[n] - other.mean[n] * count) / total
+            delta = other.mean[n] - mean
+            self.m2[n] = max(self.m2[n] - other.m2[n] - delta * delta * total * count / self.count[n], 0.0)
+            self.mean[n] = mean
+            self.count[n] = total
+            self._merge_hist(n, other.exponent[n], other.start[n], other.hist[n], sign=-1)
+            nonzero = np.flatnonzero(self.hist[n])
+            width = np.ldexp(1.0, int(self.exponent[n]))
+            if other.min[n] <= self.min[n]:
+                self.min[n] = (self.start[n] + nonzero[0]) * width
+            if other.max[n] >= self.max[n]:
+                # 单位宽度的箱对应一个整数值, 否则取箱的上边界
+                upper = nonzero[-1] if width == 1 else nonzero[-1] + 1
+                self.max[n] = (self.start[n] + upper) * width
+        return self
+
+    def save(self, filename):
+        '''
+        以npz格式保存累计状态, 增量更新时由load恢复
+        '''
+        with open(f'{filename}.tmp', 'wb') as f:
+            np.savez_compressed(f, nodata_value=np.array(np.nan if self.nodata_value is None else self.nodata_value),
+                                bins=np.array(self.bins), count=self.count, mean=self.mean, m2=self.m2,
+                                min=self.min, max=self.max, exponent=self.exponent, start=self.start, hist=self.hist)
+        os.replace(f'{filename}.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as state:
+            nodata_value = state['nodata_value'].item()
+            statistics = cls(nodata_value=None if np.isnan(nodata_value) else nodata_value, bins=int(state['bins']))
+            statistics._init_channels(len(state['count']))
+            for name in ('count', 'mean', 'm2', 'min', 'max', 'hist'):
+                getattr(statistics, name)[...] = state[name]
+            if 'exponent' in state:
+                statistics.exponent[...] = state['exponent']
+                statistics.start[...] = state['start']
+            else:
+                # 旧版本的状态: 固定范围value_range, 箱宽必须是2的整数次幂
+                low, high = state['value_range'].tolist()
+                mantissa, exponent = np.frexp((high - low) / statistics.bins)
+                if mantissa != 0.5 or low % np.ldexp(1.0, int(exponent) - 1) != 0:
+                    raise ValueError(f"Cannot convert histogram range {low}-{high} of {filename}")
+                statistics.exponent[...] = exponent - 1
+                statistics.start[...] = int(low / np.ldexp(1.0, int(exponent) - 1))
+        return statistics
+
+    def _bin_value(self, n, index):
+        width = np.ldexp(1.0, int(self.exponent[n]))
+        value = (self.start[n] + index) * width
+        if width != 1:
+            value += width / 2
+        return min(max(value, self.min[n]), self.max[n])
+
+    def quantile(self, n, q):
+        '''
+        由直方图计算第n个通道的分位数, 插值方式与np.percentile默认的linear一致
+
+        Args:
+            n: 通道序号
+            q: 分位数, 取值[0, 1]
+        '''
+        if self.count is None or self.count[n] == 0:
+            return 0.0
+        cumsum = np.cumsum(self.hist[n])
+        position = q * (self.count[n] - 1)
+        low, high = int(np.floor(position)), int(np.ceil(position))
+        low_value = self._bin_value(n, np.searchsorted(cumsum, low, side='right'))
+        high_value = self._bin_value(n, np.searchsorted(cumsum, high, side='right'))
+        return float(low_value + (high_value - low_value) * (position - low))
+
+    def summary(self):
+        '''
+        Returns:
+            各通道的max/min/mean/std/75%/25%/98%/02%, 无有效值的通道填0
+        '''
+        channels = range(self.channels)
+        valid = [self.count is not None and self.count[n] > 0 for n in channels]
+        return {
+            'max': [float(self.max[n]) if valid[n] else 0 for n in channels],
+            'min': [float(self.min[n]) if valid[n] else 0 for n in channels],
+            'mean': [float(self.mean[n]) if valid[n] else 0 for n in channels],
+            'std': [float(np.sqrt(self.m2[n] / self.count[n])) if valid[n] else 0 for n in channels],
+            '75%': [self.quantile(n, 0.75) for n in channels],
+            '25%': [self.quantile(n, 0.25) for n in channels],
+            '98%': [self.quantile(n, 0.98) for n in channels],
+            '02%': [self.quantile(n, 0.02) for n in channels],
+        }
+
+
+def tile_statistics(statistics, tile_data, record):
+    '''
+    把一个瓦片的统计值并入statistics, 并返回该瓦片单独的统计信息
+
+    Args:
+        statistics: 全局StreamingStatistics
+        tile_data: 瓦片数据(含alpha通道)
+        record: 瓦片信息(Tile_Registry.TileRecord)
+
+    Returns:
+        statis_dict: 该瓦片的统计信息
+    '''
+    tile_stats = StreamingStatistics(statistics.nodata_value, statistics.bins)
+    tile_stats.update(tile_data[:, :, :-1])
+    statistics.merge(tile_stats)
+
+    key = record.current_index
+    statis_dict = {key: {'data_dir': record.data_dir,
+                         'current_index': key,
+                         'current_level': record.current_level}}
+    statis_dict[key].update(tile_stats.summary())
+    return statis_dict
+
+
+def _analyse_tiles(args):
+    records, nodata_value = args
+    statistics = StreamingStatistics(nodata_value=nodata_value)
+    statis_dict_list = []
+    for record in records:
+        tile_data = load_tile(record)
+        statis_dict_list.append(tile_statistics(statistics, tile_data, record))
+    return statistics, statis_dict_list
+
+
+def statistics_state_file(data_dir):
+    return os.path.join(data_dir, 'statistics_state.npz')
+
+
+def save_statistics(data_dir, npy_dir, statistics, statis_dict_list, max_zoom=None, sds_name=None, contact_info=""):
+    '''
+    由StreamingStatistics生成statistics.json
+
+    Args:
+        data_dir: 输出数据存储主目录
+        npy_dir: 输出数据NPY文件存储目录
+        statistics: 全局StreamingStatistics
+        statis_dict_list: 各瓦片的统计信息
+        max_zoom: 最大瓦片等级
+        sds_name: 数据集名称
+        contact_info: 数据集处理人员
+
+    Returns:
+        statistic_dict: 统计值字典
+    '''
+    statistic_dict = {}
+    statistic_dict["dataset_name"] = get_dataset_name(sds_name)
+    statistic_dict["contact"] = contact_info
+    statistic_dict["nums"] = len(statis_dict_list)  # 瓦片数量
+    statistic_dict["npy_dir"] = npy_dir
+    statistic_dict["max_zoom"] = max_zoom
+    statistic_dict.update(statistics.summary())
+    statistic_dict["statistics"] = statis_dict_list
+
+    save_json(statistic_dict, os.path.join(data_dir, "statistics.json"))
+    if statistics.count is not None:
+        # 累计状态, 增量更新(Incremental_Update)时在此基础上增减瓦片
+        statistics.save(statistics_state_file(data_dir))
+    return statistic_dict
+
+
+def statistical_analysis(data_dir, npy_dir, max_zoom=None, sds_name=None, contact_info="", nodata_value=None,
+                         num_workers=1):
     '''
     遍历npy文件最大瓦片级数, 得到图像像素的统计信息, 归一化时使用。统计信息包括:
     --max, 最大值
@@ -15,6 +351,9 @@ def statistical_analysis(data_dir, npy_dir, max_zoom=None, sds_name=None, contac
     --25%, 从小到大排列, 25%的截断点
     --75%, 从小到大排列, 75%的截断点
 
+    全局统计值由StreamingStatistics单遍累计得到: 最值、均值、标准差是全部像素的精确值,
+    分位数来自全局直方图, 而不是各瓦片分位数的中位数
+
     注意: 该函数按通道来进行计算, 因此三通道的npy文件会得到例如: max=[1,5,10], 表示三个通道分别最大值
     Args:
         data_dir: 输出数据存储主目录
@@ -23,104 +362,33 @@ def statistical_analysis(data_dir, npy_dir, max_zoom=None, sds_name=None, contac
         sds_name: 数据集名称
         contact_info: 数据集处理人员
         nodata_value: Nodata值
+        num_workers: 进程数, 大于1时分块并行统计后合并
 
     Returns:
         statistic_dict: 统计值字典，包含总体统计信息和各瓦片(npy)的统计信息
 
     '''
-    json_file = os.path.join(data_dir, f'merged_base_tile_index_list_zoom-{max_zoom}.json')
-    tile_dict_list = load_json(json_file)
-    statistic_dict = {}
-    statistic_dict["dataset_name"] = get_dataset_name(sds_name)
-    statistic_dict["contact"] = contact_info
-    statistic_dict["nums"] = len(tile_dict_list)  # 瓦片数量
-    statistic_dict["npy_dir"] = npy_dir
-    statistic_dict["max_zoom"] = max_zoom
-
-    _max_list, _min_list, _mean_list, _std_list = [], [], [], []
-    _25_list, _75_list, _02_list, _98_list = [], [], [], []
-    statis_dict_list = []
-    for tile_dict in tile_dict_list:
-        _max, _min, _mean, _std = [], [], [], []
-        _25, _75, _02, _98 = [], [], [], []
-        statis_dict = {}
-
-        for key, value in tile_dict.items():
-            tile_data = np.load(value['data_dir'])[:, :, :-1]
-            statis_dict[key] = {}
-            tile_data[tile_data == nodata_value] = 0
-
-            for n in range(tile_data.shape[-1]):
-                # 获取非零值的掩码
-                non_zero_values = tile_data[:, :, n][tile_data[:, :, n] != 0]
-
-                # 只有当非零值存在时才计算统计值
-                if non_zero_values.size > 0:
-                    _max.append(np.max(non_zero_values))
-                    _min.append(np.min(non_zero_values))
-                    _mean.append(np.mean(non_zero_values))
-                    _std.append(np.std(non_zero_values))
-
-                    _25.append(np.percentile(non_zero_values, 25))
-                    _75.append(np.percentile(non_zero_values, 75))
-                    _02.append(np.percentile(non_zero_values, 2))
-                    _98.append(np.percentile(non_zero_values, 98))
-                else:
-                    # 如果没有非零值，填充默认值，例如 np.nan 或 0
-                    _max.append(0)
-                    _min.append(0)
-                    _mean.append(0)
-                    _std.append(0)
-                    _25.append(0)
-                    _75.append(0)
-                    _02.append(0)
-                    _98.append(0)
-
-            statis_dict[key]['data_dir'] = value['data_dir']
-            statis_dict[key]['current_index'] = value['current_index']
-            statis_dict[key]['current_level'] = value['current_level']
-
-            statis_dict[key]['max'] = _max
-            statis_dict[key]['min'] = _min
-            statis_dict[key]['mean'] = _mean
-            statis_dict[key]['std'] = _std
-            statis_dict[key]['75%'] = _75
-            statis_dict[key]['25%'] = _25
-            statis_dict[key]['98%'] = _98
-            statis_dict[key]['02%'] = _02
-
-        statis_dict_list.append(statis_dict)
-
-        _max_list.append(_max)
-        _min_list.append(_min)
-        _mean_list.append(_mean)
-        _std_list.append(_std)
-        _25_list.append(_25)
-        _75_list.append(_75)
-        _02_list.append(_02)
-        _98_list.append(_98)
-
-    statistic_dict["mean"] = list(np.mean(_mean_list, axis=0))
-    statistic_dict["std"] = list(np.mean(_std_list, axis=0))
-    statistic_dict["max"] = list(np.max(_max_list, axis=0))
-    statistic_dict["min"] = list(np.min(_min_list, axis=0))
-    statistic_dict["75%"] = list(np.median(_75_list, axis=0))
-    statistic_dict["25%"] = list(np.median(_25_list, axis=0))
-    statistic_dict["98%"] = list(np.median(_98_list, axis=0))
-    statistic_dict["02%"] = list(np.median(_02_list, axis=0))
+    records = TileRegistry.load(registry_file(data_dir, max_zoom)).records()
 
-    statistic_dict["statistics"] = statis_dict_list
-
-    save_json(statistic_dict, os.path.join(data_dir, "statistics.json"))
-    return statistic_dict
+    if num_workers > 1:
+        chunk_size = max(1, len(records) // (num_workers * 4) + 1)
+        chunks = [(records[i:i + chunk_size], nodata_value) for i in range(0, len(records), chunk_size)]
+        statistics = StreamingStatistics(nodata_value=nodata_value)
+        statis_dict_list = []
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for partial_statistics, partial_list in executor.map(_analyse_tiles, chunks):
+                statistics.merge(partial_statistics)
+                statis_dict_list.extend(partial_list)
+    else:
+        statistics, statis_dict_list = _analyse_tiles((records, nodata_value))
 
+    return save_statistics(data_dir, npy_dir, statistics, statis_dict_list, max_zoom=max_zoom, sds_name=sds_name,
+                           contact_info=contact_info)
 
 if __name__ == '__main__':
     data_dir = '../Data/NDVI/'
     npy_dir = '../Data/NDVI/NPY/'
 
-    json_file = os.path.join(data_dir, 'merged_base_tile_index_list.json')
-    tile_dict_list = load_json(json_file)
     nodata_value = -32760
     statistic_dict = statistical_analysis(data_dir=data_dir, npy_dir=npy_dir, max_zoom=9, sds_name="NDVI Mean",
                                           nodata_value=nodata_value)
@@ -1,13 +1,104 @@
 import os
-from utils import get_bbox_from_geotiff, process_tile
+import time
+import logging
+from utils import get_bbox_from_geotiff, dataset_bbox, process_tile
 from aster_core.utils import bbox2bbox
 import numpy as np
 from aster_core.global_grid import GlobalRasterGrid
 from osgeo import gdal
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 
 
-def tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=100, tile_size=1024):
+class SceneReprojector:
+    '''
+    一景数据的重投影上下文: 源文件只打开一次, 建立一个与全局栅格像素对齐的WarpedVRT(epsg:3857),
+    各栅格由窗口读取(vrt.read(window=...))得到。坐标变换在各栅格之间共用, GDAL块缓存(GDAL_CACHEMAX)中
+    已读取的源数据块也被相邻栅格复用; 逐栅格调用process_tile时每个栅格都要重新打开文件、重新建立重投影。
+    重采样为最近邻, 源文件的nodata值按原值保留, 源文件范围外填0
+    '''
+
+    def __init__(self, tiff_file, global_grid, src_crs='epsg:4326', resampling=Resampling.nearest,
+                 cache_max=512 << 20):
+        '''
+        Args:
+            tiff_file: tiff文件路径
+            global_grid: 全局栅格(GlobalRasterGrid)
+            src_crs: tiff文件坐标系, 文件本身没有坐标系时使用
+            resampling: 重采样方法
+            cache_max: GDAL块缓存的字节数
+        '''
+        self.tiff_file = tiff_file
+        self.global_grid = global_grid
+        self.src_crs = src_crs
+        self.resampling = resampling
+        self.cache_max = cache_max
+        self.tile_index_list = []
+        self._env = self._src = self._vrt = None
+        self._offsets = {}
+
+    def __enter__(self):
+        self._env = rasterio.Env(GDAL_CACHEMAX=self.cache_max)
+        self._env.__enter__()
+        try:
+            self._src = rasterio.open(self.tiff_file)
+            self._build()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _build(self):
+        # 与tiff2tiles相同的方式得到相交的栅格, 不再另外打开文件读取范围
+        bbox_3857 = bbox2bbox(dataset_bbox(self._src), self.src_crs, 'epsg:3857')
+        self.tile_index_list = self.global_grid.get_tile_list(bbox_3857)
+        if not self.tile_index_list:
+            return
+        tile_size = self.global_grid.tile_size
+        transforms = {tile_index: self.global_grid.get_tile_geotransform(tile_index, affine_flag=True)
+                      for tile_index in self.tile_index_list}
+        # VRT的左上角为最左上的栅格, 覆盖全部相交栅格, 每个栅格即VRT中整像素偏移的一个窗口
+        pixel_x, pixel_y = next(iter(transforms.values())).a, next(iter(transforms.values())).e
+        origin_x = min(transform.c for transform in transforms.values())
+        origin_y = max(transform.f for transform in transforms.values())
+        self._offsets = {tile_index: (int(round((transform.c - origin_x) / pixel_x)),
+                                      int(round((transform.f - origin_y) / pixel_y)))
+                         for tile_index, transform in transforms.items()}
+        width = max(col for col, _ in self._offsets.values()) + tile_size
+        height = max(row for _, row in self._offsets.values()) + tile_size
+        self._vrt = WarpedVRT(self._src, src_crs=self._src.crs or self.src_crs, src_nodata=None, crs='epsg:3857',
+                              transform=Affine(pixel_x, 0, origin_x, 0, pixel_y, origin_y),
+                              width=width, height=height, nodata=0, resampling=self.resampling)
+
+    def read(self, tile_index):
+        '''
+        Returns:
+            栅格数据, shape为(channel_count, tile_size, tile_size); 栅格内没有数据时返回None
+        '''
+        col, row = self._offsets[tuple(tile_index)]
+        tile_size = self.global_grid.tile_size
+        data = self._vrt.read(window=Window(col, row, tile_size, tile_size))
+        if not data.any():
+            return None
+        return data
+
+    def close(self):
+        for handle in (self._vrt, self._src):
+            if handle is not None:
+                handle.close()
+        self._vrt = self._src = None
+        if self._env is not None:
+            self._env.__exit__(None, None, None)
+            self._env = None
+
+
+def tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=100, tile_size=1024, shared_reprojection=False):
     '''
 
     Args:
@@ -15,21 +106,44 @@ def tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=100, tile_s
         tiles_dir: 栅格生成目录
         resolution: 栅格分辨率
         tile_size: 栅格尺寸
-        channel_count: tiff文件通道数
+        shared_reprojection: True时一景只打开一次并共用重投影(SceneReprojector), 否则逐栅格调用process_tile
 
     Returns:
         tile_name_list: 生成有效栅格文件名称
     '''
-    bbox = get_bbox_from_geotiff(tiff_file)
-    bbox_3857 = bbox2bbox(bbox, src_crs, 'epsg:3857')
-
     # Define the Grid in EPSG:3857
     global_grid = GlobalRasterGrid(resolution=resolution, tile_size=tile_size)
 
+    if shared_reprojection:
+        with SceneReprojector(tiff_file, global_grid, src_crs=src_crs) as scene:
+            return write_grid_tiles(scene.tile_index_list, scene.read, tiles_dir, global_grid, resolution, tile_size)
+
+    bbox = get_bbox_from_geotiff(tiff_file)
+    bbox_3857 = bbox2bbox(bbox, src_crs, 'epsg:3857')
+
     # Find the Intersect grid indexes
     tile_index_list = global_grid.get_tile_list(bbox_3857)
-    tile_name_list = []
     # Reproject the data from 4326 to 3857, and assign the grid array
+    return write_grid_tiles(tile_index_list, lambda tile_index: process_tile(tile_index, tiff_file, global_grid),
+                            tiles_dir, global_grid, resolution, tile_size)
+
+
+def write_grid_tiles(tile_index_list, read_tile, tiles_dir, global_grid, resolution, tile_size):
+    '''
+    逐个读取栅格数据并写入栅格文件, 文件已存在时保留已有的非0像素
+
+    Args:
+        tile_index_list: 栅格编号list
+        read_tile: 读取栅格数据的函数, read_tile(tile_index), 没有数据时返回None
+        tiles_dir: 栅格生成目录
+        global_grid: 全局栅格(GlobalRasterGrid)
+        resolution: 栅格分辨率
+        tile_size: 栅格尺寸
+
+    Returns:
+        tile_name_list: 生成有效栅格文件名称
+    '''
+    tile_name_list = []
     for tile_index in tile_index_list:
         tile_index_x, tile_index_y = tile_index
         fn = f"res-{resolution}_tilesize-{tile_size}_x-{tile_index_x}_y-{tile_index_y}.tiff"
@@ -37,7 +151,7 @@ def tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=100, tile_s
         tiles_file = os.path.join(tiles_dir, fn)
         tile_geotransform = global_grid.get_tile_geotransform((tile_index_x, tile_index_y), affine_flag=True)
         try:
-            data = process_tile(tile_index, tiff_file, global_grid)
+            data = read_tile(tile_index)
         except:
             continue
         if data is not None:
@@ -46,22 +160,62 @@ def tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=100, tile_s
             if os.path.exists(tiles_file):
                 data_exist = gdal.Open(tiles_file).ReadAsArray()
                 data = np.where(data_exist != 0, data_exist, data)
-            channel_count = data.shape[0]
-
-            # 保存为GeoTIFF
-            with rasterio.open(
-                    tiles_file,
-                    'w',
-                    driver='GTiff',
-                    height=tile_size,
-                    width=tile_size,
-                    count=channel_count,
-                    dtype=np.int16,
-                    crs="epsg:3857",
-                    transform=tile_geotransform,
-            ) as dst:
-                dst.write(data)
+            write_grid_tile(tiles_file, data, tile_geotransform)
 
             tile_name_list.append(fn)
 
     return tile_name_list
+
+
+def write_grid_tile(tiles_file, data, tile_geotransform):
+    '''
+    将栅格数据保存为epsg:3857的int16 GeoTIFF
+
+    Args:
+        tiles_file: 栅格文件路径
+        data: 栅格数据, shape为(channel_count, tile_size, tile_size)
+        tile_geotransform: 栅格的affine变换
+
+    '''
+    channel_count, height, width = data.shape
+
+    # 保存为GeoTIFF
+    with rasterio.open(
+            tiles_file,
+            'w',
+            driver='GTiff',
+            height=height,
+            width=width,
+            count=channel_count,
+            dtype=np.int16,
+            crs="epsg:3857",
+            transform=tile_geotransform,
+    ) as dst:
+        dst.write(data)
+
+
+if __name__ == '__main__':
+    # 对比逐栅格process_tile与共用重投影(shared_reprojection)的单景耗时, 30m分辨率下一景1°x1°的DEM约相交数十个栅格
+    tiff_file = '/home/data2/ASTWBD_TIFF/ASTGTMV003_N30E120_dem.tif'
+    benchmark_dir = '/home/data2/ASTGTM_tiny/TILES_benchmark'
+    resolution, tile_size = 30, 256
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = {}
+    for shared_reprojection in (False, True):
+        tiles_dir = os.path.join(benchmark_dir, 'shared' if shared_reprojection else 'per_tile')
+        os.makedirs(tiles_dir, exist_ok=True)
+        start = time.perf_counter()
+        tile_name_list = tiff2tiles(tiff_file, tiles_dir, src_crs='epsg:4326', resolution=resolution,
+                                    tile_size=tile_size, shared_reprojection=shared_reprojection)
+        results[shared_reprojection] = (tile_name_list, time.perf_counter() - start)
+        print(f"shared_reprojection={shared_reprojection}: {len(tile_name_list)} tiles, "
+              f"{results[shared_reprojection][1]:.2f}s")
+
+    # 两种方式生成的栅格逐个比较, 差异来自重采样/nodata处理的不同
+    for fn in set(results[True][0]) & set(results[False][0]):
+        with rasterio.open(os.path.join(benchmark_dir, 'per_tile', fn)) as src_a, \
+                rasterio.open(os.path.join(benchmark_dir, 'shared', fn)) as src_b:
+            diff = np.count_nonzero(src_a.read() != src_b.read())
+        if diff:
+            logging.info(f"{fn}: {diff} pixels differ")
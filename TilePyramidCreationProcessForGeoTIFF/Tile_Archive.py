@@ -0,0 +1,319 @@
+import os
+import struct
+import sqlite3
+import hashlib
+import numpy as np
+
+# 打包文件格式: MAGIC + 瓦片数据块 + 索引(keys/offsets/lengths) + FOOTER(索引位置, 瓦片数, MAGIC)
+MAGIC = b'TILEPAK1'
+FOOTER = struct.Struct('<QQ8s')
+# key = z << 48 | x << 24 | y, 支持到24级
+KEY_BITS = 24
+
+
+def tile_key(z, x, y):
+    return (z << (2 * KEY_BITS)) | (x << KEY_BITS) | y
+
+
+class TileCollector:
+    '''
+    子进程中代替瓦片包收集编码后的瓦片, 回传主进程后写入真正的瓦片包
+    '''
+
+    def __init__(self):
+        self.tiles = []
+
+    def put(self, z, x, y, data):
+        self.tiles.append((z, x, y, data))
+
+
+class PackedTileWriter:
+    '''
+    单文件瓦片包: 渲染好的瓦片按写入顺序追加到一个文件, 相同内容(md5)的瓦片只存一份,
+    关闭时写入按(z, x, y)排序的索引, PackedTileReader按偏移读取。
+    代替 PNG/{z}/{x}/{y}.png 的大量小文件, 上传时只有一个大对象
+    '''
+
+    def __init__(self, path):
+        '''
+        Args:
+            path: 瓦片包文件
+        '''
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._blobs = {}
+        self._index = {}
+        self.bytes_written = len(MAGIC)
+
+    def put(self, z, x, y, data):
+        '''
+        写入一个瓦片, 同一(z, x, y)重复写入时以最后一次为准
+
+        Args:
+            z, x, y: 瓦片index
+            data: 编码后的瓦片(如png字节)
+        '''
+        digest = hashlib.md5(data).digest()
+        location = self._blobs.get(digest)
+        if location is None:
+            location = (self._file.tell(), len(data))
+            self._file.write(data)
+            self._blobs[digest] = location
+            self.bytes_written += len(data)
+        self._index[tile_key(z, x, y)] = location
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        '''
+        写入索引并关闭文件
+
+        Returns:
+            metrics: {'tiles', 'unique_tiles', 'bytes'}
+        '''
+        if self._file.closed:
+            return self.metrics()
+        keys = np.array(sorted(self._index), dtype=np.uint64)
+        locations = np.array([self._index[int(key)] for key in keys], dtype=np.uint64).reshape(-1, 2)
+        index_offset = self._file.tell()
+        self._file.write(keys.tobytes())
+        self._file.write(locations[:, 0].tobytes())
+        self._file.write(locations[:, 1].astype(np.uint32).tobytes())
+        self._file.write(FOOTER.pack(index_offset, len(keys), MAGIC))
+        self._file.close()
+        return self.metrics()
+
+    def metrics(self):
+        # 被覆盖的瓦片内容仍留在文件中, 只统计索引引用的内容
+        return {'tiles': len(self._index), 'unique_tiles': len(set(self._index.values())), 'bytes': self.bytes_written}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedTileReader:
+    '''
+    读取PackedTileWriter生成的瓦片包, 索引常驻内存, 瓦片按偏移读取
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, count, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tile archive")
+        self.keys = np.fromfile(path, dtype=np.uint64, count=count, offset=index_offset)
+        self.offsets = np.fromfile(path, dtype=np.uint64, count=count, offset=index_offset + 8 * count)
+        self.lengths = np.fromfile(path, dtype=np.uint32, count=count, offset=index_offset + 16 * count)
+
+    def get(self, z, x, y):
+        '''
+        Returns:
+            瓦片字节, 不存在时返回None
+        '''
+        key = tile_key(z, x, y)
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i == len(self.keys) or int(self.keys[i]) != key:
+            return None
+        self._file.seek(int(self.offsets[i]))
+        return self._file.read(int(self.lengths[i]))
+
+    def tiles(self):
+        '''
+        按(z, x, y)顺序遍历所有瓦片index
+        '''
+        mask = (1 << KEY_BITS) - 1
+        for key in self.keys.tolist():
+            yield key >> (2 * KEY_BITS), (key >> KEY_BITS) & mask, key & mask
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MBTilesWriter:
+    '''
+    MBTiles(SQLite)瓦片包, 相同内容的瓦片在images表中只存一份(map + images + tiles视图)。
+    MBTiles规范的行号为TMS(自下而上), 写入时由XYZ的y换算 tile_row = 2^z - 1 - y
+    '''
+
+    def __init__(self, path, name='', tile_format='png', batch_size=1000, append=False):
+        '''
+        Args:
+            path: .mbtiles文件, 已存在时覆盖
+            name: 数据集名称, 写入metadata
+            tile_format: 瓦片格式, 写入metadata
+            batch_size: 每多少个瓦片提交一次事务
+            append: True时保留已有的瓦片包继续写入(中断后续跑)
+        '''
+        if os.path.exists(path) and not append:
+            os.remove(path)
+        self.path = path
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(path)
+        # 已提交的事务在进程中断后仍然有效, 续跑时只需重写未完成的等级
+        self._db.executescript('''
+            PRAGMA synchronous = OFF;
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                              PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        ''')
+        self._db.execute("DELETE FROM metadata WHERE name IN ('name', 'format')")
+        self._db.executemany('INSERT INTO metadata VALUES (?, ?)', [('name', name), ('format', tile_format)])
+        self._db.commit()
+        self._pending = 0
+        self._metrics = None
+
+    def put(self, z, x, y, data):
+        tile_id = hashlib.md5(data).hexdigest()
+        self._db.execute('INSERT OR IGNORE INTO images VALUES (?, ?)', (tile_id, sqlite3.Binary(data)))
+        self._db.execute('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', (z, x, (1 << z) - 1 - y, tile_id))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        提交已写入的瓦片
+        '''
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        '''
+        删除被覆盖后不再引用的瓦片内容, 写入等级范围
+
+        Returns:
+            metrics: {'tiles', 'unique_tiles', 'bytes'}
+        '''
+        if self._metrics is not None:
+            return self._metrics
+        self._db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT DISTINCT tile_id FROM map)')
+        min_zoom, max_zoom, tiles = self._db.execute('SELECT MIN(zoom_level), MAX(zoom_level), COUNT(*) FROM map').fetchone()
+        self._db.execute("DELETE FROM metadata WHERE name IN ('minzoom', 'maxzoom')")
+        if tiles:
+            self._db.executemany('INSERT INTO metadata VALUES (?, ?)', [('minzoom', str(min_zoom)), ('maxzoom', str(max_zoom))])
+        self._db.commit()
+        unique_tiles, = self._db.execute('SELECT COUNT(*) FROM images').fetchone()
+        self._db.close()
+        self._metrics = {'tiles': tiles, 'unique_tiles': unique_tiles, 'bytes': os.path.getsize(self.path)}
+        return self._metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MBTilesReader:
+    '''
+    按XYZ的(z, x, y)读取MBTiles中的瓦片
+    '''
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+    def tiles(self):
+        '''
+        按(z, x, y)顺序遍历所有瓦片index (XYZ)
+        '''
+        rows = self._db.execute('SELECT zoom_level, tile_column, tile_row FROM map')
+        for z, x, y in sorted((z, x, (1 << z) - 1 - row) for z, x, row in rows):
+            yield z, x, y
+
+    def get(self, z, x, y):
+        row = self._db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                               (z, x, (1 << z) - 1 - y)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_tile_sink(path, **kwargs):
+    '''
+    按后缀创建瓦片包: .mbtiles为MBTilesWriter, 其余为PackedTileWriter
+    '''
+    if path.endswith('.mbtiles'):
+        return MBTilesWriter(path, **kwargs)
+    return PackedTileWriter(path)
+
+
+def open_tile_archive(path):
+    '''
+    按后缀打开瓦片包读取
+    '''
+    if path.endswith('.mbtiles'):
+        return MBTilesReader(path)
+    return PackedTileReader(path)
+
+
+if __name__ == '__main__':
+    # 对比: 逐个写png小文件 与 写入单文件瓦片包 (含大量重复的空白瓦片)
+    import io
+    import time
+    import tempfile
+    from PIL import Image
+
+    def encode(rgba):
+        buffer = io.BytesIO()
+        Image.fromarray(rgba, mode='RGBA').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    # 60%为空白瓦片, 其余为各不相同的数据瓦片
+    rng = np.random.default_rng(0)
+    blank = encode(np.zeros((256, 256, 4), dtype=np.uint8))
+    tiles = {}
+    for x in range(64):
+        for y in range(64):
+            if rng.random() < 0.6:
+                tiles[(12, x, y)] = blank
+            else:
+                tiles[(12, x, y)] = encode(np.full((256, 256, 4), rng.integers(0, 255, 4), dtype=np.uint8))
+
+    tmp_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    for (z, x, y), data in tiles.items():
+        png_file = os.path.join(tmp_dir, 'PNG', str(z), str(x), f'{y}.png')
+        os.makedirs(os.path.dirname(png_file), exist_ok=True)
+        with open(png_file, 'wb') as f:
+            f.write(data)
+    print(f"loose png : {time.perf_counter() - start:6.2f} s, {len(tiles)} files")
+
+    for name in ('tiles.pak', 'tiles.mbtiles'):
+        path = os.path.join(tmp_dir, name)
+        start = time.perf_counter()
+        with open_tile_sink(path) as sink:
+            for (z, x, y), data in tiles.items():
+                sink.put(z, x, y, data)
+        metrics = sink.close()
+        elapsed = time.perf_counter() - start
+        with open_tile_archive(path) as reader:
+            assert all(reader.get(*key) == data for key, data in tiles.items())
+            assert reader.get(12, 100, 100) is None
+        print(f"{name:13s}: {elapsed:6.2f} s, {metrics}")
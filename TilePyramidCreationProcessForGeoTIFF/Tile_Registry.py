@@ -0,0 +1,199 @@
+import os
+import numpy as np
+
+
+def parse_tile_index(current_index):
+    '''
+    'z/x/y' --> (z, x, y)
+    '''
+    z, x, y = current_index.split('/')
+    return int(z), int(x), int(y)
+
+
+def parent_key(key):
+    '''
+    上一级(z-1)瓦片的index, 即瓦片信息中的min_index
+    '''
+    z, x, y = key
+    return z - 1, x >> 1, y >> 1
+
+
+def children_keys(key):
+    '''
+    下一级(z+1)的4个子瓦片index, 按行优先排列
+    '''
+    z, x, y = key
+    return [(z + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+
+
+class TileRecord:
+    '''
+    一个瓦片的信息, 代替 {'data_dir', 'current_index', 'current_level', 'min_index', 'min_level'} 字典;
+    index相关字段都由(z, x, y)推出, 不再重复存储字符串。
+    fragments为合并前各栅格切出的同一瓦片的临时文件(TMP), data_dir为合并后的文件(NPY)
+    '''
+    __slots__ = ('z', 'x', 'y', 'data_dir', 'fragments', 'png_dir')
+
+    def __init__(self, z, x, y, data_dir=None):
+        self.z = z
+        self.x = x
+        self.y = y
+        self.data_dir = data_dir
+        self.fragments = []
+        self.png_dir = None
+
+    @property
+    def key(self):
+        return self.z, self.x, self.y
+
+    @property
+    def current_index(self):
+        return f'{self.z}/{self.x}/{self.y}'
+
+    @property
+    def current_level(self):
+        return self.z
+
+    @property
+    def min_index(self):
+        return '/'.join(str(i) for i in parent_key(self.key))
+
+    @property
+    def min_level(self):
+        return self.z - 1
+
+    def to_dict(self, data_dir=None):
+        '''
+        转为aster_core (MergeTileRecords, OverviewTileGenerator) 使用的瓦片信息字典
+        '''
+        return {
+            'data_dir': data_dir if data_dir is not None else self.data_dir,
+            'current_index': self.current_index,
+            'current_level': self.current_level,
+            'min_index': self.min_index,
+            'min_level': self.min_level,
+        }
+
+    def fragment_dicts(self):
+        return [self.to_dict(data_dir=fragment) for fragment in self.fragments]
+
+    @classmethod
+    def from_dict(cls, tile_info):
+        z, x, y = parse_tile_index(tile_info['current_index'])
+        return cls(z, x, y, data_dir=tile_info.get('data_dir'))
+
+    def __repr__(self):
+        return f'TileRecord({self.current_index}, data_dir={self.data_dir!r}, fragments={len(self.fragments)})'
+
+
+class TileRegistry:
+    '''
+    瓦片注册表, 以(z, x, y)整数元组为键的哈希表, 插入和查询都是O(1),
+    代替 base_tile_dict + base_tile_index_list (list成员判断为O(n)) 以及
+    merged_base_tile_index_list_zoom-{z}.json 索引文件。
+    迭代顺序即插入顺序, 与原先的index列表一致
+    '''
+
+    def __init__(self, records=None):
+        self._records = {}
+        for record in records or []:
+            self._records[record.key] = record
+
+    def add_fragment(self, key, fragment):
+        '''
+        登记一个合并前的瓦片碎片(TMP文件), 同一瓦片的碎片按登记顺序保存
+
+        Args:
+            key: (z, x, y)
+            fragment: 碎片文件路径
+
+        Returns:
+            record: 该瓦片的TileRecord
+        '''
+        record = self._records.get(key)
+        if record is None:
+            record = self._records[key] = TileRecord(*key)
+        record.fragments.append(fragment)
+        return record
+
+    def add(self, record):
+        '''
+        登记一个已合并的瓦片, 同一index重复登记时覆盖
+        '''
+        self._records[record.key] = record
+        return record
+
+    def extend(self, other):
+        '''
+        按顺序并入另一个注册表的碎片, 与逐个add_fragment的结果一致
+        '''
+        for record in other:
+            for fragment in record.fragments:
+                self.add_fragment(record.key, fragment)
+        return self
+
+    def get(self, key, default=None):
+        return self._records.get(key, default)
+
+    def __getitem__(self, key):
+        return self._records[key]
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def records(self):
+        return list(self._records.values())
+
+    def children(self, key):
+        '''
+        已登记的子瓦片
+        '''
+        return [self._records[child] for child in children_keys(key) if child in self._records]
+
+    def parent(self, key):
+        return self._records.get(parent_key(key))
+
+    def group_by_parent(self):
+        '''
+        按上一级瓦片分组, 生成下一级瓦片时使用
+
+        Returns:
+            {parent_key: [TileRecord, ...]}, 顺序为父瓦片第一次出现的顺序
+        '''
+        groups = {}
+        for record in self._records.values():
+            groups.setdefault(parent_key(record.key), []).append(record)
+        return groups
+
+    def save(self, filename):
+        '''
+        以npz格式存储已合并瓦片的index和文件路径 (z, x, y为int32数组), 碎片信息不存储;
+        先写临时文件再替换, 中断时不会留下不完整的注册表
+        '''
+        keys = np.array(list(self._records.keys()), dtype=np.int32).reshape(-1, 3)
+        data_dir = np.array([record.data_dir or '' for record in self._records.values()], dtype=str)
+        with open(f'{filename}.tmp', 'wb') as f:
+            np.savez(f, z=keys[:, 0], x=keys[:, 1], y=keys[:, 2], data_dir=data_dir)
+        os.replace(f'{filename}.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        registry = cls()
+        with np.load(filename) as index:
+            for z, x, y, data_dir in zip(index['z'].tolist(), index['x'].tolist(), index['y'].tolist(),
+                                         index['data_dir'].tolist()):
+                registry.add(TileRecord(z, x, y, data_dir=data_dir or None))
+        return registry
+
+
+def registry_file(data_dir, zoom_level):
+    '''
+    瓦片注册表文件, 代替 merged_base_tile_index_list_zoom-{z}.json
+    '''
+    return os.path.join(data_dir, f'tile_registry_zoom-{zoom_level}.npz')
@@ -0,0 +1,309 @@
+import io
+import os
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image
+from utils import normalize, array_to_rgba
+from Tile_Encoder import TileEncoder
+
+# 各拉伸方法用到的统计量
+STRETCH_STATISTIC_KEYS = ("mean", "std", "min", "max", "02%", "98%")
+# 单一颜色瓦片共用的png存放在PNG目录下的该子目录, 各瓦片文件为其硬链接
+SHARED_TILE_DIR = '.shared'
+
+
+def compile_stretch(statistic_dict, stretch_method):
+    '''
+    把(stretch_method, 统计信息)编译成每个通道的截断区间(low, high), 归一化即 clip(x, low, high) 后线性映射到[0, 1],
+    与utils.normalize中对应的拉伸方法一致
+
+    Args:
+        statistic_dict: 统计信息字典
+        stretch_method: 拉伸方法
+
+    Returns:
+        (low, high): 每个通道的截断区间, 不能表示为截断+线性拉伸的方法(如'ghs')返回None
+    '''
+    if stretch_method == 'gaussian':
+        mean, std = np.asarray(statistic_dict["mean"], dtype=np.float64), np.asarray(statistic_dict["std"], dtype=np.float64)
+        return np.maximum(mean - 3 * std, 0), np.minimum(mean + 3 * std, 1)
+    elif stretch_method == '02-98':
+        return np.asarray(statistic_dict["02%"], dtype=np.float64), np.asarray(statistic_dict["98%"], dtype=np.float64)
+    elif stretch_method == 'linear-stretch':
+        return np.asarray(statistic_dict["min"], dtype=np.float64), np.asarray(statistic_dict["max"], dtype=np.float64)
+    elif stretch_method == '0-1':
+        return np.zeros(1), np.ones(1)
+    elif stretch_method == 'dem':
+        high = np.asarray(statistic_dict["max"], dtype=np.float64)
+        return np.zeros_like(high), high
+    return None
+
+
+def colormap_lut(colormap):
+    '''
+    预先计算色卡的查找表, 与array_to_png中 (cmap(x) * 255).astype(np.uint8) 逐像素的结果一致
+
+    Args:
+        colormap: matplotlib色卡
+
+    Returns:
+        lut: shape为(colormap.N, 4)的uint8查找表
+    '''
+    return (colormap(np.arange(colormap.N)) * 255).astype(np.uint8)
+
+
+class TileRenderer:
+    '''
+    瓦片渲染器: 归一化 + 上色编译为一次截断线性变换得到色卡索引, 再用一次np.take查表得到RGBA,
+    代替 utils.normalize + utils.array_to_png 中逐通道的掩码赋值和float64的RGBA中间结果。
+    不能编译的拉伸方法自动回退到 normalize + array_to_rgba。
+    编码由encoder(Tile_Encoder.TileEncoder)完成, 单通道色卡瓦片直接按色卡索引存为索引色png。
+    '''
+
+    def __init__(self, statistic_dict, stretch_method, cmap=None, customized_cmap=None, selected_channels=None,
+                 encoder=None):
+        '''
+        Args:
+            statistic_dict: 统计信息字典
+            stretch_method: 拉伸方法, 定义在utils.normalize里
+            cmap: matplotlib中色卡关键词
+            customized_cmap: 自定义的基于matplotlib的色卡，定义在color_config.py里
+            selected_channels: List, 多通道图像按顺序选择RGB通道的index
+            encoder: Tile_Encoder.TileEncoder, 默认为索引色png
+        '''
+        # 只保留拉伸需要的统计量, 便于传给子进程
+        self.statistic_dict = {key: statistic_dict[key] for key in STRETCH_STATISTIC_KEYS if key in statistic_dict}
+        self.stretch_method = stretch_method
+        self.cmap = cmap
+        self.customized_cmap = customized_cmap
+        self.selected_channels = selected_channels
+        self.colormap = customized_cmap if customized_cmap else plt.get_cmap(cmap)
+        self.lut = colormap_lut(self.colormap)
+        self.bounds = compile_stretch(self.statistic_dict, stretch_method)
+        self.encoder = encoder if encoder is not None else TileEncoder()
+
+    @property
+    def extension(self):
+        # 瓦片文件后缀
+        return self.encoder.extension
+
+    def _stretch(self, data, n):
+        # 截断线性拉伸到[0, 1]
+        # 用python float, 与normalize一样保持数据原本的精度(如float32)
+        low = float(self.bounds[0][min(n, len(self.bounds[0]) - 1)])
+        high = float(self.bounds[1][min(n, len(self.bounds[1]) - 1)])
+        # 截断区间退化(如掩码数据的02%与98%相同, 'dem'的max为0)时全部映射为0, 避免除0得到NaN
+        if not high > low:
+            return np.zeros(data.shape[:2], dtype=np.float64)
+        stretched = (np.clip(data[:, :, n], low, high) - low) / (high - low)
+        return np.clip(np.nan_to_num(stretched, nan=0.0), 0, 1)
+
+    def _colormap_index(self, tile_data):
+        index = self._stretch(tile_data, 0) * self.colormap.N
+        return np.clip(index, 0, self.colormap.N - 1).astype(np.intp)
+
+    def render(self, tile_data):
+        '''
+        Args:
+            tile_data: 瓦片数据, shape为(height, width, channel + 1), 最后一个通道为alpha
+
+        Returns:
+            rgba: uint8 RGBA矩阵
+        '''
+        if self.bounds is None:
+            norm_tile_data = normalize(np.array(tile_data), self.statistic_dict,
+                                       stretch_method=self.stretch_method)
+            return array_to_rgba(norm_tile_data, cmap=self.cmap, customized_cmap=self.customized_cmap,
+                                 selected_channels=self.selected_channels)
+
+        if self.selected_channels:
+            rgba = np.empty(tile_data.shape[:2] + (4,), dtype=np.uint8)
+            for i, n in enumerate(self.selected_channels[:3]):
+                rgba[:, :, i] = (self._stretch(tile_data, n) * 255).astype(np.uint8)
+        else:
+            rgba = np.take(self.lut, self._colormap_index(tile_data), axis=0, mode='clip')
+        rgba[:, :, 3] = tile_data[:, :, -1].astype(np.uint8) * 255
+        return rgba
+
+    def save(self, tile_data, output_path):
+        '''
+        渲染瓦片并存储为文件(格式见encoder)
+        '''
+        with open(output_path, 'wb') as f:
+            f.write(self.encode(tile_data))
+
+    def encode(self, tile_data):
+        '''
+        渲染瓦片并编码, 单通道色卡瓦片的alpha只有0/1时直接按色卡索引编码, 不生成RGBA中间结果
+
+        Returns:
+            编码后的字节
+        '''
+        if self.bounds is not None and not self.selected_channels:
+            alpha = tile_data[:, :, -1].astype(np.uint8) * 255
+            if np.all((alpha == 0) | (alpha == 255)):
+                data = self.encoder.encode_indexed(self._colormap_index(tile_data), self.lut[:, :3], alpha)
+                if data is not None:
+                    return data
+        return self.encoder.encode_rgba(self.render(tile_data))
+
+
+def classify_tile(tile_data):
+    '''
+    由alpha通道和数据判断瓦片是否需要单独渲染
+
+    Args:
+        tile_data: 瓦片数据, shape为(height, width, channel + 1), 最后一个通道为alpha
+
+    Returns:
+        'empty': 全透明(alpha全为0); 'uniform': 所有像素相同(如海洋、nodata边缘); 其余返回None
+    '''
+    if not tile_data[:, :, -1].any():
+        return 'empty'
+    if (tile_data == tile_data[0, 0]).all():
+        return 'uniform'
+    return None
+
+
+class TileWriter:
+    '''
+    渲染并写入瓦片: 全透明的瓦片不写入(已有的旧文件删除); 单一颜色的瓦片每种颜色只编码一次,
+    按png内容的md5存为 PNG/.shared/{md5}.png, 各瓦片文件为其硬链接(不支持时复制), 上传、拼图等按普通文件处理即可。
+    counts记录渲染、跳过和共用的瓦片数
+    '''
+
+    def __init__(self, renderer, png_dir=None, skip_empty=True, share_uniform=True):
+        '''
+        Args:
+            renderer: TileRenderer
+            png_dir: PNG目录, 共用的png存放在其下的SHARED_TILE_DIR
+            skip_empty: 是否跳过全透明瓦片
+            share_uniform: 单一颜色瓦片是否共用一个png
+        '''
+        self.renderer = renderer
+        self.png_dir = png_dir
+        self.skip_empty = skip_empty
+        self.share_uniform = share_uniform
+        self.counts = {'rendered': 0, 'empty': 0, 'uniform': 0}
+        self._encoded = {}
+        self._shared = set()
+
+    def classify(self, tile_data):
+        kind = classify_tile(tile_data)
+        if (kind == 'empty' and not self.skip_empty) or (kind == 'uniform' and not self.share_uniform):
+            return None
+        return kind
+
+    def _uniform_png(self, tile_data):
+        # 同一像素值的瓦片渲染结果相同, 只编码一次
+        value = (tile_data.shape, tile_data.dtype.str, tile_data[0, 0].tobytes())
+        data = self._encoded.get(value)
+        if data is None:
+            data = self._encoded[value] = self.renderer.encode(tile_data)
+        return data
+
+    def _link_shared(self, data, png_file):
+        shared_file = os.path.join(self.png_dir, SHARED_TILE_DIR, f'{hashlib.md5(data).hexdigest()}.{self.renderer.extension}')
+        if shared_file not in self._shared:
+            if not os.path.exists(shared_file):
+                os.makedirs(os.path.dirname(shared_file), exist_ok=True)
+                # 多进程同时写同一个共用文件时, 先写临时文件再改名
+                tmp_file = f'{shared_file}.{os.getpid()}.tmp'
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, shared_file)
+            self._shared.add(shared_file)
+        if os.path.lexists(png_file):
+            os.remove(png_file)
+        try:
+            os.link(shared_file, png_file)
+        except OSError:
+            shutil.copyfile(shared_file, png_file)
+
+    def write(self, tile_data, png_file):
+        '''
+        Args:
+            tile_data: 瓦片数据
+            png_file: png文件
+
+        Returns:
+            png_file, 全透明瓦片返回None
+        '''
+        kind = self.classify(tile_data)
+        if kind == 'empty':
+            self.counts['empty'] += 1
+            if os.path.lexists(png_file):
+                os.remove(png_file)
+            return None
+
+        Path(png_file).parent.mkdir(parents=True, exist_ok=True)
+        if kind == 'uniform':
+            self._link_shared(self._uniform_png(tile_data), png_file)
+            self.counts['uniform'] += 1
+            return png_file
+
+        # 已有文件是共用png的硬链接时先删除, 以免覆盖共用文件
+        if os.path.exists(png_file) and os.stat(png_file).st_nlink > 1:
+            os.remove(png_file)
+        self.renderer.save(tile_data, png_file)
+        self.counts['rendered'] += 1
+        return png_file
+
+    def put(self, tile_sink, z, x, y, tile_data):
+        '''
+        写入瓦片包(Tile_Archive), 全透明瓦片不写入
+
+        Returns:
+            是否写入
+        '''
+        kind = self.classify(tile_data)
+        if kind == 'empty':
+            self.counts['empty'] += 1
+            return False
+        if kind == 'uniform':
+            tile_sink.put(z, x, y, self._uniform_png(tile_data))
+            self.counts['uniform'] += 1
+        else:
+            tile_sink.put(z, x, y, self.renderer.encode(tile_data))
+            self.counts['rendered'] += 1
+        return True
+
+
+if __name__ == '__main__':
+    # 微基准: 对比 normalize + array_to_png 与 TileRenderer 的 tiles/sec
+    import time
+    from color_config import Greens
+
+    rng = np.random.default_rng(0)
+    tiles = []
+    for _ in range(32):
+        tile = np.zeros((256, 256, 2))
+        tile[:, :, 0] = rng.normal(0.45, 0.15, (256, 256))
+        tile[:, :, 1] = rng.random((256, 256)) > 0.1
+        tiles.append(tile)
+    statistic_dict = {"mean": [0.45], "std": [0.15], "min": [-0.2], "max": [1.1], "02%": [0.15], "98%": [0.75]}
+
+    for stretch_method in ['gaussian', '02-98', 'linear-stretch']:
+        for cmap, customized_cmap in [("Greens", None), (None, Greens().cmap)]:
+            renderer = TileRenderer(statistic_dict, stretch_method, cmap=cmap, customized_cmap=customized_cmap)
+
+            start = time.perf_counter()
+            legacy = [array_to_rgba(normalize(tile.copy(), statistic_dict, stretch_method=stretch_method),
+                                    cmap=cmap, customized_cmap=customized_cmap) for tile in tiles]
+            legacy_rate = len(tiles) / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            compiled = [renderer.render(tile) for tile in tiles]
+            compiled_rate = len(tiles) / (time.perf_counter() - start)
+            assert all(np.array_equal(a, b) for a, b in zip(legacy, compiled))
+
+            start = time.perf_counter()
+            for rgba in compiled:
+                Image.fromarray(rgba, mode='RGBA').save(io.BytesIO(), format='PNG')
+            encode_time = (time.perf_counter() - start) / len(tiles)
+
+            print(f"{stretch_method:15s} {cmap or 'customized':10s}: render {legacy_rate:8.0f} -> {compiled_rate:8.0f} tiles/s, "
+                  f"with png encode {1 / (1 / legacy_rate + encode_time):6.0f} -> {1 / (1 / compiled_rate + encode_time):6.0f} tiles/s")
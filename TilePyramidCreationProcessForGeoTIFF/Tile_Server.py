@@ -0,0 +1,291 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import color_config
+from utils import load_json
+from Tile_Renderer import TileRenderer
+from Tile_Encoder import TileEncoder
+from Tile_Registry import TileRegistry, TileRecord, registry_file
+from Level_Store import is_store_file, load_tile
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(png|webp)$')
+CONTENT_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+# 浏览器预览页面, 调色时修改地址栏的stretch/cmap参数即可
+INDEX_HTML = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{height: 100%; margin: 0;}}</style></head>
+<body><div id="map"></div><script>
+var map = L.map('map').setView([0, 0], 2);
+L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{opacity: 0.5}}).addTo(map);
+L.tileLayer('/{{z}}/{{x}}/{{y}}.png' + window.location.search, {{maxZoom: {max_zoom}}}).addTo(map);
+</script></body></html>
+'''
+
+
+class LRUCache:
+    '''
+    按字节数限制大小的LRU缓存, 线程安全; 超出max_bytes时淘汰最久未使用的条目
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return value
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.bytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'items': len(self._items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def resolve_cmap(name):
+    '''
+    色卡参数: color_config.py中的色卡类名(如BlueReds)或matplotlib色卡关键词
+
+    Returns:
+        (cmap, customized_cmap)
+    '''
+    customized = getattr(color_config, name, None)
+    if isinstance(customized, type):
+        return None, customized().cmap
+    return name, None
+
+
+class TileService:
+    '''
+    按需渲染瓦片: 读取z/x/y的NPY瓦片(或Level_Store中的瓦片), 按stretch/cmap和statistics.json的统计值渲染并编码。
+    解码后的瓦片数据和编码后的瓦片分别放在按字节限制的LRU缓存中;
+    ETag由瓦片、拉伸方法、色卡以及数据文件和statistics.json的修改时间决定, 不需要渲染即可判断是否未变化。
+    statistics.json修改后自动重新读取
+    '''
+
+    def __init__(self, data_dir, stretch_method='linear-stretch', cmap='viridis', selected_channels=None,
+                 data_cache_bytes=256 << 20, tile_cache_bytes=64 << 20, encoder=None):
+        '''
+        Args:
+            data_dir: process_tiff的输出主目录(包含statistics.json和瓦片注册表)
+            stretch_method: 默认拉伸方法, 请求参数stretch可覆盖
+            cmap: 默认色卡, 请求参数cmap可覆盖, 见resolve_cmap
+            selected_channels: List, 多通道图像按顺序选择RGB通道的index
+            data_cache_bytes: 瓦片数据缓存的字节上限
+            tile_cache_bytes: 编码后瓦片缓存的字节上限
+            encoder: 可选, 瓦片编码(Tile_Encoder.TileEncoder), 默认为索引色png, 压缩等级较低以加快响应
+        '''
+        self.data_dir = data_dir
+        self.stretch_method = stretch_method
+        self.cmap = cmap
+        self.selected_channels = selected_channels or []
+        self.data_cache = LRUCache(data_cache_bytes)
+        self.tile_cache = LRUCache(tile_cache_bytes)
+        self.encoder = encoder if encoder is not None else TileEncoder(compress_level=1)
+        self._statistics_file = os.path.join(data_dir, 'statistics.json')
+        self._statistics_mtime = None
+        self.statistic_dict = None
+        self._registries = {}
+        self._renderers = {}
+        self._lock = threading.Lock()
+        self._load_statistics()
+
+    def _load_statistics(self):
+        mtime = os.path.getmtime(self._statistics_file)
+        if mtime != self._statistics_mtime:
+            with self._lock:
+                self.statistic_dict = load_json(self._statistics_file)
+                self._statistics_mtime = mtime
+                self._renderers.clear()
+            self.tile_cache.clear()
+
+    @property
+    def max_zoom(self):
+        return self.statistic_dict.get('max_zoom') or 22
+
+    def _registry(self, z):
+        # 各等级的瓦片注册表, 文件更新后重新读取
+        path = registry_file(self.data_dir, z)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        cached = self._registries.get(z)
+        if cached is None or cached[0] != mtime:
+            cached = self._registries[z] = (mtime, TileRegistry.load(path) if mtime is not None else None)
+        return cached[1]
+
+    def locate(self, z, x, y):
+        '''
+        Returns:
+            (瓦片信息, 数据版本), 瓦片不存在时返回(None, None)
+        '''
+        registry = self._registry(z)
+        if registry is not None:
+            record = registry.get((z, x, y))
+        else:
+            # 没有注册表时按 NPY/{z}/{x}/{y}.npy 查找
+            record = TileRecord(z, x, y, data_dir=os.path.join(self.data_dir, 'NPY', str(z), str(x), f'{y}.npy'))
+        if record is None or not record.data_dir:
+            return None, None
+        # Level_Store中的瓦片以索引文件的修改时间作为版本
+        version_file = record.data_dir[:-len('.dat')] + '.index.npz' if is_store_file(record.data_dir) else record.data_dir
+        try:
+            return record, os.stat(version_file).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+
+    def renderer(self, stretch_method, cmap):
+        key = (stretch_method, cmap)
+        renderer = self._renderers.get(key)
+        if renderer is None:
+            cmap_name, customized_cmap = resolve_cmap(cmap)
+            renderer = TileRenderer(self.statistic_dict, stretch_method, cmap=cmap_name,
+                                    customized_cmap=customized_cmap, selected_channels=self.selected_channels,
+                                    encoder=self.encoder)
+            with self._lock:
+                self._renderers[key] = renderer
+        return renderer
+
+    def etag(self, z, x, y, stretch_method, cmap, version):
+        text = f'{z}/{x}/{y}|{stretch_method}|{cmap}|{self.encoder.extension}|{version}|{self._statistics_mtime}'
+        return '"' + hashlib.md5(text.encode('utf-8')).hexdigest() + '"'
+
+    def tile_data(self, record, version):
+        key = (record.key, version)
+        data = self.data_cache.get(key)
+        if data is None:
+            # 从存储映射的只读视图拷贝一份, 缓存的大小即实际占用的内存
+            data = np.array(load_tile(record))
+            self.data_cache.put(key, data, data.nbytes)
+        return data
+
+    def get_tile(self, z, x, y, stretch_method=None, cmap=None, if_none_match=None):
+        '''
+        Returns:
+            (status, etag, body): 200为瓦片字节, 304为未变化, 404为瓦片不存在
+        '''
+        self._load_statistics()
+        stretch_method = stretch_method or self.stretch_method
+        cmap = cmap or self.cmap
+        record, version = self.locate(z, x, y)
+        if record is None:
+            return 404, None, None
+        etag = self.etag(z, x, y, stretch_method, cmap, version)
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, etag, None
+        body = self.tile_cache.get(etag)
+        if body is None:
+            body = self.renderer(stretch_method, cmap).encode(self.tile_data(record, version))
+            self.tile_cache.put(etag, body, len(body))
+        return 200, etag, body
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    '''
+    GET /{z}/{x}/{y}.png?stretch=linear-stretch&cmap=Greens 返回瓦片, GET / 返回预览页面
+    '''
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path in ('/', '/index.html'):
+            title = self.service.statistic_dict.get('dataset_name') or 'tiles'
+            return self._send(200, INDEX_HTML.format(title=title, max_zoom=self.service.max_zoom).encode('utf-8'),
+                              'text/html; charset=utf-8')
+        match = TILE_PATH.match(url.path)
+        if match is None or match.group(4) != self.service.encoder.extension:
+            return self._send(404)
+        z, x, y = (int(i) for i in match.groups()[:3])
+        try:
+            status, etag, body = self.service.get_tile(z, x, y, stretch_method=query.get('stretch'),
+                                                       cmap=query.get('cmap'),
+                                                       if_none_match=self.headers.get('If-None-Match'))
+        except Exception as E:
+            logging.error(f"Tile {z}/{x}/{y} render failed: {E}")
+            return self._send(500, str(E).encode('utf-8'), 'text/plain; charset=utf-8')
+        self._send(status, body, CONTENT_TYPES[match.group(4)], etag)
+
+    def _send(self, status, body=None, content_type=None, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+            # 每次都用ETag向服务端确认, 调色后立即生效
+            self.send_header('Cache-Control', 'no-cache')
+        if body is not None:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body) if body is not None else 0))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(data_dir, host='127.0.0.1', port=8080, **kwargs):
+    '''
+    启动本地瓦片服务, 各请求在独立线程中处理
+
+    Args:
+        data_dir: process_tiff的输出主目录
+        host: 监听地址
+        port: 端口
+        **kwargs: 传给TileService, 如stretch_method、cmap和缓存大小
+
+    Returns:
+        server: ThreadingHTTPServer, 调用serve_forever()开始服务
+    '''
+    handler = type('Handler', (TileRequestHandler,), {'service': TileService(data_dir, **kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    # 生成文件的主文件目录(process_tiff的data_dir)
+    data_dir = '/data/NDVI_full'
+    # 默认拉伸方法和色卡, 浏览器中可用 ?stretch=02-98&cmap=BlueReds 覆盖
+    stretch_method = 'linear-stretch'
+    cmap = 'Greens'
+    port = 8080
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = serve(data_dir, port=port, stretch_method=stretch_method, cmap=cmap)
+    print(f"Serving {data_dir} at http://127.0.0.1:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,5 +1,8 @@
 import os
-from utils import extract_x_y_from_filename, save_json
+from utils import extract_x_y_from_filename
+from Statistical_Analysis import tile_statistics
+from Tile_Registry import TileRegistry, TileRecord, parse_tile_index, registry_file
+from Level_Store import load_tile
 from aster_core.global_grid2tiles import BaseTileGenerator, MergeTileRecords
 from aster_core.global_grid import GlobalRasterGrid
 from aster_core.mosaic_tile import extract_geotif
@@ -8,24 +11,22 @@ from pathlib import Path
 import numpy as np
 
 
-def tiles2npy(data_dir, tile_name_list, base_tile_dict, base_tile_index_list, current_level=None,
-              resolution=None, tile_size=None):
+def tiles2npy(data_dir, tile_name_list, registry, current_level=None, resolution=None, tile_size=None, store=None):
     '''
     栅格-->瓦片 计算函数
     主要过程为: 1.地理坐标转化; 2.瓦片生成; 3.瓦片合并 (func merge_tiles)
-    其中, base_tile_dict和base_tile_index_list是瓦片生成的信息, 包含index对应关系, 数据存放地址等等, 在loop中不断维护, 即使入参也是返回值
+    其中, registry(Tile_Registry.TileRegistry)是瓦片生成的信息, 包含index对应关系, 数据存放地址等等, 在loop中不断维护, 即使入参也是返回值
     Args:
         data_dir: 数据主目录
-        tile_name_list: 瓦片信息字典中包含index对应关系的list
-        base_tile_dict: 瓦片信息字典
-        base_tile_index_list:
+        tile_name_list: 栅格文件名称list
+        registry: 瓦片注册表, 以(z, x, y)为键登记各瓦片的碎片文件
         current_level: 当前切片等级
         resolution: 栅格分辨率
         tile_size: 栅格尺寸
+        store: 可选, 当前等级的Level_Store.LevelStore, 传入时瓦片碎片直接合并写入存储, 不再生成TMP文件
 
     Returns:
-        base_tile_dict: 瓦片信息字典
-        base_tile_index_list: 瓦片信息字典中包含index对应关系的list
+        registry: 瓦片注册表
 
     '''
     tiles_dir = os.path.join(data_dir, 'TILES')
@@ -62,62 +63,65 @@ def tiles2npy(data_dir, tile_name_list, base_tile_dict, base_tile_index_list, cu
         # 数据和index分开，数据存储，index建表
         for base_tile_info in base_tile_list:
             current_zoom, index_x, index_y = base_tile_info["current_index"].split('/')
+            # 全为0的碎片不参与合并, 也不写入
+            if not np.count_nonzero(base_tile_info['data'][:, :, 0]):
+                continue
+            if store is not None:
+                key = parse_tile_index(base_tile_info['current_index'])
+                store.merge(key[1], key[2], base_tile_info['data'])
+                registry.add_fragment(key, store.path)
+                continue
+
             npy_name = f'{current_zoom}/{index_x}/x-{tile_index[0]}_y-{tile_index[1]}_index-{index_y}.npy'
 
             tmp_file = os.path.join(tmp_dir, npy_name)
 
             Path(tmp_file).parent.mkdir(parents=True, exist_ok=True)
             np.save(tmp_file, base_tile_info['data'])
+            registry.add_fragment(parse_tile_index(base_tile_info['current_index']), tmp_file)
 
-            base_tile = {
-                'data_dir': tmp_file,
-                'current_index': base_tile_info['current_index'],
-                'current_level': base_tile_info['current_level'],
-                'min_index': base_tile_info['min_index'],
-                'min_level': base_tile_info['min_level'],
-            }
-
-            if np.count_nonzero(base_tile_info['data'][:, :, 0]):
-                base_tile_index = f'{base_tile_info["current_index"]}'
-
-                if base_tile_index in base_tile_index_list:
-                    base_tile_dict[base_tile_index].append(base_tile)
-                else:
-                    base_tile_index_list.append(base_tile_index)
-                    base_tile_dict[base_tile_index] = []
-                    base_tile_dict[base_tile_index].append(base_tile)
+    return registry
 
-    return base_tile_dict, base_tile_index_list
 
-
-def merge_tiles(data_dir, base_tile_dict):
+def merge_tiles(data_dir, registry, statistics=None, statis_dict_list=None, store=None):
     '''
 
-    遍历瓦片信息字典, 合并重复的瓦片/切片
+    遍历瓦片注册表, 合并重复的瓦片/切片
+    若传入statistics, 则在合并的同时累计统计信息(Statistical_Analysis.StreamingStatistics), 合并后的瓦片刚写入,
+    直接从页缓存读取, 不再需要statistical_analysis对NPY目录再遍历一遍
 
     Args:
         data_dir: 生成文件主目录
-        base_tile_dict: 瓦片信息字典
+        registry: 瓦片注册表(tiles2npy生成)
+        statistics: StreamingStatistics, 可选
+        statis_dict_list: 各瓦片统计信息的list, 随statistics一起传入, 原地追加
+        store: 可选, tiles2npy使用的Level_Store.LevelStore, 碎片已在写入时合并, 这里保存索引并关闭存储
 
     Returns:
 
-        merged_base_tile_list: 合并之后的瓦片信息字典
+        merged_registry: 合并之后的瓦片注册表, 同时存储为tile_registry_zoom-{z}.npz
 
     '''
     npy_dir = os.path.join(data_dir, 'NPY')
-    merged_base_tile_list = []
+    merged_registry = TileRegistry()
+    if store is not None:
+        store.close()
 
     # 合并瓦片并存储为npy
-    for key, value in base_tile_dict.items():
-        merged_base_tile_dict = {}
-        merged_base_tile_dict[key] = MergeTileRecords(value, data_dir_flag=True, save_dir=npy_dir)
-        # data = np.load(base_tile_dict[key]['data_dir'])
-        merged_base_tile_list.append(merged_base_tile_dict)
-
-    current_level = list(merged_base_tile_list[0].values())[0]['current_level']
-    json_file_name = f"merged_base_tile_index_list_zoom-{current_level}.json"
-    save_json(merged_base_tile_list, os.path.join(data_dir, json_file_name))
-
-    # json_file_name = "merged_base_tile_index_list.json"
-    # save_json(merged_base_tile_index_list, os.path.join(data_dir, json_file_name))
-    return merged_base_tile_list
+    for record in registry:
+        if store is not None:
+            merged_tile = {'data_dir': store.path}
+        else:
+            merged_tile = MergeTileRecords(record.fragment_dicts(), data_dir_flag=True, save_dir=npy_dir)
+        merged_record = merged_registry.add(TileRecord(*record.key, data_dir=merged_tile['data_dir']))
+        if statistics is not None:
+            tile_data = merged_tile.pop('data', None)
+            if tile_data is None:
+                tile_data = load_tile(merged_record) if store is not None else np.load(merged_record.data_dir, mmap_mode='r')
+            statis_dict = tile_statistics(statistics, tile_data, merged_record)
+            if statis_dict_list is not None:
+                statis_dict_list.append(statis_dict)
+
+    current_level = next(iter(merged_registry)).current_level
+    merged_registry.save(registry_file(data_dir, current_level))
+    return merged_registry
@@ -2,101 +2,172 @@ import os
 import matplotlib.pyplot as plt
 from PIL import Image
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
+TILE_EXTENSIONS = ('.png', '.webp')
 
-def plot_tiles_recursive(data_dir, target_group=None, output_dir=None):
+
+def _digit_dirs(path):
+    return {int(entry.name): entry.path for entry in os.scandir(path) if entry.is_dir() and entry.name.isdigit()}
+
+
+def list_level_tiles(level_dir):
+    """
+    列出一个等级的瓦片文件, 路径格式为 level_dir/index_x/index_y.png
+
+    :param level_dir: 等级目录
+    :return: [(index_x, index_y, tile_path), ...]
+    """
+    tile_positions = []
+    for index_x, x_dir in _digit_dirs(level_dir).items():
+        for entry in os.scandir(x_dir):
+            name, ext = os.path.splitext(entry.name)
+            if ext in TILE_EXTENSIONS and name.isdigit():
+                tile_positions.append((index_x, int(name), entry.path))
+    return tile_positions
+
+
+def _count_tiles(level_dir, limit):
+    # 统计等级的瓦片数, 超过limit即停止扫描
+    count = 0
+    for x_dir in _digit_dirs(level_dir).values():
+        count += sum(1 for entry in os.scandir(x_dir) if os.path.splitext(entry.name)[1] in TILE_EXTENSIONS)
+        if count > limit:
+            break
+    return count
+
+
+def _tile_size(level_dir):
+    # 读取一个瓦片的文件头得到瓦片尺寸
+    for x_dir in _digit_dirs(level_dir).values():
+        for entry in os.scandir(x_dir):
+            if os.path.splitext(entry.name)[1] in TILE_EXTENSIONS:
+                with Image.open(entry.path) as tile_image:
+                    return tile_image.size[0]
+    return None
+
+
+def _premultiply(tile_array):
+    # 与透明背景混合: 颜色和alpha都乘以alpha/255, 与原先逐通道float64混合的结果一致
+    alpha = tile_array[:, :, 3:4].astype(np.uint16)
+    return (tile_array.astype(np.uint16) * alpha // 255).astype(np.uint8)
+
+
+def _block_mean(tile_array, factor):
+    # 每factor x factor个像素取平均
+    if factor == 1:
+        return tile_array
+    height, width = tile_array.shape[0] // factor, tile_array.shape[1] // factor
+    blocks = tile_array[:height * factor, :width * factor].reshape(height, factor, width, factor, -1)
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) // (factor * factor)).astype(np.uint8)
+
+
+def mosaic_tiles(tile_positions, max_size=4096):
+    """
+    把一个等级的瓦片拼接为预览图, 长边不超过max_size: 瓦片读入后立即按2的幂次块平均缩小再放入画布,
+    画布只按输出大小分配; 缩小倍数超过瓦片尺寸时, 落在同一像素上的瓦片取最大值
+
+    :param tile_positions: [(index_x, index_y, tile_path), ...]
+    :param max_size: 预览图长边的最大像素数
+    :return: (uint8 RGBA预览图, 缩小倍数)
+    """
+    min_x = min(pos[0] for pos in tile_positions)
+    max_x = max(pos[0] for pos in tile_positions)
+    min_y = min(pos[1] for pos in tile_positions)
+    max_y = max(pos[1] for pos in tile_positions)
+
+    # 瓦片尺寸由数据读取
+    with Image.open(tile_positions[0][2]) as first_tile:
+        tile_size = first_tile.size[0]
+    grid_size = max(max_x - min_x + 1, max_y - min_y + 1) * tile_size
+    factor = 1
+    while grid_size // factor > max_size:
+        factor *= 2
+    tile_factor = min(factor, tile_size)
+    # 缩小后的瓦片尺寸, 以及每个瓦片在画布上所占的步长(可能小于1个像素)
+    small_size = tile_size // tile_factor
+    full_image = np.zeros((-(-(max_y - min_y + 1) * tile_size // factor),
+                           -(-(max_x - min_x + 1) * tile_size // factor), 4), dtype=np.uint8)
+
+    for index_x, index_y, tile_path in tile_positions:
+        with Image.open(tile_path) as tile_image:
+            tile_array = _block_mean(_premultiply(np.asarray(tile_image.convert("RGBA"))), tile_factor)
+        x_offset = (index_x - min_x) * tile_size // factor
+        y_offset = (index_y - min_y) * tile_size // factor
+        target = full_image[y_offset:y_offset + small_size, x_offset:x_offset + small_size]
+        np.maximum(target, tile_array[:target.shape[0], :target.shape[1]], out=target)
+    return full_image, factor
+
+
+def _plot_group(args):
+    group, source, level_dir, output_dir, max_size = args
+    tile_positions = list_level_tiles(level_dir)
+    if not tile_positions:
+        return group, source, None, None
+    full_image, factor = mosaic_tiles(tile_positions, max_size=max_size)
+    if output_dir:
+        output_file = os.path.join(output_dir, f"zoom-{group}.png")
+        Image.fromarray(full_image, mode='RGBA').save(output_file, compress_level=1)
+        return group, source, output_file, factor
+    return group, source, full_image, factor
+
+
+def plot_tiles_recursive(data_dir, target_group=None, output_dir=None, max_size=4096, num_workers=1, max_tiles=16384):
     """
     递归搜索瓦片数据并按第二层级拼接生成多张完整的图。路径格式为 data_dir/group/index_x/index_y.png。
+    各等级的拼接图长边不超过max_size, 内存占用与等级无关(见mosaic_tiles), 范围大于max_size的等级也由本级瓦片块平均缩小;
+    只有瓦片数超过max_tiles的等级改用金字塔中瓦片数不超过max_tiles的最高等级拼接, 不必读取该等级的全部瓦片;
+    多个等级落到同一个数据源时只拼接一次, 其余等级跳过并注明
 
     :param data_dir: 瓦片数据的根目录
-    :param output_dir: 输出拼接图的目录。
+    :param target_group: 只拼接该等级
+    :param output_dir: 输出拼接图的目录, 为空时直接显示
+    :param max_size: 拼接图长边的最大像素数
+    :param num_workers: 进程数, 大于1时各等级并行拼接
+    :param max_tiles: 由本级瓦片拼接的最大瓦片数(读取瓦片的耗时预算)
     """
-    # 存储每个组的瓦片信息
-    group_tiles = {}
-
-    # 递归查找符合结构的文件
-    for root, _, files in os.walk(data_dir):
-        # 获取当前目录的 group 和 index_x
-        rel_path = os.path.relpath(root, data_dir)
-        parts = rel_path.split(os.sep)
-
-        if len(parts) < 2:
-            continue  # 跳过没有足够层级的目录
-
-        try:
-            group = int(parts[0])  # 第二层级 group
-            index_x = int(parts[1])  # index_x
-        except ValueError:
-            continue  # 跳过非数字目录
-
-        for file in files:
-            print(group, index_x)
-            if target_group:
-                if group != target_group:
-                    continue
-            if file.endswith('.png'):
-                try:
-                    # 提取文件名中的 index_y
-                    index_y = int(file.replace('.png', ''))
-                    group_tiles.setdefault(group, []).append(
-                        (index_x, index_y, os.path.join(root, file))
-                    )
-                except ValueError:
-                    continue
-
-    # if not group_tiles:
-    #     print("未找到瓦片数据！")
-    #     return
-
-    # 对每个组生成完整拼接图
-    for group, tile_positions in group_tiles.items():
-
-        # 确定瓦片的网格范围
-        min_x = min(pos[0] for pos in tile_positions)
-        max_x = max(pos[0] for pos in tile_positions)
-        min_y = min(pos[1] for pos in tile_positions)
-        max_y = max(pos[1] for pos in tile_positions)
-
-        # 计算完整图像的大小
-        tile_size = 256
-        full_width = (max_x - min_x + 1) * tile_size
-        full_height = (max_y - min_y + 1) * tile_size
-
-        # 初始化空白大图
-        full_image = np.zeros((full_height, full_width, 4), dtype=np.uint8)
-
-        # 将瓦片放入对应的位置
-        for index_x, index_y, tile_path in tile_positions:
-            tile_image = Image.open(tile_path).convert("RGBA")  # 确保图像是 RGBA 格式
-            tile_array = np.array(tile_image)
-
-            x_offset = (index_x - min_x) * tile_size
-            y_offset = (index_y - min_y) * tile_size
-
-            # 使用透明度进行混合
-            alpha = tile_array[:, :, 3] / 255.0  # 归一化的透明度通道
-            for c in range(4):  # 对 RGBA 四个通道逐一处理
-                full_image[y_offset:y_offset + tile_size, x_offset:x_offset + tile_size, c] = (
-                        full_image[y_offset:y_offset + tile_size, x_offset:x_offset + tile_size, c] * (1 - alpha)
-                        + tile_array[:, :, c] * alpha
-                )
-
-        # 绘制完整的大图
-        plt.figure(figsize=(10, 10))
-        plt.imshow(full_image)
-        plt.axis('off')
-        plt.tight_layout()
-
-        # 保存或显示
+    levels = _digit_dirs(data_dir) if os.path.isdir(data_dir) else {}
+    tile_size = next((size for size in map(_tile_size, levels.values()) if size), None)
+    if tile_size is None:
+        print("未找到瓦片数据！")
+        return
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    tasks, sources = [], {}
+    for group in sorted(levels):
+        if target_group and group != target_group:
+            continue
+        # 瓦片数超过预算时, 选择瓦片数不超过预算的最高等级作为数据源
+        source = group
+        while _count_tiles(levels[source], max_tiles) > max_tiles and source - 1 in levels:
+            source -= 1
+        if source in sources:
+            print(f"zoom-{group} 的瓦片数超过{max_tiles}, 其拼接图与zoom-{sources[source]}相同(由zoom-{source}瓦片拼接), 跳过")
+            continue
+        sources[source] = group
+        tasks.append((group, source, levels[source], output_dir, max_size))
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks))) as executor:
+            results = list(executor.map(_plot_group, tasks))
+    else:
+        results = map(_plot_group, tasks)
+
+    for group, source, result, factor in results:
+        if result is None:
+            continue
         if output_dir:
-            os.makedirs(output_dir, exist_ok=True)
-            output_file = os.path.join(output_dir, f"zoom-{group}.png")
-            plt.savefig(output_file, dpi=300, bbox_inches='tight')
-            print(f"zoom-{group} 的拼接图保存到: {output_file}")
+            print(f"zoom-{group} 的拼接图(由zoom-{source}瓦片缩小1/{factor})保存到: {result}")
         else:
+            plt.figure(figsize=(10, 10))
+            plt.imshow(result)
+            plt.axis('off')
             plt.title(f"zoom-{group}")
+            plt.tight_layout()
             plt.show()
-        plt.close()
+            plt.close()
+
+
 if __name__ == '__main__':
     # 示例用法
     data_dir = "/home/data2/ASTWBD/PNG"
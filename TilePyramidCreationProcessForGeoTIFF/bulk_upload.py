@@ -0,0 +1,580 @@
+import os
+import copy
+import json
+import hashlib
+import time
+import random
+import shutil
+import logging
+import posixpath
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import oss2
+from tqdm import tqdm
+
+# 需要退避重试的HTTP状态码(限流/服务暂不可用)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def tile_object_key(oss_url, local_file):
+    '''
+    本地瓦片文件 .../{z}/{x}/{y}.png --> OSS对象名 {oss_url}/{z}/{x}/{y}.png, 后缀与本地文件一致
+
+    Args:
+        oss_url: OSS目录
+        local_file: 本地瓦片文件
+
+    Returns:
+        key: OSS对象名
+    '''
+    parts = os.path.normpath(local_file).split(os.sep)
+    current_level = parts[-3]  # 倒数第3层是 current_level
+    index_x = parts[-2]  # 倒数第2层是 index_x
+    return posixpath.join(oss_url.replace("\\", "/"), current_level, index_x, parts[-1])
+
+
+def pooled_bucket(bucket, pool_size):
+    '''
+    复制一个使用独立连接池的oss2.Bucket, 连接池大小与线程数一致, 各线程复用连接
+    '''
+    if not isinstance(bucket, oss2.Bucket):
+        return bucket
+    bucket = copy.copy(bucket)
+    bucket.session = oss2.Session(pool_size=pool_size)
+    return bucket
+
+
+def list_object_sizes(bucket, prefix, max_keys=1000):
+    '''
+    分页列举prefix下的所有对象, 一次快照代替每个对象一次object_exists请求
+
+    Returns:
+        {key: size}
+    '''
+    objects = {}
+    marker = ''
+    while True:
+        result = call_with_retry(bucket.list_objects, prefix=prefix, marker=marker, max_keys=max_keys)
+        for obj in result.object_list:
+            objects[obj.key] = obj.size
+        if not result.is_truncated:
+            return objects
+        marker = result.next_marker
+
+
+def call_with_retry(func, *args, max_retries=5, backoff=0.5, **kwargs):
+    '''
+    调用OSS接口, 遇到限流(429)或服务端错误(5xx)时指数退避重试
+    '''
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as E:
+            if getattr(E, 'status', None) not in RETRY_STATUS or attempt == max_retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class PublishManifest:
+    '''
+    本地发布清单 {OSS对象名: [md5, size]}, 记录已上传瓦片的内容;
+    重新发布时只上传新增或内容变化的瓦片, 不再依赖overwrite全部重传。
+    每次上传/删除都追加到 {path}.journal(与Run_Manifest一样的只追加日志), 上传中断时已上传的瓦片不会丢失记录,
+    读取时重放日志; save()写入完整清单后删除日志
+    '''
+
+    def __init__(self, path):
+        '''
+        Args:
+            path: 清单json文件, 不存在时为空清单
+        '''
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as json_file:
+                self.entries = json.load(json_file)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # 中断时未写完的行
+                        break
+                    if value is None:
+                        self.entries.pop(key, None)
+                    else:
+                        self.entries[key] = value
+        self._journal = None
+        self._lock = threading.Lock()
+
+    def _log(self, key, value):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps([key, value]) + '\n')
+        self._journal.flush()
+
+    def changed(self, key, md5, size):
+        '''
+        瓦片是否需要上传(清单中没有或内容不同)
+        '''
+        return self.entries.get(key) != [md5, size]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def record(self, key, md5, size):
+        with self._lock:
+            self.entries[key] = [md5, size]
+            self._log(key, [md5, size])
+
+    def remove(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._log(key, None)
+
+    def keys(self, prefix=''):
+        return [key for key in self.entries if key.startswith(prefix)]
+
+    def save(self):
+        '''
+        先写临时文件再替换, 中断时不会留下不完整的清单
+        '''
+        tmp_file = f'{self.path}.tmp'
+        with self._lock:
+            with open(tmp_file, 'w', encoding='utf-8') as json_file:
+                json.dump(self.entries, json_file)
+            os.replace(tmp_file, self.path)
+            # 清单已包含日志中的全部记录
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+
+class BulkUploader:
+    '''
+    多线程批量上传瓦片到OSS:
+    1. 上传前对目标目录做一次分页list_objects快照, 据此判断跳过还是覆盖, 不再逐个object_exists;
+    2. 线程池共用一个连接池(oss2.Session), 避免每个请求重新建立连接;
+    3. 限流和5xx错误指数退避重试;
+    4. 统计上传速度(objects/sec)
+    '''
+
+    def __init__(self, bucket, oss_url, overwrite=False, num_threads=32, max_retries=5, backoff=0.5):
+        '''
+        Args:
+            bucket: oss2.Bucket, 或实现了相同接口的对象(如LocalFsBucket)
+            oss_url: OSS目录
+            overwrite: 是否覆盖OSS上已有的对象
+            num_threads: 上传线程数
+            max_retries: 限流/服务端错误的最大重试次数
+            backoff: 首次重试的等待时间(秒), 之后逐次翻倍
+        '''
+        self.bucket = pooled_bucket(bucket, num_threads)
+        self.oss_url = oss_url.replace("\\", "/")
+        self.overwrite = overwrite
+        self.num_threads = num_threads
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def _put(self, key, local_file):
+        try:
+            call_with_retry(self.bucket.put_object_from_file, key, local_file,
+                            max_retries=self.max_retries, backoff=self.backoff)
+            return True
+        except Exception as E:
+            logging.error(f"Failed to upload {local_file} to {key}: {E}")
+            return False
+
+    def upload_file(self, local_file):
+        '''
+        上传单个文件(如瓦片包)到 {oss_url}/{文件名}, 总是覆盖
+
+        Returns:
+            key: OSS对象名, 上传失败时返回None
+        '''
+        key = posixpath.join(self.oss_url, os.path.basename(local_file))
+        return key if self._put(key, local_file) else None
+
+    def upload(self, file_list, desc="Upload to OSS"):
+        '''
+        Args:
+            file_list: 本地瓦片文件列表, 路径为 .../{z}/{x}/{y}.{suffix}
+            desc: 进度条描述
+
+        Returns:
+            metrics: {'uploaded', 'skipped', 'failed', 'seconds', 'objects_per_sec'}
+        '''
+        start = time.perf_counter()
+        prefix = self.oss_url.rstrip('/') + '/' if self.oss_url else ''
+        existing = {} if self.overwrite else list_object_sizes(self.bucket, prefix)
+
+        tasks = []
+        for local_file in file_list:
+            key = tile_object_key(self.oss_url, local_file)
+            if key not in existing:
+                tasks.append((key, local_file))
+
+        uploaded = failed = 0
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for ok in tqdm(executor.map(lambda task: self._put(*task), tasks), total=len(tasks), desc=desc):
+                if ok:
+                    uploaded += 1
+                else:
+                    failed += 1
+
+        seconds = time.perf_counter() - start
+        return {
+            'uploaded': uploaded,
+            'skipped': len(file_list) - len(tasks),
+            'failed': failed,
+            'seconds': seconds,
+            'objects_per_sec': uploaded / seconds if seconds > 0 else 0.0,
+        }
+
+
+class TilePublisher:
+    '''
+    后台发布瓦片: 每写完一个png就调用publish(png_file), 由后台线程从有界队列取出上传,
+    上传与后续等级的瓦片生成重叠进行, 不再等全部生成后重新遍历PNG目录。
+    队列满时publish阻塞, 生成速度超过上传速度时不会无限占用内存。
+    传入manifest(PublishManifest)时按内容md5增量发布: 清单中内容相同的瓦片跳过(overwrite=True时仍全部上传);
+    overwrite=False时仍对OSS目录做一次快照, 清单中没有而OSS上已存在的瓦片不会被覆盖;
+    delete_missing=True时, close()删除清单中有、本次没有发布的瓦片; 只渲染了部分等级/范围时,
+    由limit_deletion限定删除的范围, 范围外的瓦片不会被删除
+    '''
+
+    def __init__(self, bucket, oss_url, overwrite=False, num_threads=16, max_queue=1024, max_retries=5,
+                 backoff=0.5, manifest=None, delete_missing=False):
+        '''
+        Args:
+            bucket: oss2.Bucket, 或实现了相同接口的对象(如LocalFsBucket)
+            oss_url: OSS目录
+            overwrite: 是否覆盖OSS上已有的对象
+            num_threads: 上传线程数
+            max_queue: 等待上传的最大瓦片数
+            max_retries: 限流/服务端错误的最大重试次数
+            backoff: 首次重试的等待时间(秒)
+            manifest: PublishManifest, 可选, 按内容增量发布
+            delete_missing: 是否删除本次没有发布的已有瓦片, 需要manifest; 默认范围为清单中的全部瓦片,
+                            只发布了部分瓦片时需调用limit_deletion
+        '''
+        if delete_missing and manifest is None:
+            raise ValueError("delete_missing requires a manifest")
+        self.uploader = BulkUploader(bucket, oss_url, overwrite=overwrite, num_threads=num_threads,
+                                     max_retries=max_retries, backoff=backoff)
+        self.prefix = self.uploader.oss_url.rstrip('/') + '/' if self.uploader.oss_url else ''
+        self.manifest = manifest
+        self.delete_missing = delete_missing
+        self.existing = set() if overwrite else set(list_object_sizes(self.uploader.bucket, self.prefix))
+        self.published = set()
+        # 允许删除的范围 {zoom_level: (x_min, y_min, x_max, y_max)或None(整级)}, None为不限
+        self.delete_scope = None
+        self.uploaded = self.skipped = self.failed = self.deleted = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._start = time.perf_counter()
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+        self._closed = False
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            key, local_file = task
+            try:
+                if self.manifest is not None:
+                    md5, size = file_md5(local_file), os.path.getsize(local_file)
+                    if not self.uploader.overwrite and not self.manifest.changed(key, md5, size):
+                        with self._lock:
+                            self.skipped += 1
+                        continue
+                ok = self.uploader._put(key, local_file)
+                if ok and self.manifest is not None:
+                    self.manifest.record(key, md5, size)
+            except Exception as E:
+                # 线程退出后close会一直等待, 出错的瓦片记为失败并继续
+                logging.error(f"Failed to publish {local_file}: {E}")
+                ok = False
+            with self._lock:
+                if ok:
+                    self.uploaded += 1
+                else:
+                    self.failed += 1
+
+    def publish(self, local_file):
+        '''
+        提交一个已写完的瓦片文件, 路径为 .../{z}/{x}/{y}.{suffix}
+        '''
+        key = tile_object_key(self.uploader.oss_url, local_file)
+        self.published.add(key)
+        # 清单中有的瓦片按md5判断是否变化, 其余已存在的瓦片在overwrite=False时不覆盖
+        if key in self.existing and (self.manifest is None or key not in self.manifest):
+            with self._lock:
+                self.skipped += 1
+            return
+        self._queue.put((key, local_file))
+
+    __call__ = publish
+
+    def limit_deletion(self, zoom_level, tile_range=None):
+        '''
+        把zoom_level(及其瓦片范围)加入delete_missing允许删除的范围; 调用后范围外的瓦片不再删除
+
+        Args:
+            zoom_level: 本次完整发布的等级
+            tile_range: 可选, (x_min, y_min, x_max, y_max), 包含两端; 为None时为整级
+        '''
+        if self.delete_scope is None:
+            self.delete_scope = {}
+        self.delete_scope[zoom_level] = tile_range
+
+    def _in_scope(self, key):
+        if self.delete_scope is None:
+            return True
+        # key为 {prefix}{z}/{x}/{y}.{suffix}
+        try:
+            z, x, y = key[len(self.prefix):].split('/')[-3:]
+            z, x, y = int(z), int(x), int(os.path.splitext(y)[0])
+        except ValueError:
+            return False
+        if z not in self.delete_scope:
+            return False
+        tile_range = self.delete_scope[z]
+        return tile_range is None or (tile_range[0] <= x <= tile_range[2] and tile_range[1] <= y <= tile_range[3])
+
+    def close(self):
+        '''
+        等待队列中的瓦片全部上传完成, 按需删除消失的瓦片并保存清单
+
+        Returns:
+            metrics: {'uploaded', 'skipped', 'failed', 'deleted', 'seconds', 'objects_per_sec'}
+        '''
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            if self.manifest is not None:
+                if self.delete_missing:
+                    self._delete_missing()
+                self.manifest.save()
+        seconds = time.perf_counter() - self._start
+        return {
+            'uploaded': self.uploaded,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'deleted': self.deleted,
+            'seconds': seconds,
+            'objects_per_sec': self.uploaded / seconds if seconds > 0 else 0.0,
+        }
+
+    def _delete_missing(self):
+        bucket = self.uploader.bucket
+        for key in self.manifest.keys(self.prefix):
+            if key in self.published or not self._in_scope(key):
+                continue
+            try:
+                call_with_retry(bucket.delete_object, key, max_retries=self.uploader.max_retries,
+                                backoff=self.uploader.backoff)
+                self.manifest.remove(key)
+                self.deleted += 1
+            except Exception as E:
+                logging.error(f"Failed to delete {key}: {E}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ListObjectsResult:
+    def __init__(self, object_list, is_truncated, next_marker):
+        self.object_list = object_list
+        self.is_truncated = is_truncated
+        self.next_marker = next_marker
+
+
+class _ObjectInfo:
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+
+
+class _HeadObjectResult:
+    def __init__(self, content_length, server_crc):
+        self.content_length = content_length
+        self.server_crc = server_crc
+
+
+class _RangeReader:
+    '''
+    对象(或其中一段)的流式读取, 对应oss2.GetObjectResult的read接口
+    '''
+
+    def __init__(self, path, start, length):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+
+    def read(self, amt=None):
+        if self._remaining <= 0:
+            self._file.close()
+            return b''
+        amt = self._remaining if amt is None else min(amt, self._remaining)
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class ThrottledError(Exception):
+    '''
+    LocalFsBucket模拟的限流错误, 与oss2异常一样带有status
+    '''
+
+    def __init__(self, status=503):
+        super().__init__(f"Throttled (status {status})")
+        self.status = status
+
+
+class LocalFsBucket:
+    '''
+    基于本地文件系统的OSS bucket替身, 实现BulkUploader/bulk_download.ParallelDownloader用到的oss2.Bucket接口,
+    用于离线测试和基准; throttle_rate>0时按概率抛出ThrottledError, 模拟限流
+    '''
+
+    def __init__(self, root, throttle_rate=0.0, latency=0.0):
+        '''
+        Args:
+            root: 对象存放的本地目录
+            throttle_rate: 请求被限流的概率
+            latency: 每个请求的模拟延迟(秒)
+        '''
+        self.root = root
+        self.throttle_rate = throttle_rate
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _request(self):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise ThrottledError(random.choice((429, 503)))
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def object_exists(self, key):
+        self._request()
+        return os.path.isfile(self._path(key))
+
+    def put_object_from_file(self, key, filename):
+        self._request()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+
+    def put_object(self, key, data):
+        self._request()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def head_object(self, key):
+        self._request()
+        path = self._path(key)
+        crc64 = oss2.utils.Crc64()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                crc64.update(chunk)
+        return _HeadObjectResult(os.path.getsize(path), crc64.crc)
+
+    def get_object(self, key, byte_range=None):
+        self._request()
+        path = self._path(key)
+        size = os.path.getsize(path)
+        start, end = byte_range if byte_range is not None else (0, size - 1)
+        end = size - 1 if end is None else min(end, size - 1)
+        return _RangeReader(path, start, end - start + 1)
+
+    def get_object_to_file(self, key, filename, byte_range=None):
+        result = self.get_object(key, byte_range=byte_range)
+        with open(filename, 'wb') as f:
+            for chunk in iter(lambda: result.read(1 << 20), b''):
+                f.write(chunk)
+
+    def delete_object(self, key):
+        self._request()
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list_objects(self, prefix='', marker='', max_keys=100):
+        self._request()
+        keys = []
+        for root, _, files in os.walk(self.root):
+            for file in files:
+                key = os.path.relpath(os.path.join(root, file), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and key > marker:
+                    keys.append(key)
+        keys.sort()
+        page = keys[:max_keys]
+        object_list = [_ObjectInfo(key, os.path.getsize(self._path(key))) for key in page]
+        return _ListObjectsResult(object_list, len(keys) > max_keys, page[-1] if page else marker)
+
+
+if __name__ == '__main__':
+    # 基准: 逐个 object_exists + put 的串行上传 与 BulkUploader 对比 (本地模拟bucket, 每个请求5ms延迟)
+    import tempfile
+    from utils import upload_object_to_oss
+
+    tmp_dir = tempfile.mkdtemp()
+    png_dir = os.path.join(tmp_dir, 'PNG')
+    file_list = []
+    for x in range(20):
+        for y in range(20):
+            png_file = os.path.join(png_dir, '9', str(x), f'{y}.png')
+            os.makedirs(os.path.dirname(png_file), exist_ok=True)
+            with open(png_file, 'wb') as f:
+                f.write(os.urandom(2048))
+            file_list.append(png_file)
+
+    bucket = LocalFsBucket(os.path.join(tmp_dir, 'serial'), latency=0.005)
+    start = time.perf_counter()
+    for png_file in file_list:
+        upload_object_to_oss(bucket, tile_object_key('tiles', png_file), png_file)
+    serial_seconds = time.perf_counter() - start
+    print(f"serial    : {len(file_list) / serial_seconds:8.1f} objects/s, {bucket.request_count} requests")
+
+    bucket = LocalFsBucket(os.path.join(tmp_dir, 'bulk'), latency=0.005, throttle_rate=0.05)
+    metrics = BulkUploader(bucket, 'tiles', num_threads=32, backoff=0.01).upload(file_list)
+    print(f"bulk      : {metrics['objects_per_sec']:8.1f} objects/s, {bucket.request_count} requests, {metrics}")
+
+    # 再次上传: 快照中已存在, 全部跳过
+    metrics = BulkUploader(bucket, 'tiles', num_threads=32).upload(file_list)
+    print(f"re-upload : {metrics}")
@@ -3,6 +3,7 @@ from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from config_save import download_bucket, aster_bucket
 from utils import download_object_from_oss
+from bulk_download import ParallelDownloader
 
 
 def download_file(bucket, oss_url, download_file):
@@ -31,27 +32,8 @@ if __name__ == '__main__':
     with open(data_list_file, 'r', encoding='utf-8') as f:
         fn_list = [fn.strip() for fn in f.readlines()]
 
-    progress_bar = tqdm(total=len(fn_list), desc="ASTWBD")
-
-    # 使用列表来记录已完成任务数量，初始值设为0
-    completed_tasks = [0]
-
-    def update_progress_bar(future):
-        # 获取列表中的值
-        current_completed = completed_tasks[0]
-        future.result()  # 触发可能存在的异常（如果有异常会在这里抛出）
-        # 更新列表中的值，实现计数加1的效果
-        completed_tasks[0] = current_completed + 1
-        progress_bar.update(1)
-
-
-    # 创建一个上下文管理器来处理进程池
-    with ProcessPoolExecutor(max_workers=16) as executor:
-        futures = [executor.submit(download_file, aster_bucket, os.path.join(oss_download_url, fn),
-                                   os.path.join(download_dir, fn)) for fn in fn_list]
-
-        for future in futures:
-            future.add_done_callback(update_progress_bar)
-
-    # 确保进度条关闭
-    progress_bar.close()
+    # 多线程 + 大文件分片下载, 校验大小/CRC64, 中断后重跑只补齐缺失部分
+    downloader = ParallelDownloader(aster_bucket, num_threads=16)
+    tasks = [(os.path.join(oss_download_url, fn).replace("\\", "/"), os.path.join(download_dir, fn)) for fn in fn_list]
+    metrics = downloader.download(tasks, desc="ASTWBD")
+    print(metrics)
@@ -1,30 +1,26 @@
 from utils import get_all_files, upload_object_to_oss
 from config_save import geocloud_bucket, center_bucket
+from bulk_upload import BulkUploader, tile_object_key
+from Tile_Renderer import SHARED_TILE_DIR
 import os
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 
-def upload_files(bucket, oss_url, upload_file):
-    normalized_path = os.path.normpath(upload_file)
-    parts = normalized_path.split(os.sep)
-    current_level = parts[-3]  # 倒数第3层是 current_level
-    index_x = parts[-2]  # 倒数第2层是 index_x
-    index_y = parts[-1].replace('.png', '')  # 文件名部分是 index_y
-
-    oss_upload_file = os.path.join(oss_url, current_level, index_x, index_y) + '.png'
-    upload_object_to_oss(bucket, oss_upload_file, normalized_path, overwrite=overwrite_oss)
+def upload_files(bucket, oss_url, upload_file, overwrite_oss=False):
+    oss_upload_file = tile_object_key(oss_url, upload_file)
+    upload_object_to_oss(bucket, oss_upload_file, os.path.normpath(upload_file), overwrite=overwrite_oss)
 
 
 if __name__ == '__main__':
     png_dir = 'Data/GHS-V_0/PNG'
-    png_list = get_all_files(png_dir, suffix='png')
+    # 单一颜色瓦片共用的png不单独上传, 各瓦片文件是其硬链接
+    png_list = [fn for fn in get_all_files(png_dir, suffix='png') if SHARED_TILE_DIR not in fn.split(os.sep)]
     overwrite_oss = True
     # oss_upload_url = 'aster_functional_group/GlobalDatasets/Aster-GEDV3_NDVI/NPY/'
     oss_upload_url = 'earth/tiles/72'
-    for png_path in tqdm(png_list):
-        upload_files(geocloud_bucket, oss_upload_url, png_path)
+    metrics = BulkUploader(geocloud_bucket, oss_upload_url, overwrite=overwrite_oss, num_threads=32).upload(png_list)
 
-    print(f"Upload to OSS {oss_upload_url} OK, overwrite is {overwrite_oss}")
+    print(f"Upload to OSS {oss_upload_url} OK, overwrite is {overwrite_oss}, {metrics}")
 
 
 
@@ -96,27 +96,37 @@ def get_bbox_from_geotiff(geotiff_path):
     :return: rasterio.coords.BoundingBox对象
     """
     with rasterio.open(geotiff_path) as src:
-        # 获取图像的宽度和高度
-        width = src.width
-        height = src.height
+        return dataset_bbox(src)
 
-        # 获取图像的变换矩阵
-        transform = src.transform
 
-        # 计算边界框的四个角点坐标
-        left = transform.c
-        top = transform.f
-        right = left + transform.a * width
-        bottom = top + transform.e * height
+def dataset_bbox(src):
+    """
+    从已打开的rasterio数据集获取边界框, 与get_bbox_from_geotiff相同
+
+    :param src: rasterio数据集
+    :return: rasterio.coords.BoundingBox对象
+    """
+    # 获取图像的宽度和高度
+    width = src.width
+    height = src.height
+
+    # 获取图像的变换矩阵
+    transform = src.transform
 
-        left = max(left, -180.0)
-        bottom = max(bottom, -90.0)
-        top = min(top, 90.0)
-        right = min(right, 180.0)
+    # 计算边界框的四个角点坐标
+    left = transform.c
+    top = transform.f
+    right = left + transform.a * width
+    bottom = top + transform.e * height
 
-        # 创建BoundingBox对象
-        bbox = BoundingBox(left=left, bottom=bottom, right=right, top=top)
-        return bbox
+    left = max(left, -180.0)
+    bottom = max(bottom, -90.0)
+    top = min(top, 90.0)
+    right = min(right, 180.0)
+
+    # 创建BoundingBox对象
+    bbox = BoundingBox(left=left, bottom=bottom, right=right, top=top)
+    return bbox
 
 
 def process_tile(tile_index, input_file, global_grid, bands=None):
@@ -157,8 +167,13 @@ def extract_x_y_from_filename(filename):
 
 
 def save_json(data, filename):
-    with open(filename, 'w', encoding='utf-8') as json_file:
+    # 先写临时文件再替换, 中断时不会留下写了一半的json
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as json_file:
         json.dump(data, json_file, ensure_ascii=False, indent=4)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_file, filename)
 
 
 def load_json(filename):
@@ -237,6 +252,14 @@ def normalize(data, statistic_dict, stretch_method='gaussian'):
 
 
 def array_to_png(array, output_path, cmap=None, customized_cmap=None, selected_channels=None):
+    rgba_image = array_to_rgba(array, cmap=cmap, customized_cmap=customized_cmap, selected_channels=selected_channels)
+
+    # 使用 Pillow 保存图像
+    image = Image.fromarray(rgba_image, mode='RGBA')
+    image.save(output_path)
+
+
+def array_to_rgba(array, cmap=None, customized_cmap=None, selected_channels=None):
     # 创建NDVI颜色映射（从白色到绿色）
     if customized_cmap:
         cmap = customized_cmap
@@ -255,18 +278,23 @@ def array_to_png(array, output_path, cmap=None, customized_cmap=None, selected_c
     a = array[:, :, -1].astype(np.uint8) * 255
 
     # 创建 RGBA 图像
-    rgba_image = np.dstack((r, g, b, a))
-
-    # 使用 Pillow 保存图像
-    image = Image.fromarray(rgba_image, mode='RGBA')
-    image.save(output_path)
+    return np.dstack((r, g, b, a))
 
 
 def download_object_from_oss(bucket, oss_url, download_file):
-    if os.path.exists(download_file):
-        pass
-    else:
-        bucket.get_object_to_file(oss_url, download_file)
+    # 本地文件大小与OSS一致才跳过, 被中断的下载会重新下载
+    size = bucket.head_object(oss_url).content_length
+    if os.path.exists(download_file) and os.path.getsize(download_file) == size:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(download_file)), exist_ok=True)
+    # 先写临时文件, 下载完整后再改名
+    tmp_file = f'{download_file}.part'
+    bucket.get_object_to_file(oss_url, tmp_file)
+    tmp_size = os.path.getsize(tmp_file)
+    if tmp_size != size:
+        os.remove(tmp_file)
+        raise IOError(f"{oss_url} download incomplete: {tmp_size} != {size}")
+    os.replace(tmp_file, download_file)
 
 
 def upload_object_to_oss(bucket, oss_url, upload_file, overwrite=False):